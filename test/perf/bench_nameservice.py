@@ -0,0 +1,52 @@
+"""
+Wiring time benchmark for the cluster NameService
+
+Registers every node of a cluster, in random order, where each node
+connects to the next `fan_out` nodes, run it as:
+
+    python -m test.perf.bench_nameservice [nodes] [fan_out]
+"""
+import struct
+import sys
+import time
+from random import shuffle
+
+from zerocloud.proxyquery import NameService
+
+
+def registrations(nodes, fan_out):
+    messages = []
+    for peer_id in range(1, nodes + 1):
+        connects = [(peer_id + i - 1) % nodes + 1 for i in range(1, fan_out + 1)]
+        binds = [(peer_id - i - 1) % nodes + 1 for i in range(1, fan_out + 1)]
+        message = struct.pack('!III', peer_id, len(binds), len(connects))
+        message += ''.join([struct.pack('!IH', h, 20000 + h) for h in binds])
+        message += ''.join([struct.pack('!IH', h, 0) for h in connects])
+        address = ('10.0.%d.%d' % (peer_id / 250, peer_id % 250 + 1), 30000 + peer_id)
+        messages.append((message, address))
+    shuffle(messages)
+    return messages
+
+
+def run(nodes, fan_out):
+    messages = registrations(nodes, fan_out)
+    ns_job = NameService().add_job(nodes)
+    replied = 0
+    start = time.time()
+    for message, address in messages:
+        replied += len(ns_job.register(message, address))
+    elapsed = time.time() - start
+    print '%d nodes, %d connections each: %.1f ms, %d replies' \
+          % (nodes, fan_out, elapsed * 1000, replied)
+    if replied != nodes:
+        print 'ERROR: %d nodes did not get a reply' % (nodes - replied)
+
+
+if __name__ == '__main__':
+    nodes = 1000
+    fan_out = 10
+    if len(sys.argv) > 1:
+        nodes = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        fan_out = int(sys.argv[2])
+    run(nodes, fan_out)
@@ -0,0 +1,71 @@
+"""
+System map encoding benchmark
+
+Builds a cluster of nodes copied from one template node, each one reads
+an object and connects to the next `fan_out` nodes, and encodes system maps
+of all of them with NodeEncoder and with SysmapEncoder, run it as:
+
+    python -m test.perf.bench_sysmap [nodes] [fan_out]
+
+Without arguments runs 1000 and 10000 node clusters.
+"""
+import json
+import sys
+import time
+
+from swift.common.swob import Request
+
+from zerocloud.common import ZvmNode, ZvmChannel, NodeEncoder, SysmapEncoder, \
+    parse_location, ACCESS_READABLE, ACCESS_WRITABLE
+
+
+def cluster(nodes, fan_out):
+    template = ZvmNode(0, 'map', parse_location('swift://a/c/map.nexe'),
+                       args='-v input', env={'MODE': 'map'})
+    channels = [ZvmChannel('stdin', ACCESS_READABLE, content_type='text/plain'),
+                ZvmChannel('stdout', ACCESS_WRITABLE, content_type='text/plain'),
+                ZvmChannel('stderr', ACCESS_WRITABLE)]
+    req = Request.blank('/a', headers={'accept': '*/*'})
+    node_list = []
+    for node_id in range(1, nodes + 1):
+        node = template.copy(node_id, 'map-%d' % node_id)
+        for channel in channels:
+            path = None
+            if channel.device != 'stderr':
+                path = parse_location('swift://a/%s/%d' % (channel.device, node_id))
+            node.add_channel(channel=channel, path=path)
+        node.connect = ['tcp:%d:,/dev/out/map-%d,0,0,0,0,1024,1048576'
+                        % ((node_id + i) % nodes + 1, (node_id + i) % nodes + 1)
+                        for i in range(fan_out)]
+        node.wildcards = [str(node_id)]
+        node.path_info = '/a/stdin/%d' % node_id
+        node.name_service = 'udp:10.0.0.1:40000'
+        node.copy_cgi_env(req)
+        node_list.append(node)
+    return node_list
+
+
+def run(nodes, fan_out):
+    node_list = cluster(nodes, fan_out)
+    start = time.time()
+    for node in node_list:
+        json.dumps(node, cls=NodeEncoder)
+    elapsed = time.time() - start
+    print '%d nodes, NodeEncoder: %.1f ms' % (nodes, elapsed * 1000)
+    sysmap_encoder = SysmapEncoder()
+    start = time.time()
+    for node in node_list:
+        sysmap_encoder.encode(node)
+    elapsed = time.time() - start
+    print '%d nodes, SysmapEncoder: %.1f ms' % (nodes, elapsed * 1000)
+
+
+if __name__ == '__main__':
+    fan_out = 10
+    if len(sys.argv) > 2:
+        fan_out = int(sys.argv[2])
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]), fan_out)
+    else:
+        run(1000, fan_out)
+        run(10000, fan_out)
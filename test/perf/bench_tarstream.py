@@ -0,0 +1,89 @@
+"""
+Throughput benchmark for TarStream chunk framing
+
+Compares the buffer-list framing engine against the original
+string concatenation one, run it as:
+
+    python -m test.perf.bench_tarstream [total_megabytes]
+"""
+import sys
+import time
+from hashlib import md5
+
+from zerocloud.tarstream import TarStream, BLOCKSIZE, NUL, REGTYPE
+
+INPUT_CHUNK_SIZES = [1024, 64 * 1024, 4 * 1024 * 1024]
+
+
+class ConcatTarStream(TarStream):
+    """Original framing engine, accumulates output by string concatenation"""
+
+    def __init__(self, *args, **kwargs):
+        super(ConcatTarStream, self).__init__(*args, **kwargs)
+        self.concat_data = ''
+
+    @property
+    def data(self):
+        return self.concat_data
+
+    def serve_chunk(self, buf):
+        self.to_write -= len(buf)
+        if self.to_write < 0:
+            self.concat_data += buf[:self.to_write]
+            self.file_len += self.chunk_size
+            yield self.concat_data
+            self.concat_data = buf[self.to_write:]
+            self.to_write += self.chunk_size
+        else:
+            self.concat_data += buf
+
+
+def frame(stream_class, input_chunk, total_size):
+    """Frame total_size bytes arriving in input_chunk pieces as a tar member"""
+    stream = stream_class()
+    etag = md5()
+    count = 0
+    piece = 'x' * input_chunk
+    start = time.time()
+    header = stream.create_tarinfo(ftype=REGTYPE, name='stdin', size=total_size)
+    for chunk in stream.serve_chunk(header):
+        etag.update(chunk)
+        count += 1
+    sent = 0
+    while sent < total_size:
+        for chunk in stream.serve_chunk(piece):
+            etag.update(chunk)
+            count += 1
+        sent += input_chunk
+    blocks, remainder = divmod(total_size, BLOCKSIZE)
+    if remainder > 0:
+        for chunk in stream.serve_chunk(NUL * (BLOCKSIZE - remainder)):
+            etag.update(chunk)
+            count += 1
+    if stream.data:
+        etag.update(stream.data)
+        count += 1
+    return time.time() - start, count, etag.hexdigest()
+
+
+def run(total_size):
+    print '%-12s %-8s %10s %10s %8s' % ('input chunk', 'engine', 'seconds', 'MB/s', 'chunks')
+    for input_chunk in INPUT_CHUNK_SIZES:
+        # the quadratic engine needs much more time on small pieces
+        size = max(input_chunk, total_size)
+        results = {}
+        for name, cls in [('concat', ConcatTarStream), ('list', TarStream)]:
+            elapsed, count, etag = frame(cls, input_chunk, size)
+            results[name] = etag
+            print '%-12d %-8s %10.4f %10.1f %8d' % (input_chunk, name, elapsed,
+                                                    size / 1048576.0 / max(elapsed, 1e-6),
+                                                    count)
+        if results['concat'] != results['list']:
+            print 'ERROR: framed stream differs for input chunk %d' % input_chunk
+
+
+if __name__ == '__main__':
+    megabytes = 64
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    run(megabytes * 1048576)
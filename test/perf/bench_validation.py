@@ -0,0 +1,80 @@
+"""
+Per-call cost of the cluster map string validation
+
+Compares has_control_chars with the original implementation, that built
+its regex on every call, on typical strings, and the one-pass check
+of a whole cluster map with checking its strings one by one, run it as:
+
+    python -m test.perf.bench_validation [calls]
+"""
+import re
+import sys
+import time
+
+from zerocloud.validation import has_control_chars, cluster_map_has_control_chars
+
+STRINGS = [
+    ('short ascii str', 'stdout'),
+    ('ascii unicode', u'swift://account/container/object.nexe -v --input=/dev/stdin'),
+    ('non-ascii unicode', u'swift://account/\u043a\u043e\u043d\u0442\u0435\u0439\u043d\u0435\u0440/object'),
+    ('control char', u'map\x01reduce'),
+]
+
+
+def original_has_control_chars(line):
+    """Original implementation"""
+    if line:
+        RE_ILLEGAL = u'([\u0000-\u0008\u000b-\u000c\u000e-\u001f\ufffe-\uffff])' + \
+                     u'|' + \
+                     u'([%s-%s][^%s-%s])|([^%s-%s][%s-%s])|([%s-%s]$)|(^[%s-%s])' % \
+                     (unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff),
+                      unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff),
+                      unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff),)
+        if re.search(RE_ILLEGAL, line):
+            return True
+        if re.search(r"[\x01-\x1F\x7F]", line):
+            return True
+    return False
+
+
+def cluster_map(nodes):
+    return [{'name': u'node%d' % i,
+             'exec': {'path': u'swift://a/c/node%d.nexe' % i, 'args': u'-v', 'env': {u'N': unicode(i)}},
+             'file_list': [{'device': u'stdin'}, {'device': u'stdout'}, {'device': u'stderr'}]}
+            for i in range(nodes)]
+
+
+def check_one_by_one(cluster_config, validator):
+    for node in cluster_config:
+        validator(node['name'])
+        nexe = node['exec']
+        validator('%s %s %s' % (nexe['path'], nexe.get('args'), nexe.get('env')))
+        for channel in node['file_list']:
+            validator(channel['device'])
+
+
+def per_call(func, arg, calls):
+    start = time.time()
+    for i in xrange(calls):
+        func(arg)
+    return (time.time() - start) / calls * 1000000
+
+
+def run(calls):
+    for title, line in STRINGS:
+        print '%-18s original: %6.2f us, precompiled: %6.2f us' \
+              % (title, per_call(original_has_control_chars, line, calls),
+                 per_call(has_control_chars, line, calls))
+    cluster_config = cluster_map(1000)
+    rounds = max(calls / 10000, 1)
+    print '1000 node map      original: %6.2f ms, precompiled: %6.2f ms, one pass: %6.2f ms' \
+          % (per_call(lambda c: check_one_by_one(c, original_has_control_chars), cluster_config, rounds) / 1000,
+             per_call(lambda c: check_one_by_one(c, has_control_chars), cluster_config, rounds) / 1000,
+             per_call(cluster_map_has_control_chars, cluster_config, rounds) / 1000)
+
+
+if __name__ == '__main__':
+    calls = 100000
+    if len(sys.argv) > 1:
+        calls = int(sys.argv[1])
+    run(calls)
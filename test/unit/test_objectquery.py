@@ -10,9 +10,9 @@ import os
 import random
 import cPickle as pickle
 from time import time, sleep
-from eventlet import GreenPool
+from eventlet import GreenPool, listen, spawn, wsgi
 from unittest.case import SkipTest
-from hashlib import md5
+from hashlib import md5, sha256
 from tempfile import mkstemp, mkdtemp
 from shutil import rmtree
 from copy import copy
@@ -103,6 +103,7 @@ class TestObjectQuery(unittest.TestCase):
         self.conf = {'devices': self.testdir,
                      'mount_check': 'false',
                      'disable_fallocate': 'true',
+                     'zerovm_validation_cache': os.path.join(self.testdir, 'zvm-validation.log'),
                      'zerovm_sysimage_devices': 'sysimage1 /opt/zerovm/sysimage1 sysimage2 /opt/zerovm/sysimage2'
         }
         self.obj_controller = FakeApp(self.conf)
@@ -298,6 +299,186 @@ class TestObjectQuery(unittest.TestCase):
             #self.assertEqual(self.app.logger.log_dict['info'][0][0][0],
             #    'Zerovm CDR: 0 0 0 0 1 46 2 56 0 0 0 0')
 
+    def test_QUERY_nexe_cache(self):
+        self.setup_zerovm_query()
+        self.app.zerovm_nexe_cache_size = 1024 * 1024
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/o'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        req = self.zerovm_object_request()
+        req.headers['x-zerovm-boot-etag'] = self._nexescript_etag
+        with self.create_tar({'boot': StringIO(self._nexescript),
+                              'sysmap': StringIO(conf)}) as tar:
+            length = os.path.getsize(tar)
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-zerovm-nexe-cached'], self._nexescript_etag)
+            resp.body
+        # executable is not sent now, it is taken from cache
+        req = self.zerovm_object_request()
+        req.headers['x-zerovm-boot-etag'] = self._nexescript_etag
+        with self.create_tar({'sysmap': StringIO(conf)}) as tar:
+            length = os.path.getsize(tar)
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-zerovm-nexe-cached'], self._nexescript_etag)
+            tar = tarfile.open(fileobj=StringIO(resp.body))
+            self.assertEqual(tar.extractfile('stdout').read(), self._sortednumbers)
+        digest = sha256(self._nexescript).hexdigest()
+        self.assertTrue(self.app.validation_index.get(digest))
+
+    def test_nexe_cache_evicts_least_recently_used(self):
+        cache_dir = os.path.join(self.testdir, 'sda1', 'zvm-nexe-cache')
+        cache = objectquery.NexeCache(cache_dir, 10)
+        tmpdir = os.path.join(self.testdir, 'sda1', 'tmp')
+        for name in ['a', 'b', 'c']:
+            with open(os.path.join(tmpdir, name), 'wb') as fp:
+                fp.write(name * 4)
+            cache.put(name, os.path.join(tmpdir, name))
+            if name == 'b':
+                self.assertTrue(cache.link('a', os.path.join(tmpdir, 'a.link')))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.size, 8)
+        self.assertFalse(cache.link('b', os.path.join(tmpdir, 'b.link')))
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['a', 'c'])
+        # another worker sharing the directory sees the same entries
+        other = objectquery.NexeCache(cache_dir, 10)
+        with open(os.path.join(tmpdir, 'd'), 'wb') as fp:
+            fp.write('dddd')
+        other.put('d', os.path.join(tmpdir, 'd'))
+        self.assertEqual(other.size, 8)
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['c', 'd'])
+
+    def test_validation_index_is_shared_and_compacted(self):
+        path = os.path.join(self.testdir, 'zvm-validation.log')
+        index = objectquery.ValidationIndex(path, 2)
+        other = objectquery.ValidationIndex(path, 2)
+        self.assertEqual(index.get('a'), None)
+        index.put('a', True)
+        index.put('b', False)
+        self.assertEqual(other.get('a'), True)
+        self.assertEqual(other.get('b'), False)
+        index.put('c', True)
+        index.put('d', True)
+        index.put('e', False)
+        # index keeps two last verdicts, log is compacted to them
+        self.assertEqual(index.get('a'), None)
+        self.assertEqual(open(path).read(), 'd 1\ne 0\n')
+        self.assertEqual(objectquery.ValidationIndex(path, 2).get('e'), False)
+        self.assertEqual(other.get('d'), True)
+
+    def test_validation_index_refuses_unsafe_files(self):
+        path = os.path.join(self.testdir, 'zvm-validation.log')
+        index = objectquery.ValidationIndex(path, 10)
+        index.put('a', True)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        other = objectquery.ValidationIndex(path, 10)
+        os.chmod(path, 0o666)
+        self.assertRaises(ValueError, objectquery.ValidationIndex, path, 10)
+        # verdicts from a log somebody else could write are not used
+        index.put('b', True)
+        self.assertEqual(other.get('b'), None)
+        self.assertEqual(other.get('a'), True)
+        shared_dir = os.path.join(self.testdir, 'shared')
+        os.mkdir(shared_dir)
+        os.chmod(shared_dir, 0o1777)
+        self.assertRaises(ValueError, objectquery.ValidationIndex,
+                          os.path.join(shared_dir, 'zvm-validation.log'), 10)
+        # no file is default, verdicts are kept in memory
+        conf = dict(self.conf)
+        del conf['zerovm_validation_cache']
+        self.assertEqual(objectquery.ObjectQueryMiddleware(
+            self.obj_controller, conf).validation_index.path, '')
+
+    def test_QUERY_validation_verdict_by_content(self):
+        self.setup_zerovm_query()
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+
+        def run_query():
+            req = self.zerovm_free_request()
+            with self.create_tar({'boot': StringIO(self._nexescript),
+                                  'sysmap': StringIO(conf)}) as tar:
+                length = os.path.getsize(tar)
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = self.app.zerovm_query(req)
+                ''.join(resp.app_iter)
+                return resp
+        index = self.app.validation_index
+        # verdict planted under the etag of the executable is ignored
+        index.put(md5(self._nexescript).hexdigest(), True)
+        resp = run_query()
+        self.assertEqual(resp.headers['x-nexe-validation'], '0')
+        digest = sha256(self._nexescript).hexdigest()
+        self.assertEqual(index.get(digest), True)
+        resp = run_query()
+        self.assertEqual(resp.headers['x-nexe-validation'], '2')
+
+    def test_QUERY_cached_nexe_validated_by_content(self):
+        self.setup_zerovm_query()
+        self.app.zerovm_nexe_cache_size = 1024 * 1024
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        conf = json.dumps(conf, cls=NodeEncoder)
+        # original executable was validated, cache holds different bytes under its etag
+        self.app.validation_index.put(sha256(self._nexescript).hexdigest(), True)
+        tmpdir = os.path.join(self.testdir, 'sda1', 'tmp')
+        changed = os.path.join(tmpdir, 'changed')
+        with open(changed, 'wb') as fp:
+            fp.write(self._nexescript + '\n# changed\n')
+        cache = self.app.get_nexe_cache('sda1')
+        cache.put(self._nexescript_etag, changed)
+        original = os.path.join(tmpdir, 'original')
+        with open(original, 'wb') as fp:
+            fp.write(self._nexescript)
+        cache.put('0' * 32, original)
+
+        def run_query(etag):
+            req = self.zerovm_free_request()
+            req.headers['x-zerovm-boot-etag'] = etag
+            with self.create_tar({'sysmap': StringIO(conf)}) as tar:
+                length = os.path.getsize(tar)
+                req.body_file = Input(open(tar, 'rb'), length)
+                req.content_length = length
+                resp = self.app.zerovm_query(req)
+                ''.join(resp.app_iter)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(resp.headers['x-zerovm-nexe-cached'], etag)
+            return resp
+        resp = run_query(self._nexescript_etag)
+        self.assertEqual(resp.headers['x-nexe-validation'], '0')
+        # same bytes as validated ones skip validation under any etag
+        resp = run_query('0' * 32)
+        self.assertEqual(resp.headers['x-nexe-validation'], '2')
+
+    def test_daemon_pool_grows_and_shrinks(self):
+        self.app.zerovm_daemon_pool_size = 2
+        self.app.zerovm_daemon_idle_timeout = 0
+        cleaned = []
+        self.app._cleanup_daemon = lambda sock: cleaned.append(sock)
+        first = self.app._acquire_daemon('uuid')
+        self.assertEqual(first.sock, os.path.join(self.app.zerovm_sockets_dir, 'uuid'))
+        second = self.app._acquire_daemon('uuid')
+        self.assertEqual(second.sock, first.sock + '.1')
+        # pool is full, least busy instance is shared
+        third = self.app._acquire_daemon('uuid')
+        self.assertEqual(third.busy, 2)
+        self.app._release_daemon('uuid', first)
+        self.assertIs(self.app._acquire_daemon('uuid'), first)
+        for daemon in [first, second, third]:
+            self.app._release_daemon('uuid', daemon)
+        self.assertEqual(cleaned, [second.sock])
+        self.assertEqual(self.app.daemon_pools['uuid'], [first])
+
     def test_QUERY_sort_textout(self):
         self.setup_zerovm_query()
         req = self.zerovm_object_request()
@@ -1118,6 +1299,87 @@ time.sleep(10)
                 self.app.parser_config['manifest']['Timeout'] = orig_timeout
                 self.app.zerovm_kill_timeout = orig_kill_timeout
 
+    def execute_script(self, script, timeout=1, kill_timeout=1):
+        if self.zerovm_mock:
+            os.unlink(self.zerovm_mock)
+        fd, self.zerovm_mock = mkstemp()
+        os.write(fd, script)
+        os.close(fd)
+        self.app.zerovm_exename = ['python', self.zerovm_mock]
+        orig_timeout = self.app.parser_config['manifest']['Timeout']
+        orig_kill_timeout = self.app.zerovm_kill_timeout
+        try:
+            self.app.parser_config['manifest']['Timeout'] = timeout
+            self.app.zerovm_kill_timeout = kill_timeout
+            metrics = {}
+            start = time()
+            result = self.app.execute_zerovm('manifest', metrics=metrics)
+            return result, metrics, time() - start
+        finally:
+            self.app.parser_config['manifest']['Timeout'] = orig_timeout
+            self.app.zerovm_kill_timeout = orig_kill_timeout
+
+    def test_execute_zerovm_output_bigger_than_pipe(self):
+        self.app.zerovm_stdout_size = 1024 * 1024
+        (retcode, stdout, stderr), metrics, _junk = self.execute_script(r'''
+import sys
+sys.stderr.write('e' * 200000)
+sys.stdout.write('o' * 300000)
+''')
+        # stderr is over its limit, reading stops one byte past it
+        self.assertEqual(retcode, 4)
+        self.assertEqual(stderr, 'e' * (self.app.zerovm_stderr_size + 1))
+        self.app.zerovm_stderr_size = 1024 * 1024
+        # both streams are drained, child never blocks on a full pipe
+        (retcode, stdout, stderr), metrics, _junk = self.execute_script(r'''
+import sys
+sys.stderr.write('e' * 200000)
+sys.stdout.write('o' * 300000)
+''')
+        self.assertEqual(retcode, 0)
+        self.assertEqual(stdout, 'o' * 300000)
+        self.assertEqual(stderr, 'e' * 200000)
+
+    def test_execute_zerovm_timeout_kill(self):
+        # terminated on timeout
+        (retcode, stdout, stderr), metrics, elapsed = self.execute_script(r'''
+import sys, time
+sys.stdout.write('started')
+sys.stdout.flush()
+time.sleep(10)
+''', timeout=0)
+        self.assertEqual(retcode, 2)
+        self.assertEqual(stdout, 'started')
+        self.assertTrue(elapsed < 5)
+        # ignores SIGTERM, killed after kill timeout
+        (retcode, stdout, stderr), metrics, elapsed = self.execute_script(r'''
+import signal, sys, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+sys.stdout.write('started')
+sys.stdout.flush()
+time.sleep(10)
+''', timeout=0)
+        self.assertEqual(retcode, 3)
+        self.assertEqual(stdout, 'started')
+        self.assertTrue(2 <= elapsed < 5)
+        self.assertTrue(metrics['wall'] >= 2)
+
+    def test_execute_zerovm_metrics(self):
+        (retcode, stdout, stderr), metrics, elapsed = self.execute_script(r'''
+import sys, time
+end = time.time() + 0.3
+while time.time() < end:
+    pass
+sys.exit(1)
+''')
+        # non-zero exit status is reported as 1
+        self.assertEqual(retcode, 1)
+        self.assertEqual(sorted(metrics.keys()), ['sys', 'user', 'wall'])
+        self.assertTrue(0.3 <= metrics['wall'] <= elapsed)
+        # cpu time is the child's, not ours
+        self.assertTrue(metrics['user'] + metrics['sys'] >= 0.2)
+        self.assertTrue(metrics['user'] + metrics['sys'] <= metrics['wall'] + 0.1)
+
     def test_QUERY_simulteneous_running_zerovm_limits(self):
         self.setup_zerovm_query()
         nexefile = StringIO('return sleep(.2)')
@@ -1385,6 +1647,96 @@ time.sleep(10)
             self.assertEqual(resp.status_int, 400)
             self.assertEqual(resp.body, 'Could not resolve channel path: bla-bla')
 
+    def test_fetch_remote_object(self):
+        body = 'x' * 5000
+        etag = md5(body).hexdigest()
+
+        def object_server(env, start_response):
+            if env['PATH_INFO'] != '/sda/1/a/c/o':
+                start_response('404 Not Found', [('Content-Length', '0')])
+                return ['']
+            if env.get('HTTP_IF_MATCH') != etag:
+                start_response('412 Precondition Failed', [('Content-Length', '0')])
+                return ['']
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        sock = listen(('127.0.0.1', 0))
+        server = spawn(wsgi.server, sock, object_server, log=StringIO())
+
+        class PeerRing(object):
+
+            def get_nodes(self, account, container, obj):
+                return 1, [{'ip': '127.0.0.1', 'port': sock.getsockname()[1], 'device': 'sda'}]
+
+            def get_more_nodes(self, partition):
+                return iter([])
+
+        self.app._object_ring = PeerRing()
+        tmpdir = os.path.join(self.testdir, 'sda1', 'tmp')
+        try:
+            ch = {'path': 'swift://a/c/o', 'device': 'stdin',
+                  'remote': {'size': len(body), 'etag': etag}}
+            self.assertEqual(self.app._fetch_remote_object(ch, tmpdir), None)
+            self.assertEqual(open(ch['lpath']).read(), body)
+            self.assertEqual(ch['size'], len(body))
+            # only the version that proxy has checked is accepted
+            ch = {'path': 'swift://a/c/o', 'device': 'input',
+                  'remote': {'etag': md5('other').hexdigest()}}
+            self.assertEqual(self.app._fetch_remote_object(ch, tmpdir), 503)
+            self.assertNotIn('lpath', ch)
+            ch = {'path': 'swift://a/c/o', 'device': 'input',
+                  'remote': {'size': 10, 'etag': etag}}
+            self.assertEqual(self.app._fetch_remote_object(ch, tmpdir), 503)
+            ch = {'path': 'swift://a/c/missing', 'device': 'input',
+                  'remote': {'size': 10, 'etag': etag}}
+            self.assertEqual(self.app._fetch_remote_object(ch, tmpdir), 404)
+        finally:
+            server.kill()
+            sock.close()
+
+    def test_QUERY_remote_fetch_only_marked(self):
+        self.setup_zerovm_query()
+        randomnumbers = self.create_random_numbers(10)
+        fetched = []
+
+        def fetch_remote_object(ch, zerovm_tmp):
+            fetched.append(ch['path'])
+            ch['lpath'] = os.path.join(zerovm_tmp, ch['device'])
+            with open(ch['lpath'], 'wb') as fp:
+                fp.write(randomnumbers)
+            return None
+
+        self.app._fetch_remote_object = fetch_remote_object
+        conf = ZvmNode(1, 'sort', parse_location('swift://a/c/exe'))
+        conf.add_new_channel('stdin', ACCESS_READABLE, parse_location('swift://a/c/remote'))
+        conf.add_new_channel('stdout', ACCESS_WRITABLE)
+        # proxy did not check the object, it had to send it
+        with self.create_tar({'boot': StringIO(self._nexescript),
+                              'sysmap': StringIO(json.dumps(conf, cls=NodeEncoder))}) as tar:
+            req = self.zerovm_free_request()
+            length = os.path.getsize(tar)
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 400)
+            self.assertEqual(resp.body, 'Could not resolve channel path: swift://a/c/remote')
+        self.assertEqual(fetched, [])
+        # plain object is marked by proxy and fetched by object server
+        conf.get_channel(device='stdin').remote = {'size': len(randomnumbers),
+                                                   'etag': md5(randomnumbers).hexdigest()}
+        with self.create_tar({'boot': StringIO(self._nexescript),
+                              'sysmap': StringIO(json.dumps(conf, cls=NodeEncoder))}) as tar:
+            req = self.zerovm_free_request()
+            length = os.path.getsize(tar)
+            req.body_file = Input(open(tar, 'rb'), length)
+            req.content_length = length
+            resp = self.app.zerovm_query(req)
+            self.assertEqual(resp.status_int, 200)
+            tar = tarfile.open(fileobj=StringIO(resp.body))
+            self.assertEqual(tar.extractfile('stdout').read(), self._sortednumbers)
+        self.assertEqual(fetched, ['swift://a/c/remote'])
+
     def test_QUERY_filter_factory(self):
         app = objectquery.filter_factory(self.conf)(FakeApp(self.conf))
         self.assertIsInstance(app, objectquery.ObjectQueryMiddleware)
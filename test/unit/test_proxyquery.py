@@ -13,14 +13,15 @@ import unittest
 import os
 import cPickle as pickle
 from time import time, sleep
-from swift.common.swob import Request, HTTPNotFound, HTTPUnauthorized
+from swift.common.swob import Request, Response, HTTPNotFound, HTTPUnauthorized
 from hashlib import md5
 from tempfile import mkstemp, mkdtemp
 from shutil import rmtree
 
 from nose import SkipTest
 from httplib import HTTPException
-from eventlet import sleep, spawn, Timeout, util, wsgi, listen, GreenPool
+from eventlet import sleep, spawn, Timeout, util, wsgi, listen, GreenPool, Queue
+from eventlet.event import Event
 from gzip import GzipFile
 from contextlib import contextmanager
 
@@ -33,8 +34,13 @@ from swift.common import ring
 
 from zerocloud import proxyquery, objectquery
 from test.unit import connect_tcp, readuntil2crlfs, FakeLogger, fake_http_connect
-from zerocloud.common import CLUSTER_CONFIG_FILENAME, NODE_CONFIG_FILENAME, NodeEncoder
-from zerocloud.configparser import ClusterConfigParser, ClusterConfigParsingError
+from zerocloud.common import CLUSTER_CONFIG_FILENAME, NODE_CONFIG_FILENAME, NodeEncoder, SwiftPath, \
+    SysmapEncoder, ZvmNode, ZvmChannel, ACCESS_READABLE, parse_location
+from zerocloud.configparser import ClusterConfigParser, ClusterConfigParsingError, GlobMask, \
+    ClusterPlanCache
+from zerocloud.validation import has_control_chars, cluster_map_has_control_chars
+from zerocloud import configparser
+from zerocloud.tarstream import TarStream
 
 try:
     import simplejson as json
@@ -125,6 +131,56 @@ class FakeMemcacheReturnsNone(FakeMemcache):
         return None
 
 
+class FakePlacementRing(object):
+
+    def __init__(self, objects, server_count=6):
+        self.servers = [{'ip': '10.0.1.%d' % i, 'port': 6000, 'device': 'sda'}
+                        for i in range(server_count)]
+        # object name -> indexes of the servers that store it
+        self.objects = objects
+        self.partition_count = server_count
+
+    def get_nodes(self, account, container=None, obj=None):
+        devs = self.objects[obj]
+        return devs[0], [self.servers[i] for i in devs]
+
+    def get_part_nodes(self, part):
+        return [self.servers[(part + i) % len(self.servers)] for i in range(3)]
+
+
+class FakePlacementApp(object):
+
+    def __init__(self, ring, error_limited=()):
+        self.object_ring = ring
+        self.limited = error_limited
+
+    def error_limited(self, dev):
+        return dev['ip'] in self.limited
+
+
+class FakeExecConn(object):
+
+    def __init__(self, node):
+        self.cnode = node
+        self.queue = Queue()
+        self.failed = False
+
+    def sent(self):
+        data = []
+        while not self.queue.empty():
+            data.append(self.queue.get())
+        return data
+
+
+class FakeDataSource(object):
+
+    def __init__(self, body, nodes):
+        self.body = body
+        self.content_length = len(body)
+        self.bytes_transferred = 0
+        self.nodes = nodes
+
+
 def setup():
     global _testdir, _test_servers, _test_sockets,\
     _orig_container_listing_limit, _test_coros
@@ -465,9 +521,10 @@ class TestProxyQuery(unittest.TestCase):
 
     def test_QUERY_name_service(self):
         peers = 3
-        ns_server = proxyquery.NameService(peers)
+        ns_server = proxyquery.NameService()
         pool = GreenPool()
         ns_server.start(pool)
+        ns_server.add_job(peers)
         connection_map = {}
         sleep(0.1)
 
@@ -530,6 +587,76 @@ class TestProxyQuery(unittest.TestCase):
         th3.wait()
         ns_server.stop()
 
+    def test_name_service_resolves_connections_without_barrier(self):
+        ns_job = proxyquery.NameService().add_job(3)
+
+        def registration(id, binds, connects):
+            return struct.pack('!III', id, len(binds), len(connects)) + \
+                ''.join([struct.pack('!IH', h, port) for h, port in binds]) + \
+                ''.join([struct.pack('!IH', h, 0) for h in connects])
+
+        # 1 -> 2 -> 3, node 3 connects to nobody
+        self.assertEqual(ns_job.register(registration(1, [], [2]), ('10.0.0.1', 1001)), [])
+        self.assertEqual(ns_job.register(registration(3, [(2, 3002)], []), ('10.0.0.3', 1003)), [3])
+        self.assertEqual(ns_job.register(registration(2, [(1, 2001)], [3]), ('10.0.0.1', 1002)), [1, 2])
+        reply = str(ns_job.conn_map[1][0])
+        host, port = struct.unpack_from('!4sH', reply, 12)
+        self.assertEqual(socket.inet_ntop(socket.AF_INET, host), '127.0.0.1')
+        self.assertEqual(port, 2001)
+        reply = str(ns_job.conn_map[2][0])
+        host, port = struct.unpack_from('!4sH', reply, 18)
+        self.assertEqual(socket.inet_ntop(socket.AF_INET, host), '10.0.0.3')
+        self.assertEqual(port, 3002)
+        # registration sent again is answered again
+        self.assertEqual(ns_job.register(registration(1, [], [2]), ('10.0.0.1', 1001)), [1])
+
+    def test_name_service_routes_jobs_by_node_id(self):
+        ns_server = proxyquery.NameService()
+        job1 = ns_server.add_job(3)
+        job2 = ns_server.add_job(2, 4)
+        self.assertEqual(job1.base, 0)
+        self.assertEqual(job2.base, 3)
+        self.assertEqual(ns_server.get_job(1), job1)
+        self.assertEqual(ns_server.get_job(3), job1)
+        self.assertEqual(ns_server.get_job(4), job2)
+        self.assertEqual(ns_server.get_job(7), job2)
+        self.assertEqual(ns_server.get_job(8), None)
+        ns_server.remove_job(job1)
+        self.assertEqual(ns_server.get_job(1), None)
+        # ids wrap around and skip ranges of running jobs
+        ns_server.next_base = proxyquery.NameService.MAX_NODE_ID - 1
+        job3 = ns_server.add_job(5)
+        self.assertEqual(job3.base, 7)
+        self.assertEqual(ns_server.get_job(8), job3)
+        self.assertEqual(ns_server.get_job(4), job2)
+
+    def test_failed_POST_removes_name_service_job(self):
+        pqm = proxyquery.ProxyQueryMiddleware(self.proxy_app, {'zerovm_ns_hostname': '127.0.0.1'})
+        # name service is not started, nodes never register in this test
+        ns_server = pqm.name_service = proxyquery.NameService()
+        ns_server.port = 1
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [{'device': 'stdout'}],
+                'count': 2
+            }
+        ]
+
+        def authorize(req):
+            return HTTPUnauthorized(request=req)
+        req = Request.blank('/a', environ={'REQUEST_METHOD': 'POST',
+                                           'swift.authorize': authorize},
+                            headers={'Content-Type': 'application/json'})
+        req.body = json.dumps(conf)
+        res = pqm.get_controller('a', None, None).POST(req)
+        self.assertEqual(res.status_int, 401)
+        # job was added for the two nodes and removed on the error return
+        self.assertEqual(ns_server.next_base, 2)
+        self.assertEqual(ns_server.jobs, {})
+        self.assertEqual(ns_server.bases, [])
+
     def test_QUERY_sort_store_stdout(self):
         self.setup_QUERY()
         conf = [
@@ -687,6 +814,139 @@ return 'hello, world'
         self.assertEqual(res.body, 'hello, world')
         self.check_container_integrity(prosrv, '/v1/a/c', {})
 
+    def test_QUERY_batch(self):
+        self.setup_QUERY()
+        prolis = _test_sockets[0]
+        prosrv = _test_servers[0]
+        nexe =\
+r'''
+return 'hello, world'
+'''[1:-1]
+        self.create_object(prolis, '/v1/a/c/hello.nexe', nexe)
+        hello = [
+            {
+                "name": "hello",
+                "exec": {"path": "swift://a/c/hello.nexe"},
+                "file_list": [
+                    {"device": "stdout"}
+                ]
+            }
+        ]
+        missing = [
+            {
+                "name": "missing",
+                "exec": {"path": "swift://a/c/missing.nexe"},
+                "file_list": [
+                    {"device": "stdout"}
+                ]
+            }
+        ]
+        req = self.zerovm_request()
+        req.headers['x-zerovm-batch'] = 'yes'
+        req.body = json.dumps([hello, missing, hello])
+        res = req.get_response(prosrv)
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(res.content_type, 'application/x-tar')
+        members = {}
+        tar = tarfile.open(fileobj=StringIO(res.body))
+        for info in tar.getmembers():
+            members[info.name] = tar.extractfile(info).read()
+        self.assertEqual(sorted(members.keys()),
+                         ['0/body', '0/headers', '1/body', '1/headers',
+                          '2/body', '2/headers'])
+        self.assertEqual(members['0/body'], 'hello, world')
+        self.assertEqual(members['2/body'], 'hello, world')
+        self.assertTrue(json.loads(members['0/headers'])['status'].startswith('200'))
+        self.assertFalse(json.loads(members['1/headers'])['status'].startswith('200'))
+        req = self.zerovm_request()
+        req.headers['x-zerovm-batch'] = 'yes'
+        req.body = json.dumps(hello)
+        res = req.get_response(prosrv)
+        self.assertEqual(res.status_int, 422)
+        self.check_container_integrity(prosrv, '/v1/a/c', {})
+
+    def test_batch_streams_results_early(self):
+        pqm = proxyquery.ProxyQueryMiddleware(self.proxy_app, {'zerovm_batch_concurrency': '2'})
+        job_count = 5
+        started = []
+        finish = [Event() for _i in range(job_count)]
+
+        def execute_batch_job(req, path_parts, cluster_config):
+            n = json.loads(cluster_config)[0]['name']
+            started.append(n)
+            finish[n].wait()
+            return Response(body=str(n) * 70000)
+        pqm._execute_batch_job = execute_batch_job
+        req = Request.blank('/v1/a', environ={'REQUEST_METHOD': 'POST'},
+                            headers={'Content-Type': 'application/json'})
+        req.body = json.dumps([[{'name': n}] for n in range(job_count)])
+        with Timeout(5):
+            # response is ready before any job is finished
+            resp = pqm.execute_batch(req, {})
+        self.assertEqual(resp.status_int, 200)
+        sleep(0.01)
+        self.assertEqual(started, [0, 1])
+        finish[0].send()
+        with Timeout(5):
+            chunk = next(resp.app_iter)
+        # first result is streamed, next job took its place
+        self.assertIn('0' * 1000, chunk)
+        sleep(0.01)
+        self.assertEqual(started, [0, 1, 2])
+        for event in finish[1:]:
+            event.send()
+        tar = tarfile.open(fileobj=StringIO(chunk + ''.join(resp.app_iter)))
+        names = tar.getnames()
+        self.assertEqual(names, ['%d/%s' % (n, name) for n in range(job_count) for name in ('headers', 'body')])
+        for n in range(job_count):
+            self.assertEqual(tar.extractfile('%d/body' % n).read(), str(n) * 70000)
+        self.assertEqual(started, range(job_count))
+
+    def test_batch_job_request(self):
+        pqm = proxyquery.ProxyQueryMiddleware(self.proxy_app, {})
+        jobs = []
+
+        class FakeController(object):
+            def POST(self, req, cluster_config=None):
+                jobs.append((req, cluster_config))
+                return Response(body='ok')
+        pqm.get_controller = lambda account, container, obj: FakeController()
+        req = Request.blank('/v1/a', environ={'REQUEST_METHOD': 'POST',
+                                              'swift.trans_id': 'tx1'},
+                            headers={'Content-Type': 'application/json',
+                                     'x-zerovm-batch': 'yes'})
+        req.body = json.dumps([[{'name': 'a'}], [{'name': 'b'}]])
+        path_parts = {'version': 'v1', 'account_name': 'a',
+                      'container_name': None, 'object_name': None}
+        resp = pqm.execute_batch(req, path_parts)
+        self.assertEqual(resp.status_int, 200)
+        resp.body
+        self.assertEqual([json.loads(conf)[0]['name'] for _req, conf in jobs], ['a', 'b'])
+        for job_req, _conf in jobs:
+            self.assertEqual(job_req.content_length, None)
+            self.assertNotIn('x-zerovm-batch', job_req.headers)
+            self.assertEqual(job_req.body, '')
+        # batch request itself is not changed
+        self.assertEqual(req.content_length, len(req.body))
+        self.assertIn('x-zerovm-batch', req.headers)
+
+    def test_batch_results_check_body_size(self):
+        for body, size in [(['abc'], 3), (['ab', 'c'], 3)]:
+            stream = TarStream(path_list=proxyquery._batch_results(
+                [Response(app_iter=body, content_length=size)]))
+            tar = tarfile.open(fileobj=StringIO(''.join(stream)))
+            self.assertEqual(tar.extractfile('0/body').read(), 'abc')
+        for body, size in [(['abc'], 4), (['ab', 'c'], 2)]:
+            stream = TarStream(path_list=proxyquery._batch_results(
+                [Response(app_iter=body, content_length=size)]))
+            self.assertRaises(Exception, ''.join, stream)
+        # unknown size is buffered
+        resp = Response(app_iter=['ab', 'c'])
+        resp.content_length = None
+        stream = TarStream(path_list=proxyquery._batch_results([resp]))
+        tar = tarfile.open(fileobj=StringIO(''.join(stream)))
+        self.assertEqual(tar.extractfile('0/body').read(), 'abc')
+
     def test_QUERY_hello_stderr(self):
         self.setup_QUERY()
         prolis = _test_sockets[0]
@@ -897,6 +1157,106 @@ return resp
         self.assertEqual(res.body, self.get_sorted_numbers())
         self.check_container_integrity(prosrv, '/v1/a/c', {})
 
+    def test_disk_result_cache_dir_is_private(self):
+        tmpdir = mkdtemp()
+        try:
+            self.assertRaises(ValueError, proxyquery.DiskResultCache, '', 300, 1048576)
+            path = os.path.join(tmpdir, 'results')
+            cache = proxyquery.DiskResultCache(path, 300, 1048576)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+            os.rmdir(path)
+            # removed directory is created again as private
+            cache.put('key', 'entry')
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+            self.assertEqual(os.listdir(path), ['key'])
+            for mode in (0o755, 0o770, 0o1777):
+                os.chmod(path, mode)
+                self.assertRaises(ValueError, proxyquery.DiskResultCache, path, 300, 1048576)
+            os.chmod(path, 0o700)
+            proxyquery.DiskResultCache(path, 300, 1048576)
+            self.assertRaises(ValueError, proxyquery.DiskResultCache, os.path.join(path, 'key'), 300, 1048576)
+            # disk cache must be configured explicitly
+            self.assertRaises(ValueError, proxyquery.filter_factory({'zerovm_result_cache': 'disk'}), self.proxy_app)
+        finally:
+            rmtree(tmpdir)
+
+    def test_result_cache_key_covers_cgi_env(self):
+        pqm = proxyquery.ProxyQueryMiddleware(self.proxy_app, {})
+        controller = pqm.get_controller('a', 'c', 'exe')
+        location = SwiftPath.init('a', 'c', 'exe')
+        config = json.dumps([{'name': 'exe', 'exec': {'path': location.url},
+                              'file_list': [{'device': 'stdout'}]}])
+        obj_resp = Response(headers={'etag': 'abc'})
+
+        def cache_key(environ=None, headers=None):
+            req = Request.blank('/open/a/c/exe', environ=environ or {}, headers=headers or {})
+            return controller._result_cache_key(req, config, location, obj_resp)
+        key = cache_key()
+        self.assertTrue(key)
+        self.assertEqual(cache_key(), key)
+        keys = [cache_key(environ={'REMOTE_USER': 'other'}),
+                cache_key(environ={'REMOTE_ADDR': '10.0.0.1'}),
+                cache_key(headers={'User-Agent': 'other'}),
+                cache_key(headers={'Referer': 'http://other'}),
+                cache_key(environ={'SERVER_PORT': '8080'})]
+        self.assertNotIn(key, keys)
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_QUERY_GET_result_cache(self):
+        self.setup_QUERY()
+        prolis = _test_sockets[0]
+        prosrv = _test_servers[0]
+        nexe =\
+r'''
+return 'Test this'
+'''[1:-1]
+        self.create_object(prolis, '/v1/a/c/exe2', nexe, content_type='application/x-nexe')
+        prosrv.app.zerovm_result_cache = 'disk'
+        prosrv.app.result_cache_disk = proxyquery.DiskResultCache(
+            os.path.join(_testdir, 'results'), 300, 1048576)
+        try:
+            req = Request.blank('/open/a/c/exe2?' + urlencode({'content_type': 'text/html'}))
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, 'Test this')
+            self.assertNotIn('x-zerovm-result-cached', res.headers)
+            req = Request.blank('/open/a/c/exe2?' + urlencode({'content_type': 'text/html'}))
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, 'Test this')
+            self.assertEqual(res.headers['content-type'], 'text/html')
+            self.assertEqual(res.headers['x-zerovm-result-cached'], 'true')
+            # cached result is authorized as the job would be
+            req = Request.blank('/open/a/c/exe2?' + urlencode({'content_type': 'text/html'}))
+            req.environ['swift.authorize'] = lambda req: HTTPUnauthorized(request=req)
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 401)
+            # another user agent is a different job
+            req = Request.blank('/open/a/c/exe2?' + urlencode({'content_type': 'text/html'}),
+                                headers={'User-Agent': 'other'})
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertNotIn('x-zerovm-result-cached', res.headers)
+            # different args
+            req = Request.blank('/open/a/c/exe2?' + urlencode({'content_type': 'text/plain'}))
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertNotIn('x-zerovm-result-cached', res.headers)
+            # new executable
+            nexe =\
+r'''
+return 'Test that'
+'''[1:-1]
+            self.create_object(prolis, '/v1/a/c/exe2', nexe, content_type='application/x-nexe')
+            req = Request.blank('/open/a/c/exe2?' + urlencode({'content_type': 'text/html'}))
+            res = req.get_response(prosrv)
+            self.assertEqual(res.status_int, 200)
+            self.assertEqual(res.body, 'Test that')
+            self.assertNotIn('x-zerovm-result-cached', res.headers)
+        finally:
+            prosrv.app.zerovm_result_cache = ''
+            prosrv.app.result_cache_disk = None
+
     def test_QUERY_use_image(self):
         self.setup_QUERY()
         prolis = _test_sockets[0]
@@ -1496,6 +1856,596 @@ return json.dumps(con_list)
             str(range(30, 40))
         ]))
 
+    def test_find_objects_lists_by_prefix(self):
+        listed = []
+
+        def list_account(account, mask=None, prefix=None, **kwargs):
+            for container in ['c_in1', 'c_in2', 'c_out']:
+                if container.startswith(prefix) and mask.match(container):
+                    yield container
+
+        def list_container(account, container, mask=None, prefix=None, **kwargs):
+            listed.append((container, prefix))
+            for obj in ['in1', 'in2', 'out1']:
+                if obj.startswith(prefix) and mask.match(obj):
+                    yield obj
+
+        parser = ClusterConfigParser({}, 'application/octet-stream', {},
+                                     list_account, list_container)
+        objects = parser.find_objects(SwiftPath('swift://a/c_in*/in*'))
+        self.assertEqual([path.url for path in objects],
+                         ['swift://a/c_in1/in1', 'swift://a/c_in1/in2',
+                          'swift://a/c_in2/in1', 'swift://a/c_in2/in2'])
+        self.assertEqual(listed, [('c_in1', 'in'), ('c_in2', 'in')])
+        self.assertRaises(ClusterConfigParsingError, list,
+                          parser.find_objects(SwiftPath('swift://a/c_in1/x*')))
+
+    def test_find_objects_lists_containers_concurrently(self):
+        containers = ['c%d' % i for i in range(5)]
+        running = [0, 0]
+
+        def list_account(account, mask=None, prefix=None, **kwargs):
+            return containers
+
+        def list_container(account, container, mask=None, prefix=None, **kwargs):
+            running[0] += 1
+            running[1] = max(running)
+            # last containers are listed first
+            sleep(0.01 * (5 - int(container[1:])))
+            running[0] -= 1
+            if container == 'c3' and kwargs.get('fail'):
+                raise Exception('listing failed')
+            return ['o1', 'o2']
+
+        parser = ClusterConfigParser({}, 'application/octet-stream',
+                                     {'listing_concurrency': 3},
+                                     list_account, list_container)
+        objects = parser.find_objects(SwiftPath('swift://a/c*/o*'))
+        self.assertEqual([path.url for path in objects],
+                         ['swift://a/%s/%s' % (c, o) for c in containers for o in ['o1', 'o2']])
+        self.assertEqual(running[1], 3)
+        try:
+            list(parser.find_objects(SwiftPath('swift://a/c*/o*'), fail=True))
+        except ClusterConfigParsingError, e:
+            self.assertEqual(str(e), 'Error querying object server for container: c3')
+        else:
+            self.fail('listing error is not reported')
+
+    def test_list_container_cache(self):
+        self.setup_QUERY()
+        prolis = _test_sockets[0]
+        prosrv = _test_servers[0]
+        memcache = FakeMemcache()
+        req = Request.blank('/v1/a', environ={'swift.cache': memcache})
+        prosrv.app.zerovm_listing_cache = True
+        try:
+            names = prosrv.list_container('a', 'c_in1', request=req, prefix='in')
+            self.assertEqual(list(names), ['input1', 'input2'])
+            cached = memcache.get('zvmlist/a/c_in1/in')
+            self.assertEqual(cached['names'], ['input1', 'input2'])
+            cached['names'] = ['input1']
+            names = prosrv.list_container('a', 'c_in1', request=req, prefix='in')
+            self.assertEqual(list(names), ['input1'])
+            # container has changed since listing was cached
+            cached['validator'] = [0, 0]
+            names = prosrv.list_container('a', 'c_in1', request=req, prefix='in')
+            self.assertEqual(list(names), ['input1', 'input2'])
+            self.assertEqual(memcache.get('zvmlist/a/c_in1/in')['names'], ['input1', 'input2'])
+            # new object is listed, even while Swift still caches the container info
+            self.create_object(prolis, '/v1/a/c_in1/input3', 'data')
+            names = prosrv.list_container('a', 'c_in1', request=req, prefix='in')
+            self.assertEqual(list(names), ['input1', 'input2', 'input3'])
+        finally:
+            prosrv.app.zerovm_listing_cache = False
+            Request.blank('/v1/a/c_in1/input3',
+                          environ={'REQUEST_METHOD': 'DELETE'}).get_response(prosrv)
+
+    def test_parse_reuses_cached_plan(self):
+        objects = ['in1', 'in2']
+        listed = []
+
+        def list_container(account, container, mask=None, prefix=None, **kwargs):
+            listed.append(container)
+            return objects
+
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [
+                    {'device': 'stdin', 'path': 'swift://a/c_in1/in*'},
+                    {'device': 'stdout', 'path': 'swift://a/c_out1/out*'}
+                ],
+                'connect': ['sort']
+            }
+        ]
+        plan_cache = ClusterPlanCache(10)
+        limits = {'limits': {'reads': 1, 'writes': 1, 'rbytes': 1, 'wbytes': 1}}
+        parser = ClusterConfigParser({}, 'application/octet-stream', limits,
+                                     None, list_container, plan_cache=plan_cache)
+        parser.parse(conf, False, 'a', 3)
+        self.assertEqual(len(plan_cache.plans), 1)
+        first = json.dumps(parser.node_list, cls=NodeEncoder, sort_keys=True)
+        parser.node_list[0].channels[0].path = None
+        parser = ClusterConfigParser({}, 'application/octet-stream', limits,
+                                     None, list_container, plan_cache=plan_cache)
+        parser.parse(conf, False, 'a', 3)
+        self.assertEqual(json.dumps(parser.node_list, cls=NodeEncoder, sort_keys=True), first)
+        self.assertEqual(sorted(parser.nodes.keys()), ['sort-1', 'sort-2'])
+        self.assertEqual(parser.total_count, 2)
+        self.assertEqual(parser.node_id, 3)
+        # wildcards are listed again, plan is not reused if objects have changed
+        self.assertEqual(listed, ['c_in1', 'c_in1'])
+        objects.append('in3')
+        parser.parse(conf, False, 'a', 3)
+        self.assertEqual(sorted(parser.nodes.keys()), ['sort-1', 'sort-2', 'sort-3'])
+        self.assertEqual(len(plan_cache.plans), 1)
+
+    def test_node_copy_changes_do_not_leak(self):
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe', 'env': {'KEY': 'value'}},
+                'file_list': [
+                    {'device': 'stdin', 'path': 'swift://a/c/in'},
+                    {'device': 'stdout', 'path': 'swift://a/c/out',
+                     'content_type': 'text/plain', 'meta': {'key': 'value'}}
+                ]
+            }
+        ]
+        plan_cache = ClusterPlanCache(10)
+        limits = {'limits': {'reads': 1, 'writes': 1, 'rbytes': 1, 'wbytes': 1}}
+        parser = ClusterConfigParser({}, 'application/octet-stream', limits,
+                                     None, None, plan_cache=plan_cache)
+        parser.parse(conf, False, 'a', 3)
+        cached_nodes = plan_cache.plans.values()[0][0]
+        cached = json.dumps(cached_nodes, cls=NodeEncoder, sort_keys=True)
+        node = parser.node_list[0]
+        original = json.dumps(node, cls=NodeEncoder, sort_keys=True)
+        channel_data = json.dumps({'channels': [{'device': 'stdout', 'content_type': 'text/html',
+                                                 'meta': {'key': 'new', 'other': 'x'}}]})
+        node_copy = node.copy(2)
+        node_copy.copy_cgi_env(Request.blank('/a/c/o?x=1'))
+        proxyquery._load_channel_data(node_copy, StringIO(channel_data))
+        self.assertEqual(node_copy.env['QUERY_STRING'], 'x=1')
+        self.assertEqual(node_copy.env['KEY'], 'value')
+        stdout = node_copy.get_channel(device='stdout')
+        self.assertEqual(stdout.content_type, 'text/html')
+        self.assertEqual(stdout.meta, {'key': 'new', 'other': 'x'})
+        # node the copy was made from and the cached plan are unchanged
+        self.assertEqual(json.dumps(node, cls=NodeEncoder, sort_keys=True), original)
+        self.assertEqual(node.env, {'KEY': 'value'})
+        self.assertEqual(node.get_channel(device='stdout').meta, {'key': 'value'})
+        self.assertEqual(json.dumps(cached_nodes, cls=NodeEncoder, sort_keys=True), cached)
+        # same for the nodes parser gets from the plan cache
+        parser = ClusterConfigParser({}, 'application/octet-stream', limits,
+                                     None, None, plan_cache=plan_cache)
+        parser.parse(conf, False, 'a', 3)
+        node = parser.node_list[0]
+        node.copy_cgi_env(Request.blank('/a/c/o?y=2'))
+        proxyquery._load_channel_data(node, StringIO(channel_data))
+        self.assertEqual(node.get_channel(device='stdout').content_type, 'text/html')
+        self.assertEqual(json.dumps(cached_nodes, cls=NodeEncoder, sort_keys=True), cached)
+        self.assertEqual(json.dumps(plan_cache.plans.values()[0][0], cls=NodeEncoder, sort_keys=True),
+                         cached)
+
+    def test_sysmap_encoder(self):
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe', 'args': 'a b', 'env': {'KEY': 'value'}},
+                'file_list': [
+                    {'device': 'stdin', 'path': 'swift://a/c_in1/in*'},
+                    {'device': 'stdout', 'path': 'swift://a/c_out1/out*',
+                     'content_type': 'text/plain', 'meta': {'key': 'value'}},
+                    {'device': 'stderr'}
+                ],
+                'connect': ['sort']
+            }
+        ]
+        limits = {'limits': {'reads': 1, 'writes': 1, 'rbytes': 1, 'wbytes': 1}}
+        parser = ClusterConfigParser({}, 'application/octet-stream', limits,
+                                     None, lambda *args, **kwargs: ['in1', 'in2', 'in3'])
+        parser.parse(conf, False, 'a', 1)
+        req = Request.blank('/a', headers={'accept': u'text/\u043f'.encode('utf-8')})
+        sysmap_encoder = SysmapEncoder()
+        parser.build_connect_strings()
+        for node in parser.node_list:
+            node.name_service = 'udp:127.0.0.1:1234'
+            node.copy_cgi_env(req)
+            node.replicas.append(node.copy(node.id + 3))
+            self.assertEqual(json.loads(sysmap_encoder.encode(node)),
+                             json.loads(json.dumps(node, cls=NodeEncoder)))
+        del node.path_info
+        self.assertEqual(json.loads(sysmap_encoder.encode(node)),
+                         json.loads(json.dumps(node, cls=NodeEncoder)))
+
+    def test_has_control_chars(self):
+        self.assertFalse(has_control_chars('stdout'))
+        self.assertFalse(has_control_chars(u'/dev/\u043f\u0443\u0442\u044c'))
+        self.assertFalse(has_control_chars(u'\ud800\udc00'))
+        self.assertTrue(has_control_chars('std\x7fout'))
+        self.assertTrue(has_control_chars(u'std\tout'))
+        self.assertTrue(has_control_chars(u'\u043f\x01'))
+        self.assertTrue(has_control_chars(u'\u043f\ufffe'))
+        self.assertTrue(has_control_chars(u'\ud800a'))
+        self.assertTrue(has_control_chars(u'\u043f\udc00'))
+        conf = [
+            {
+                'name': 'sort',
+                'exec': {'path': 'swift://a/c/exe', 'args': 'a b'},
+                'file_list': [{'device': 'stdout'}]
+            }
+        ]
+        self.assertFalse(cluster_map_has_control_chars(conf))
+        conf[0]['file_list'].append({'device': 'std\x00in'})
+        self.assertTrue(cluster_map_has_control_chars(conf))
+        parser = ClusterConfigParser({}, 'application/octet-stream', {}, None, None)
+        try:
+            parser.parse(conf, False)
+        except ClusterConfigParsingError, e:
+            self.assertEqual(str(e), 'Bad device name: std\x00in in sort')
+        else:
+            self.fail('invalid device name is accepted')
+        self.assertTrue(cluster_map_has_control_chars({'name': 'sort'}))
+
+    def test_node_channel_index(self):
+        node = ZvmNode(1, 'sort', SwiftPath('swift://a/c/exe'))
+        node.add_new_channel('stdin', 1, SwiftPath('swift://a/c/in1'))
+        node.add_channel(channel=ZvmChannel('stdout', 2), path=SwiftPath('swift://a/c/out'))
+        node.add_new_channel('stdin', 1, SwiftPath('swift://a/c/in2'))
+        node.add_new_channel('stderr', 2)
+        self.assertEqual(node.get_channel(device='stdin').path.url, 'swift://a/c/in1')
+        self.assertEqual(node.get_channel(path=SwiftPath('swift://a/c/in2')), node.channels[2])
+        self.assertEqual(node.get_channel(device='stderr'), node.channels[3])
+        self.assertEqual(node.get_channel(device='stdout', path=SwiftPath('swift://a/c/in1')),
+                         node.channels[1])
+        self.assertEqual(node.get_channel(device='image', path=SwiftPath('swift://a/c/in1')),
+                         node.channels[0])
+        self.assertEqual(node.get_channel(device='image'), None)
+        new_node = node.copy(2)
+        self.assertEqual(new_node.get_channel(device='stdout'), new_node.channels[1])
+        self.assertFalse(new_node.get_channel(device='stdout') is node.channels[1])
+        node.channels = list(reversed(node.channels))
+        self.assertEqual(node.get_channel(device='stdin').path.url, 'swift://a/c/in2')
+
+    def test_build_connect_strings(self):
+        conf = [
+            {
+                'name': 'map',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [{'device': 'stdout'}],
+                'connect': ['reduce'],
+                'count': 3
+            },
+            {
+                'name': 'reduce',
+                'exec': {'path': 'swift://a/c/exe'},
+                'file_list': [{'device': 'stdout'}],
+                'count': 4
+            }
+        ]
+        limits = {'reads': 1, 'writes': 2, 'rbytes': 3, 'wbytes': 4}
+        parser = ClusterConfigParser({}, 'application/octet-stream', {'limits': limits},
+                                     None, None)
+        parser.parse(conf, False)
+        parser.build_connect_strings()
+        map1 = parser.nodes['map-1']
+        self.assertEqual(map1.connect,
+                         ['tcp:%d:,/dev/out/reduce-%d,0,0,0,0,2,4' % (3 + i, i) for i in range(1, 5)])
+        self.assertEqual(parser.nodes['reduce-2'].bind,
+                         ['tcp:%d:0,/dev/in/map-%d,0,0,1,3,0,0' % (i, i) for i in range(1, 4)])
+        ranged = ClusterConfigParser({}, 'application/octet-stream',
+                                     {'limits': limits, 'connect_ranges': True},
+                                     None, None)
+        ranged.parse(conf, False)
+        ranged.build_connect_strings()
+        self.assertEqual(ranged.nodes['map-1'].connect,
+                         [['tcp:', 4, ':,/dev/out/reduce-', 1, ',0,0,0,0,2,4', 4]])
+        for node in ranged.node_list:
+            self.assertEqual(list(configparser._expand_connections(node.connect + node.bind)),
+                             parser.nodes[node.name].connect + parser.nodes[node.name].bind)
+
+    def test_glob_mask(self):
+        mask = GlobMask('logs/2013-*.gz')
+        self.assertEqual(mask.prefix, 'logs/2013-')
+        self.assertTrue(mask.match('logs/2013-01.gz'))
+        self.assertTrue(mask.match('logs/2013-01/02.gz'))
+        self.assertFalse(mask.match('logs/2014-01.gz'))
+        self.assertFalse(mask.match('logs/2013-01.txt'))
+        mask = GlobMask('a.b*')
+        self.assertEqual(mask.prefix, 'a.b')
+        self.assertFalse(mask.match('axb'))
+        mask = GlobMask('*')
+        self.assertEqual(mask.prefix, '')
+        self.assertTrue(mask.match('anything'))
+
+    def placement_request(self, node_id, inputs, replicate=1):
+        node = ZvmNode(node_id, 'node-%d' % node_id, SwiftPath('swift://a/c/exe'),
+                       replicate=replicate)
+        for i, obj in enumerate(inputs):
+            node.add_new_channel('input%d' % i, ACCESS_READABLE, SwiftPath('swift://a/c/%s' % obj))
+        node.path_info = '/a'
+        for i in range(1, replicate):
+            node.replicas.append(node.copy(node_id + i * 100))
+        req = Request.blank('/a')
+        req.node = node
+        return req
+
+    def test_plan_placement_colocated_inputs(self):
+        ring = FakePlacementRing({'exe': [5, 4, 3], 'big': [0, 1, 2], 'small': [2, 3, 4]})
+        controller = _test_servers[0].get_controller('a', None, None)
+        controller.app = FakePlacementApp(ring)
+        req = self.placement_request(1, ['big', 'small'])
+        plan = controller._plan_placement([req], {'/a/c/big': 1000, '/a/c/small': 10})
+        partition, preferred = plan[id(req.node)]
+        # server 2 has both inputs, then servers with the big one
+        self.assertEqual(preferred[0]['ip'], '10.0.1.2')
+        self.assertEqual(sorted(dev['ip'] for dev in preferred[1:3]), ['10.0.1.0', '10.0.1.1'])
+        self.assertEqual(len(preferred), 6)
+        # node without inputs is placed on a random partition
+        controller.get_random_partition = lambda: 3
+        req = self.placement_request(2, [])
+        req.node.exe = parse_location('file://python:python')
+        plan = controller._plan_placement([req], {})
+        self.assertEqual(plan[id(req.node)][0], 3)
+        self.assertEqual(sorted(dev['ip'] for dev in plan[id(req.node)][1]),
+                         ['10.0.1.3', '10.0.1.4', '10.0.1.5'])
+
+    def test_plan_placement_shared_object(self):
+        ring = FakePlacementRing({'exe': [5, 4, 3], 'data': [0, 1, 2], 'other': [3, 4, 5]})
+        controller = _test_servers[0].get_controller('a', None, None)
+        controller.app = FakePlacementApp(ring)
+        sizes = {'/a/c/data': 1000, '/a/c/other': 100}
+        reqs = [self.placement_request(i, ['data']) for i in range(3)]
+        reqs.append(self.placement_request(3, ['other']))
+        plan = controller._plan_placement(reqs, sizes)
+        # nodes reading the same object are spread over the servers that have it
+        first = [plan[id(req.node)][1][0]['ip'] for req in reqs[:3]]
+        self.assertEqual(sorted(first), ['10.0.1.0', '10.0.1.1', '10.0.1.2'])
+        self.assertTrue(plan[id(reqs[3].node)][1][0]['ip'] in ['10.0.1.3', '10.0.1.4', '10.0.1.5'])
+        # replicas of one node never share a host while there are others
+        req = self.placement_request(10, ['data'], replicate=3)
+        plan = controller._plan_placement([req], sizes)
+        hosts = [plan[id(n)][1][0]['ip'] for n in [req.node] + req.node.replicas]
+        self.assertEqual(sorted(hosts), ['10.0.1.0', '10.0.1.1', '10.0.1.2'])
+
+    def test_preferred_nodes_first(self):
+        ring = FakePlacementRing({'data': [0, 1, 2]})
+        controller = _test_servers[0].get_controller('a', None, None)
+        controller.app = FakePlacementApp(ring, error_limited=['10.0.1.0'])
+        preferred = [ring.servers[i] for i in (0, 1, 2)]
+        node_iter = iter([ring.servers[i] for i in (2, 1, 3, 4)])
+        # error limited preferred server is skipped, ring order is the fallback
+        self.assertEqual([dev['ip'] for dev in controller._preferred_nodes_first(preferred, node_iter)],
+                         ['10.0.1.1', '10.0.1.2', '10.0.1.3', '10.0.1.4'])
+        controller.app.limited = ['10.0.1.0', '10.0.1.1', '10.0.1.2']
+        node_iter = iter([ring.servers[i] for i in (3, 4)])
+        self.assertEqual([dev['ip'] for dev in controller._preferred_nodes_first(preferred, node_iter)],
+                         ['10.0.1.3', '10.0.1.4'])
+
+    def test_authorize_remote_object(self):
+        controller = _test_servers[0].get_controller('a', None, None)
+        objects = {
+            '/a/c/plain': Response(body='x' * 10, headers={'etag': 'e1'}),
+            '/a/c/dlo': Response(body='', headers={'etag': 'e2', 'x-object-manifest': 'c/seg'}),
+            '/a/c/slo': Response(body='[]', headers={'etag': 'e3', 'x-static-large-object': 'True'}),
+            '/a/c/missing': HTTPNotFound()
+        }
+        heads = []
+
+        def head_object(req, load_from):
+            heads.append(load_from)
+            return objects[load_from]
+
+        controller._head_object = head_object
+        node = ZvmNode(1, 'node-1', SwiftPath('swift://a/c/exe'), replicate=2)
+        for name in ('plain', 'dlo', 'slo'):
+            node.add_new_channel(name, ACCESS_READABLE, SwiftPath('swift://a/c/%s' % name))
+        node.replicas.append(node.copy(2))
+        req = Request.blank('/a')
+        sizes = {}
+        remote_objects = {}
+        for ch in node.channels:
+            self.assertEqual(controller._authorize_remote_object(ch, node, req, {}, sizes,
+                                                                 remote_objects), None)
+        self.assertEqual(sizes, {'/a/c/plain': 10, '/a/c/dlo': 0, '/a/c/slo': 2})
+        # only plain objects are left to object servers, manifests are sent by proxy
+        for n in [node] + node.replicas:
+            self.assertEqual(n.get_channel(device='plain').remote, {'size': 10, 'etag': 'e1'})
+            self.assertFalse(hasattr(n.get_channel(device='dlo'), 'remote'))
+            self.assertFalse(hasattr(n.get_channel(device='slo'), 'remote'))
+        sysmap = json.loads(json.dumps(node, cls=NodeEncoder))
+        self.assertEqual([ch.get('remote') for ch in sysmap['channels']],
+                         [{'size': 10, 'etag': 'e1'}, None, None])
+        self.assertEqual(json.loads(SysmapEncoder().encode(node)), sysmap)
+        # object is checked once for all nodes of the job
+        other = ZvmNode(3, 'node-3', SwiftPath('swift://a/c/exe'))
+        other.add_new_channel('stdin', ACCESS_READABLE, SwiftPath('swift://a/c/plain'))
+        controller._authorize_remote_object(other.channels[0], other, req, {}, sizes, remote_objects)
+        self.assertEqual(other.channels[0].remote, {'size': 10, 'etag': 'e1'})
+        self.assertEqual(heads, ['/a/c/plain', '/a/c/dlo', '/a/c/slo'])
+        other.add_new_channel('input', ACCESS_READABLE, SwiftPath('swift://a/c/missing'))
+        resp = controller._authorize_remote_object(other.channels[1], other, req, {}, sizes,
+                                                   remote_objects)
+        self.assertEqual(resp.status_int, 404)
+
+    def test_data_source_shared_framing(self):
+        nodes = [ZvmNode(i, 'node-%d' % i, SwiftPath('swift://a/c/exe')) for i in range(3)]
+        conns = [FakeExecConn(node) for node in nodes]
+        body = ''.join(chr(i % 256) for i in range(70000))
+        data_src = FakeDataSource(body, [{'node': nodes[0], 'dev': 'stdin'},
+                                         {'node': nodes[1], 'dev': 'stdin'},
+                                         {'node': nodes[2], 'dev': 'input'}])
+        req = Request.blank('/a')
+        proxyquery._attach_connections_to_data_sources(conns, [data_src])
+        # one tar stream for each device name, not for each connection
+        self.assertEqual(len(data_src.streams), 2)
+        proxyquery._send_tar_headers(False, data_src)
+        for offset in range(0, len(body), 4096):
+            self.assertEqual(proxyquery._send_data_chunk(False, data_src,
+                                                         body[offset:offset + 4096], req),
+                             None)
+        self.assertEqual(proxyquery._finalize_tar_streams(False, data_src, req), None)
+        sent = [conn.sent() for conn in conns]
+        # connections that get the same member share the very same chunks
+        self.assertEqual(len(sent[0]), len(sent[1]))
+        for chunk0, chunk1 in zip(sent[0], sent[1]):
+            self.assertTrue(chunk0 is chunk1)
+        members = []
+        for chunks in sent:
+            data = ''.join(chunks)
+            self.assertEqual(len(data) % 512, 0)
+            tar = tarfile.open(fileobj=StringIO(data + '\0' * 1024))
+            info = tar.next()
+            members.append((info.name, tar.extractfile(info).read()))
+            self.assertEqual(tar.next(), None)
+        self.assertEqual(members, [('stdin', body), ('stdin', body), ('input', body)])
+        self.assertEqual(''.join(sent[0])[512:], ''.join(sent[2])[512:])
+
+    def test_schedule_data_sources(self):
+        conns = [FakeExecConn(ZvmNode(i, 'node-%d' % i, SwiftPath('swift://a/c/exe'))) for i in range(2)]
+        first = FakeDataSource('1', [])
+        first.conns = [{'conn': conns[0], 'dev': 'stdin'}, {'conn': conns[1], 'dev': 'stdin'}]
+        second = FakeDataSource('2', [])
+        second.conns = [{'conn': conns[0], 'dev': 'input'}]
+        third = FakeDataSource('3', [])
+        third.conns = [{'conn': conns[1], 'dev': 'input'}]
+        last = FakeDataSource('4', [])
+        last.conns = [{'conn': conns[0], 'dev': 'input1'}, {'conn': conns[1], 'dev': 'input1'}]
+        proxyquery._schedule_data_sources(conns, [first, second, third, last])
+        self.assertEqual([src.ready.ready() for src in (first, second, third, last)],
+                         [True, False, False, False])
+        proxyquery._advance_data_sources(first)
+        self.assertEqual([src.ready.ready() for src in (second, third, last)],
+                         [True, True, False])
+        proxyquery._advance_data_sources(third)
+        self.assertFalse(last.ready.ready())
+        proxyquery._advance_data_sources(second)
+        self.assertTrue(last.ready.ready())
+        proxyquery._advance_data_sources(last)
+        self.assertEqual([conn.data_sources for conn in conns], [[], []])
+
+    def test_schedule_data_sources_duplicate_conn(self):
+        conn = FakeExecConn(ZvmNode(1, 'node-1', SwiftPath('swift://a/c/exe')))
+        # same connection gets both data sources under two device names each
+        first = FakeDataSource('1', [])
+        first.conns = [{'conn': conn, 'dev': 'boot'}, {'conn': conn, 'dev': 'stdin'}]
+        second = FakeDataSource('2', [])
+        second.conns = [{'conn': conn, 'dev': 'input1'}, {'conn': conn, 'dev': 'input2'}]
+        proxyquery._schedule_data_sources([conn], [first, second])
+        self.assertEqual(conn.data_sources, [first, second])
+        self.assertTrue(first.ready.ready())
+        self.assertFalse(second.ready.ready())
+        proxyquery._advance_data_sources(first)
+        self.assertEqual(conn.data_sources, [second])
+        self.assertTrue(second.ready.ready())
+        proxyquery._advance_data_sources(second)
+        self.assertEqual(conn.data_sources, [])
+
+    def test_send_data_source_wait_timeout(self):
+        self.setup_QUERY()
+        prosrv = _test_servers[0]
+        controller = prosrv.get_controller('a', None, None)
+        conn = FakeExecConn(ZvmNode(1, 'node-1', SwiftPath('swift://a/c/exe')))
+        first = FakeDataSource('1', [{'node': conn.cnode, 'dev': 'stdin'}])
+        second = FakeDataSource('2', [{'node': conn.cnode, 'dev': 'input'}])
+        second.app_iter = iter(['2'])
+        proxyquery._attach_connections_to_data_sources([conn], [first, second])
+        proxyquery._schedule_data_sources([conn], [first, second])
+        orig_timeout = prosrv.app.zerovm_source_wait_timeout
+        prosrv.app.zerovm_source_wait_timeout = 0.1
+        try:
+            # first data source is never sent, second one must not wait forever
+            resp = controller._send_data_source(second, False, Request.blank('/a'))
+            self.assertEqual(resp.status_int, 408)
+            self.assertEqual(conn.sent(), [])
+        finally:
+            prosrv.app.zerovm_source_wait_timeout = orig_timeout
+
+    def daemon_config(self, exe='file://sysimage1:bin/python', devices=('sysimage1', 'stdout')):
+        return [{'name': 'daemon',
+                 'exec': {'path': exe},
+                 'file_list': [{'device': dev} for dev in devices]}]
+
+    def test_parse_daemon_node(self):
+        pqm = proxyquery.ProxyQueryMiddleware(self.proxy_app, {'zerovm_sysimage_devices': 'sysimage1 sysimage2'})
+        node = pqm.parse_daemon_node('d1', self.daemon_config(devices=('stdout', 'sysimage1', 'stderr')), 'test')
+        self.assertEqual(node.exe.url, 'file://sysimage1:bin/python')
+        self.assertEqual([ch.device for ch in node.channels], ['stderr', 'stdout', 'sysimage1'])
+        # network channels are not allowed
+        conf = self.daemon_config()
+        conf[0]['connect'] = ['daemon']
+        self.assertEqual(pqm.parse_daemon_node('d1', conf, 'test'), None)
+        # executable must be in a sysimage device
+        self.assertEqual(pqm.parse_daemon_node('d1', self.daemon_config(exe='swift://a/c/exe'), 'test'), None)
+        self.assertEqual(pqm.parse_daemon_node('d1', self.daemon_config(exe='file://image:bin/python'), 'test'),
+                         None)
+        self.assertEqual(pqm.parse_daemon_node('d1', [{'name': 'daemon'}], 'test'), None)
+
+    def test_daemon_registry_lookup(self):
+
+        def node(exe='file://sysimage1:bin/python', devices=('stdout', 'sysimage1')):
+            node = ZvmNode(1, 'daemon', parse_location(exe))
+            for dev in devices:
+                node.add_new_channel(dev, ACCESS_READABLE)
+            return node
+        registry = proxyquery.DaemonRegistry()
+        registry.register('first', node())
+        registry.register('second', node())
+        # node device only has to be a part of daemon device
+        registry.register('image', node(devices=('sysimage1',)))
+        registry.register('other', node(exe='file://sysimage2:bin/python'))
+        self.assertEqual(len(registry), 4)
+        # first daemon that can run the node wins
+        self.assertEqual(registry.lookup(node(devices=('sysimage1', 'stdout'))), 'first')
+        self.assertEqual(registry.lookup(node(devices=('image',))), 'image')
+        self.assertEqual(registry.lookup(node(exe='file://sysimage2:bin/python')), 'other')
+        self.assertEqual(registry.lookup(node(devices=('stderr', 'sysimage1'))), None)
+        self.assertEqual(registry.lookup(node(devices=('stderr', 'stdout', 'sysimage1'))), None)
+        self.assertEqual(registry.lookup(node(exe='file://sysimage1:bin/lua')), None)
+        self.assertEqual(registry.lookup(node(devices=())), None)
+        copy = registry.copy()
+        registry.unregister('first')
+        self.assertEqual(registry.lookup(node()), 'second')
+        self.assertEqual(copy.lookup(node()), 'first')
+        # registered again, goes to the end of the list
+        copy.register('first', node())
+        self.assertEqual(copy.lookup(node()), 'second')
+        registry.unregister('second')
+        registry.unregister('image')
+        self.assertEqual(registry.lookup(node()), None)
+        self.assertEqual(registry.index.keys(), [('file://sysimage2:bin/python', 2)])
+
+    def test_daemon_registry_background_reload(self):
+        pqm = proxyquery.ProxyQueryMiddleware(self.proxy_app, {'zerovm_sysimage_devices': 'sysimage1 sysimage2',
+                                                               'zerovm_daemon_registry': '/a/c/daemons'})
+        loaded = Queue()
+
+        class FakeObjectController(object):
+
+            def __init__(ctl, app, account, container, obj):
+                pass
+
+            def GET(ctl, req):
+                loaded.get()
+                return Response(body=json.dumps({'d1': self.daemon_config()}), headers={'etag': 'e1'})
+        orig_controller = proxyquery.ObjectController
+        proxyquery.ObjectController = FakeObjectController
+        try:
+            static_daemons = pqm.app.zerovm_daemons
+            pqm.load_daemon_registry(Request.blank('/v1/a'))
+            # request does not wait for the registry
+            self.assertTrue(pqm.app.zerovm_daemons is static_daemons)
+            self.assertTrue(pqm.daemon_registry_loading)
+            loaded.put(True)
+            sleep(0.01)
+            self.assertFalse(pqm.daemon_registry_loading)
+            self.assertEqual(pqm.app.zerovm_daemons.daemons.keys(), ['d1'])
+            self.assertEqual(pqm.daemon_registry_etag, 'e1')
+        finally:
+            proxyquery.ObjectController = orig_controller
+
     def test_QUERY_group_transform(self):
         self.setup_QUERY()
         conf = [
@@ -0,0 +1,164 @@
+from StringIO import StringIO
+import random
+import tarfile
+import unittest
+
+from zerocloud.tarstream import UntarStream, ExtractedFile, StringBuffer
+
+
+def make_tar(files):
+    data = StringIO()
+    tar = tarfile.open(fileobj=data, mode='w', format=tarfile.GNU_FORMAT)
+    for name, body in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(body)
+        tar.addfile(info, StringIO(body))
+    tar.close()
+    return data.getvalue()
+
+
+def random_chunks(data, max_size, rand):
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rand.randint(1, max_size)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+class TestUntarStream(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(1234)
+
+    def random_files(self):
+        files = []
+        for i in range(self.rand.randint(1, 5)):
+            name = 'file%d' % i
+            if self.rand.random() < 0.3:
+                # long names need an extended header block in front
+                name = 'long/' + 'x' * 150 + str(i)
+            body = ''.join(chr(self.rand.randint(0, 255))
+                           for _ in range(self.rand.randint(0, 3000)))
+            files.append((name, body))
+        return files
+
+    def untar(self, chunks):
+        tar_iter = iter(chunks)
+        untar = UntarStream(tar_iter)
+        result = []
+        for chunk in tar_iter:
+            untar.update_buffer(chunk)
+            info = untar.get_next_tarinfo()
+            while info:
+                if info.offset_data:
+                    untar.to_write = info.size
+                    untar.offset_data = info.offset_data
+                    result.append((info.name,
+                                   ''.join(untar.untar_file_iter())))
+                info = untar.get_next_tarinfo()
+        return result, untar
+
+    def test_random_chunks(self):
+        for max_size in (1, 100, 700, 5000, 70000):
+            files = self.random_files()
+            tar = make_tar(files)
+            result, untar = self.untar(
+                random_chunks(tar, max_size, self.rand))
+            self.assertEqual(result, files)
+            # consumed chunks are released
+            self.assertTrue(untar.buffer_end - untar.chunks_offset
+                            <= 2 * max_size + 1024)
+
+    def test_header_spans_chunks(self):
+        files = [('long/' + 'y' * 200, 'data' * 100), ('short', 'abc')]
+        tar = make_tar(files)
+        untar = UntarStream(iter([]))
+        # feed the long name headers one byte at a time,
+        # tarinfo is read again from the start until all of it is here
+        header_size = tar.index('data' * 100)
+        for i in range(header_size - 1):
+            untar.update_buffer(tar[i])
+            self.assertEqual(untar.get_next_tarinfo(), None)
+            self.assertEqual(untar.offset, 0)
+        untar.update_buffer(tar[header_size - 1])
+        info = untar.get_next_tarinfo()
+        self.assertEqual(info.name, files[0][0])
+        self.assertEqual(info.offset_data, header_size)
+        untar.tar_iter = iter(random_chunks(tar[header_size:], 300,
+                                            self.rand))
+        untar.to_write = info.size
+        untar.offset_data = info.offset_data
+        self.assertEqual(''.join(untar.untar_file_iter()), files[0][1])
+        untar.update_buffer(''.join(untar.tar_iter))
+        info = untar.get_next_tarinfo()
+        self.assertEqual(info.name, 'short')
+
+    def test_iter_writes_files(self):
+        files = self.random_files()
+        tar = make_tar(files)
+        buffers = [StringBuffer(name) for name, _ in files]
+        chunks = random_chunks(tar, 500, self.rand)
+        self.assertEqual(''.join(UntarStream(chunks, buffers)), tar)
+        for buf, (name, body) in zip(buffers, files):
+            self.assertTrue(buf.is_closed)
+            self.assertEqual(buf.body, body)
+
+    def test_extracted_file(self):
+        files = self.random_files()
+        tar = make_tar(files)
+        tar_iter = iter(random_chunks(tar, 700, self.rand))
+        untar = UntarStream(tar_iter)
+        result = []
+        for chunk in tar_iter:
+            untar.update_buffer(chunk)
+            info = untar.get_next_tarinfo()
+            while info:
+                untar.to_write = info.size
+                untar.offset_data = info.offset_data
+                extracted = ExtractedFile(untar)
+                size = self.rand.choice([1, 100, 65536])
+                parts = []
+                data = extracted.read(size)
+                while data:
+                    self.assertTrue(len(data) <= size)
+                    parts.append(data)
+                    data = extracted.read(size)
+                result.append((info.name, ''.join(parts)))
+                info = untar.get_next_tarinfo()
+        self.assertEqual(result, files)
+
+    def test_extracted_file_smaller_reads(self):
+        body = ''.join(chr(self.rand.randint(0, 255)) for _ in range(5000))
+        tar = make_tar([('a', body)])
+        tar_iter = iter([tar[:3000], tar[3000:]])
+        untar = UntarStream(tar_iter)
+        untar.update_buffer(next(tar_iter))
+        info = untar.get_next_tarinfo()
+        untar.to_write = info.size
+        untar.offset_data = info.offset_data
+        extracted = ExtractedFile(untar)
+        parts = [extracted.read(2000)]
+        # leftover of a big read is served by smaller ones
+        for size in (10, 1, 0, 500, 4000):
+            data = extracted.read(size)
+            self.assertEqual(len(data), min(size, len(body) - len(''.join(parts))))
+            parts.append(data)
+        parts.append(extracted.read())
+        self.assertEqual(''.join(parts), body)
+
+    def test_get_buffered_chunks(self):
+        tar = make_tar([('a', 'x' * 3000)])
+        chunks = [tar[i:i + 1000] for i in range(0, len(tar), 1000)]
+        tar_iter = iter(chunks)
+        untar = UntarStream(tar_iter)
+        untar.update_buffer(next(tar_iter))
+        info = untar.get_next_tarinfo()
+        rest = ''.join(untar.get_buffered_chunks(info.offset_data)) + \
+            ''.join(tar_iter)
+        self.assertEqual(rest[:3000], 'x' * 3000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,3 @@
-from copy import deepcopy
-import re
 from hashlib import md5
 from swift.common.constraints import MAX_META_NAME_LENGTH, MAX_META_VALUE_LENGTH, \
     MAX_META_COUNT, MAX_META_OVERALL_SIZE
@@ -111,21 +109,6 @@ def merge_headers(current, new):
                 current[key.lower()] += ',' + str(value)
 
 
-def has_control_chars(line):
-    if line:
-        RE_ILLEGAL = u'([\u0000-\u0008\u000b-\u000c\u000e-\u001f\ufffe-\uffff])' + \
-                     u'|' + \
-                     u'([%s-%s][^%s-%s])|([^%s-%s][%s-%s])|([%s-%s]$)|(^[%s-%s])' % \
-                     (unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff),
-                      unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff),
-                      unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff),)
-        if re.search(RE_ILLEGAL, line):
-            return True
-        if re.search(r"[\x01-\x1F\x7F]", line):
-            return True
-    return False
-
-
 def update_metadata(request, meta_data):
     if not meta_data:
         return None
@@ -279,7 +262,48 @@ def is_cache_path(location):
     return False
 
 
+def request_cgi_env(request):
+    """
+    Returns CGI environment of the request, as executables see it
+    """
+    env = {}
+    env['HTTP_HOST'] = request.host
+    env['REMOTE_ADDR'] = request.remote_addr
+    env['REMOTE_USER'] = request.remote_user
+    env['HTTP_USER_AGENT'] = request.user_agent
+    env['QUERY_STRING'] = request.query_string
+    env['SERVER_NAME'] = request.environ.get('SERVER_NAME', 'localhost')
+    env['SERVER_PORT'] = request.environ.get('SERVER_PORT', '80')
+    env['SERVER_PROTOCOL'] = request.environ.get('SERVER_PROTOCOL', 'HTTP/1.0')
+    env['SERVER_SOFTWARE'] = 'zerocloud'
+    env['GATEWAY_INTERFACE'] = 'CGI/1.1'
+    env['PATH_INFO'] = request.path_info
+    env['REQUEST_METHOD'] = 'GET'
+    env['HTTP_REFERER'] = request.referer
+    env['HTTP_ACCEPT'] = request.headers.get('accept')
+    env['HTTP_ACCEPT_ENCODING'] = request.headers.get('accept-encoding')
+    env['HTTP_ACCEPT_LANGUAGE'] = request.headers.get('accept-language')
+    return env
+
+
 class ZvmNode(object):
+    """
+    Job config of one cluster node
+
+    Copies of a node share exe, args, env and wildcards with the original,
+    these are always replaced, never changed in place.
+    Channels are indexed by device and by path, add them with add_channel()
+    or add_new_channel(), or assign a new list to `channels`.
+    """
+    # attributes that go to the node system map, if they are set
+    json_fields = ('id', 'name', 'exe', 'args', 'env', 'replicate', 'channels',
+                   'connect', 'bind', 'replicas', 'skip_validation', 'wildcards',
+                   'path_info', 'name_service')
+    # channels are copied one by one
+    copy_fields = tuple([field for field in json_fields if field != 'channels'])
+    __slots__ = copy_fields + ('_channels', 'channel_devices', 'channel_paths',
+                               'last_data', 'size', 'boot_size', 'boot_etag')
+
     def __init__(self, id=None, name=None, exe=None, args=None, env=None, replicate=1):
         self.id = id
         self.name = name
@@ -295,62 +319,76 @@ class ZvmNode(object):
         self.wildcards = None
 
     def copy(self, id, name=None):
-        newnode = deepcopy(self)
+        newnode = ZvmNode.__new__(ZvmNode)
+        for field in self.copy_fields:
+            try:
+                setattr(newnode, field, getattr(self, field))
+            except AttributeError:
+                pass
         newnode.id = id
         if name:
             newnode.name = name
+        newnode.channels = [channel.copy() for channel in self.channels]
+        newnode.connect = list(self.connect)
+        newnode.bind = list(self.bind)
+        newnode.replicas = list(self.replicas)
         return newnode
 
+    @property
+    def channels(self):
+        return self._channels
+
+    @channels.setter
+    def channels(self, channels):
+        self._channels = []
+        self.channel_devices = {}
+        self.channel_paths = {}
+        for channel in channels:
+            self._append_channel(channel)
+
+    def _append_channel(self, channel):
+        self._channels.append(channel)
+        # first channel wins, as in the list
+        self.channel_devices.setdefault(channel.device, channel)
+        if isinstance(channel.path, ObjPath):
+            self.channel_paths.setdefault(channel.path.url, channel)
+
     def add_channel(self, path=None,
                     content_type=None, channel=None):
-        channel = deepcopy(channel)
+        channel = channel.copy()
         if path:
             channel.path = path
         if content_type:
             channel.content_type = content_type
-        self.channels.append(channel)
+        self._append_channel(channel)
 
     def add_new_channel(self, device=None, access=None, path=None, content_type='application/octet-stream',
                         meta_data=None, mode=None, removable='no', mountpoint='/'):
         channel = ZvmChannel(device, access, path,
                              content_type=content_type, meta_data=meta_data, mode=mode,
                              removable=removable, mountpoint=mountpoint)
-        self.channels.append(channel)
+        self._append_channel(channel)
 
     def get_channel(self, device=None, path=None):
         if device:
-            for chan in self.channels:
-                if chan.device == device:
-                    return chan
+            chan = self.channel_devices.get(device)
+            if chan:
+                return chan
         if path:
-            for chan in self.channels:
-                if chan.path == path:
-                    return chan
+            return self.channel_paths.get(path.url)
         return None
 
     def copy_cgi_env(self, request):
-        if not self.env:
-            self.env = {}
-        self.env['HTTP_HOST'] = request.host
-        self.env['REMOTE_ADDR'] = request.remote_addr
-        self.env['REMOTE_USER'] = request.remote_user
-        self.env['HTTP_USER_AGENT'] = request.user_agent
-        self.env['QUERY_STRING'] = request.query_string
-        self.env['SERVER_NAME'] = request.environ.get('SERVER_NAME', 'localhost')
-        self.env['SERVER_PORT'] = request.environ.get('SERVER_PORT', '80')
-        self.env['SERVER_PROTOCOL'] = request.environ.get('SERVER_PROTOCOL', 'HTTP/1.0')
-        self.env['SERVER_SOFTWARE'] = 'zerocloud'
-        self.env['GATEWAY_INTERFACE'] = 'CGI/1.1'
-        self.env['SCRIPT_NAME'] = self.exe
-        self.env['PATH_INFO'] = request.path_info
-        self.env['REQUEST_METHOD'] = 'GET'
-        self.env['HTTP_REFERER'] = request.referer
-        self.env['HTTP_ACCEPT'] = request.headers.get('accept')
-        self.env['HTTP_ACCEPT_ENCODING'] = request.headers.get('accept-encoding')
-        self.env['HTTP_ACCEPT_LANGUAGE'] = request.headers.get('accept-language')
-
-    def create_sysmap_resp(self):
-        sysmap = json.dumps(self, cls=NodeEncoder)
+        env = dict(self.env or {})
+        env.update(request_cgi_env(request))
+        env['SCRIPT_NAME'] = self.exe
+        self.env = env
+
+    def create_sysmap_resp(self, sysmap_encoder=None):
+        if sysmap_encoder:
+            sysmap = sysmap_encoder.encode(self)
+        else:
+            sysmap = json.dumps(self, cls=NodeEncoder)
         #print json.dumps(self, cls=NodeEncoder, indent=2)
         sysmap_iter = iter([sysmap])
         return Response(app_iter=sysmap_iter,
@@ -372,6 +410,11 @@ class ZvmNode(object):
 
 
 class ZvmChannel(object):
+    # remote is set only for swift objects that object server fetches by itself
+    json_fields = ('device', 'access', 'path', 'content_type', 'meta',
+                   'mode', 'removable', 'mountpoint', 'remote')
+    __slots__ = json_fields
+
     def __init__(self, device, access, path=None,
                  content_type=None, meta_data=None,
                  mode=None, removable='no', mountpoint='/'):
@@ -384,14 +427,117 @@ class ZvmChannel(object):
         self.removable = removable
         self.mountpoint = mountpoint
 
+    def copy(self):
+        """
+        Returns a copy of the channel, meta data is shared
+        """
+        channel = ZvmChannel.__new__(ZvmChannel)
+        channel.device = self.device
+        channel.access = self.access
+        channel.path = self.path
+        channel.content_type = self.content_type
+        channel.meta = self.meta
+        channel.mode = self.mode
+        channel.removable = self.removable
+        channel.mountpoint = self.mountpoint
+        if hasattr(self, 'remote'):
+            channel.remote = self.remote
+        return channel
+
 
 class NodeEncoder(json.JSONEncoder):
 
     def default(self, o):
         if isinstance(o, ZvmNode) or isinstance(o, ZvmChannel):
-            return o.__dict__
+            return dict([(field, getattr(o, field)) for field in o.json_fields if hasattr(o, field)])
         elif isinstance(o, Response):
             return str(o.__dict__)
         if isinstance(o, ObjPath):
             return o.url
         return json.JSONEncoder.default(self, o)
+
+
+_encode_json = NodeEncoder().encode
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def _encode_value(value):
+    if isinstance(value, basestring):
+        return _encode_string(value)
+    if value is None:
+        return 'null'
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+    if isinstance(value, list):
+        try:
+            return '[%s]' % ', '.join(map(_encode_string, value))
+        except TypeError:
+            pass
+    return _encode_json(value)
+
+
+class SysmapEncoder(object):
+    """
+    Encodes system maps of nodes, same JSON as NodeEncoder produces
+
+    Use one encoder for all nodes of a job: JSON of the fields that copies
+    of a node share (exe, args, replicate, skip_validation, name_service, env)
+    and of channel attributes other than path and remote is encoded once,
+    only the rest is encoded for each node.
+    """
+
+    def __init__(self):
+        self.fragments = {}
+        self.last_env = None
+
+    def encode(self, node):
+        parts = ['"id": %s' % _encode_value(node.id),
+                 '"name": %s' % _encode_value(node.name),
+                 self._shared_fields(node),
+                 '"env": %s' % self._encode_env(node.env),
+                 '"channels": [%s]' % ', '.join([self.encode_channel(ch) for ch in node.channels]),
+                 '"connect": %s' % _encode_value(node.connect),
+                 '"bind": %s' % _encode_value(node.bind),
+                 '"replicas": [%s]' % ', '.join([self.encode(replica) for replica in node.replicas]),
+                 '"wildcards": %s' % _encode_value(node.wildcards)]
+        path_info = getattr(node, 'path_info', None)
+        if path_info is not None:
+            parts.append('"path_info": %s' % _encode_value(path_info))
+        return '{%s}' % ', '.join(parts)
+
+    def encode_channel(self, channel):
+        key = (channel.device, channel.access, channel.content_type, id(channel.meta),
+               channel.mode, channel.removable, channel.mountpoint)
+        fragment = self.fragments.get(key)
+        # fragment keeps the meta dict, so its id cannot be reused by another dict
+        if not fragment or fragment[0] is not channel.meta:
+            static = dict([(field, getattr(channel, field))
+                           for field in channel.json_fields if field not in ('path', 'remote')])
+            fragment = (channel.meta, _encode_json(static)[:-1])
+            self.fragments[key] = fragment
+        path = channel.path
+        if isinstance(path, ObjPath):
+            path = path.url
+        if hasattr(channel, 'remote'):
+            return '%s, "path": %s, "remote": %s}' % (fragment[1], _encode_value(path),
+                                                     _encode_json(channel.remote))
+        return '%s, "path": %s}' % (fragment[1], _encode_value(path))
+
+    def _encode_env(self, env):
+        # copies of the node get equal, but not the same, CGI environments
+        if not self.last_env or self.last_env[0] != env:
+            self.last_env = (env, _encode_json(env))
+        return self.last_env[1]
+
+    def _shared_fields(self, node):
+        name_service = getattr(node, 'name_service', None)
+        key = (id(node.exe), id(node.args), node.replicate, node.skip_validation, name_service)
+        fragment = self.fragments.get(key)
+        if not fragment or fragment[0] is not node.exe or fragment[1] is not node.args:
+            shared = {'exe': node.exe, 'args': node.args,
+                      'replicate': node.replicate, 'skip_validation': node.skip_validation}
+            if name_service is not None:
+                shared['name_service'] = name_service
+            fragment = (node.exe, node.args, _encode_json(shared)[1:-1])
+            self.fragments[key] = fragment
+        return fragment[2]
@@ -1,9 +1,20 @@
+from array import array
+from collections import OrderedDict
+from hashlib import md5
+from itertools import izip
 import re
 import traceback
+from eventlet import GreenPool
 from swift import gettext_ as _
 from zerocloud.common import SwiftPath, ZvmNode, ZvmChannel, is_zvm_path, \
     ACCESS_READABLE, ACCESS_CDR, ACCESS_WRITABLE, parse_location, ACCESS_RANDOM, \
-    has_control_chars, DEVICE_MAP, is_swift_path, ACCESS_NETWORK
+    DEVICE_MAP, is_swift_path, ACCESS_NETWORK
+from zerocloud.validation import has_control_chars, cluster_map_has_control_chars
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 CHANNEL_TYPE_MAP = {
     'stdin': 0,
@@ -33,10 +44,60 @@ class ClusterConfigParsingError(Exception):
         return str(self.msg)
 
 
+class GlobMask(object):
+    """
+    Compiled wildcard name, where `*` matches any string, including `/`
+
+    Longest literal prefix of the wildcard is checked as a plain string and
+    sent to the listing server as `prefix`, so listing cost grows with the number
+    of names under the prefix, not with the container size.
+    Only the rest of the name is matched by regex.
+    Listing `delimiter` is never used: `*` can span pseudo-directories,
+    names inside them would be lost.
+    """
+
+    def __init__(self, glob):
+        self.glob = glob
+        self.prefix = glob.split('*', 1)[0]
+        self.suffix = re.compile(re.escape(glob[len(self.prefix):]).replace('\\*', '.*'))
+
+    def match(self, name):
+        return name.startswith(self.prefix) and \
+            self.suffix.match(name, len(self.prefix)) is not None
+
+
+class ClusterPlanCache(object):
+    """
+    LRU cache of parsed cluster maps
+
+    Plans are keyed by the hash of canonical JSON of the cluster map
+    and of the parse arguments. Each plan keeps the parsed nodes
+    and the results of all wildcard listings done while parsing,
+    plan is used only if listings still return the same objects.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.plans = OrderedDict()
+
+    def get(self, key):
+        plan = self.plans.pop(key, None)
+        if plan:
+            self.plans[key] = plan
+        return plan
+
+    def put(self, key, plan):
+        self.plans.pop(key, None)
+        self.plans[key] = plan
+        while len(self.plans) > self.max_size:
+            self.plans.popitem(last=False)
+
+
 class ClusterConfigParser(object):
     def __init__(self, sysimage_devices, default_content_type,
                  parser_config,
-                 list_account_callback, list_container_callback):
+                 list_account_callback, list_container_callback,
+                 plan_cache=None):
         """
         Create a new parser instance
 
@@ -44,11 +105,13 @@ class ClusterConfigParser(object):
         :param default_content_type: default content type to use for writable objects
         :param parser_config: configuration dictionary
         :param list_account_callback: callback function that can be called with
-                (account_name, mask) to get a list of container names in account
+                (account_name, mask, prefix) to get an iterable of container names in account
                 that match the mask regex
         :param list_container_callback: callback function that can be called with
-                (account_name, container_name, mask) to get a list of object names in container
-                that match the mask regex
+                (account_name, container_name, mask, prefix) to get an iterable of object names
+                in container that match the mask regex
+        :param plan_cache: ClusterPlanCache instance to reuse parsed cluster maps,
+                or None to parse every cluster map from scratch
         """
         self.sysimage_devices = sysimage_devices
         self.list_account = list_account_callback
@@ -57,61 +120,75 @@ class ClusterConfigParser(object):
         self.node_list = []
         self.default_content_type = default_content_type
         self.node_id = 1
+        self.groups = {}
         self.total_count = 0
         self.parser_config = parser_config
+        self.plan_cache = plan_cache
 
     def find_objects(self, path, **kwargs):
         """
         Find all objects in SwiftPath with wildcards
 
+        Objects are generated as soon as their listing page arrives,
+        listings are filtered on the server by the literal prefix of the wildcard,
+        see GlobMask.
+
         :param path: SwiftPath object that has wildcards in url string
         :param **kwargs: optional arguments for list_container, list_account callbacks
 
-        :returns list of object names, raises ClusterConfigParsingError on empty list
+        :returns generator of SwiftPath objects, raises ClusterConfigParsingError on empty list
         :raises ClusterConfigParsingError: on all errors
         """
-        temp_list = []
+        found = False
         if '*' in path.container:
-            mask = re.compile(re.escape(path.container).replace('\\*', '.*'))
+            mask = GlobMask(path.container)
             try:
-                containers = self.list_account(path.account, mask=mask, **kwargs)
+                containers = list(self.list_account(path.account, mask=mask,
+                                                    prefix=mask.prefix, **kwargs))
             except Exception:
                 raise ClusterConfigParsingError(_('Error querying object server '
                                                   'for account: %s') % path.account)
+            prefix = None
             if path.obj:
-                obj = path.obj
-                if '*' in obj:
-                    obj = re.escape(obj).replace('\\*', '.*')
-                mask = re.compile(obj)
+                mask = GlobMask(path.obj)
+                prefix = mask.prefix
             else:
                 mask = None
-            for container in containers:
+
+            def list_objects(container):
                 try:
-                    obj_list = self.list_container(path.account,
-                                                   container,
-                                                   mask=mask, **kwargs)
+                    return list(self.list_container(path.account, container,
+                                                    mask=mask, prefix=prefix, **kwargs))
                 except Exception:
+                    return None
+
+            # containers are listed concurrently, but results come in the order of containers,
+            # node names and ids depend on it
+            pool = GreenPool(self.parser_config.get('listing_concurrency', 8))
+            for container, obj_list in izip(containers, pool.imap(list_objects, containers)):
+                if obj_list is None:
                     raise ClusterConfigParsingError(_('Error querying object server '
                                                       'for container: %s') % container)
                 for obj in obj_list:
-                    temp_list.append(SwiftPath.init(path.account, container, obj))
+                    found = True
+                    yield SwiftPath.init(path.account, container, obj)
         else:
-            obj = re.escape(path.obj).replace('\\*', '.*')
-            mask = re.compile(obj)
+            mask = GlobMask(path.obj)
             try:
                 for obj in self.list_container(path.account,
                                                path.container,
-                                               mask=mask, **kwargs):
-                    temp_list.append(SwiftPath.init(path.account,
-                                                    path.container,
-                                                    obj))
+                                               mask=mask, prefix=mask.prefix,
+                                               **kwargs):
+                    found = True
+                    yield SwiftPath.init(path.account,
+                                         path.container,
+                                         obj)
             except Exception:
                 raise ClusterConfigParsingError(_('Error querying object server '
                                                   'for container: %s') % path.container)
-        if not temp_list:
+        if not found:
             raise ClusterConfigParsingError(_('No objects found in path %s')
                                             % path.url)
-        return temp_list
 
     def _get_new_node(self, zvm_node, index=0):
         if index == 0:
@@ -123,11 +200,22 @@ class ClusterConfigParser(object):
             new_node = zvm_node.copy(self.node_id, new_name)
             self.nodes[new_name] = new_node
             self.node_id += 1
+            if index > 0:
+                # nodes are created in order of their index: name-1, name-2, ...
+                self.groups.setdefault(zvm_node.name, []).append(new_node)
         return new_node
 
+    def _get_node_group(self, node_name):
+        node = self.nodes.get(node_name)
+        if node:
+            return [node]
+        return self.groups.get(node_name)
+
     def _add_all_connections(self, node_name, connections, source_devices):
-        if self.nodes.get(node_name):
-            connect_node = self.nodes.get(node_name)
+        connect_nodes = self._get_node_group(node_name)
+        if not connect_nodes:
+            raise ClusterConfigParsingError(_('Non existing node in connect string for node %s') % node_name)
+        for connect_node in connect_nodes:
             for bind_name in connections:
                 src_dev = None
                 dst_dev = None
@@ -136,23 +224,6 @@ class ClusterConfigParser(object):
                     if devices:
                         (src_dev, dst_dev) = devices
                 self._add_connection(connect_node, bind_name, src_dev, dst_dev)
-        elif self.nodes.get(node_name + '-1'):
-            j = 1
-            connect_node = self.nodes.get(_create_node_name(node_name, j))
-            while connect_node:
-                for bind_name in connections:
-                    src_dev = None
-                    dst_dev = None
-                    if source_devices:
-                        devices = source_devices.get(bind_name, None)
-                        if devices:
-                            (src_dev, dst_dev) = devices
-                    self._add_connection(connect_node, bind_name, src_dev, dst_dev)
-                j += 1
-                connect_node = self.nodes.get(
-                    _create_node_name(node_name, j))
-        else:
-            raise ClusterConfigParsingError(_('Non existing node in connect string for node %s') % node_name)
 
     def parse(self, cluster_config, add_user_image, account_name=None, replica_count=1, **kwargs):
         """
@@ -167,10 +238,23 @@ class ClusterConfigParser(object):
         self.nodes = {}
         self.node_id = 1
         self.node_list = []
+        self.groups = {}
+        plan_key = None
+        if self.plan_cache is not None:
+            plan_key = md5(json.dumps([cluster_config, add_user_image, account_name, replica_count],
+                                      sort_keys=True)).hexdigest()
+            plan = self.plan_cache.get(plan_key)
+            if plan and self._listings_unchanged(plan[1], **kwargs):
+                self.node_list = [node.copy(node.id) for node in plan[0]]
+                self._set_node_list(self.node_list)
+                return
+        listings = []
         try:
             connect_devices = {}
+            # strings of each node and channel are checked only if some of them may be invalid
+            validate = cluster_map_has_control_chars(cluster_config)
             for node in cluster_config:
-                zvm_node = _create_node(node)
+                zvm_node = _create_node(node, validate)
                 node_count = node.get('count', 1)
                 if isinstance(node_count, int) and node_count > 0:
                     pass
@@ -185,7 +269,8 @@ class ClusterConfigParser(object):
                     for f in file_list:
                         channel = _create_channel(
                             f, zvm_node,
-                            default_content_type=self.default_content_type)
+                            default_content_type=self.default_content_type,
+                            validate=validate)
                         if is_zvm_path(channel.path):
                             _add_connected_device(connect_devices, channel, zvm_node)
                             continue
@@ -208,13 +293,15 @@ class ClusterConfigParser(object):
                     for chan in read_list:
                         if '*' in chan.path.path:
                             read_group = True
-                            object_list = self.find_objects(chan.path, **kwargs)
                             read_mask = re.escape(chan.path.path).replace('\\*', '(.*)')
                             read_mask = re.compile(read_mask)
-                            node_count = len(object_list)
-                            for i in range(node_count):
-                                new_path = object_list[i]
-                                new_node = self._add_new_channel(zvm_node, chan, index=(i + 1), path=new_path)
+                            node_count = 0
+                            found = []
+                            listings.append((chan.path, found))
+                            for new_path in self.find_objects(chan.path, **kwargs):
+                                found.append(new_path.url)
+                                node_count += 1
+                                new_node = self._add_new_channel(zvm_node, chan, index=node_count, path=new_path)
                                 new_node.store_wildcards(new_path, read_mask)
                         else:
                             if node_count > 1:
@@ -291,6 +378,24 @@ class ClusterConfigParser(object):
         self.total_count = 0
         for n in self.node_list:
             self.total_count += n.replicate
+        if plan_key:
+            self.plan_cache.put(plan_key, ([node.copy(node.id) for node in self.node_list], listings))
+
+    def _listings_unchanged(self, listings, **kwargs):
+        try:
+            for path, urls in listings:
+                if [new_path.url for new_path in self.find_objects(path, **kwargs)] != urls:
+                    return False
+        except ClusterConfigParsingError:
+            return False
+        return True
+
+    def _set_node_list(self, node_list):
+        self.nodes = dict([(node.name, node) for node in node_list])
+        self.node_id = len(node_list) + 1
+        self.total_count = 0
+        for n in node_list:
+            self.total_count += n.replicate
 
     def _add_new_channel(self, node, channel, index=0, path=None, content_type=None):
         new_node = self._get_new_node(node, index=index)
@@ -303,76 +408,47 @@ class ClusterConfigParser(object):
             dst_device = '/dev/in/' + node.name
         else:
             dst_device = _resolve_wildcards(node, dst_device)
-        if self.nodes.get(bind_name):
-            bind_node = self.nodes.get(bind_name)
+        bind_nodes = self._get_node_group(bind_name)
+        if not bind_nodes:
+            raise ClusterConfigParsingError('Non-existing node in connect %s' % bind_name)
+        if bind_nodes[0] is node and bind_name in self.nodes:
+            raise ClusterConfigParsingError('Cannot bind to itself: %s' % bind_name)
+        for bind_node in bind_nodes:
             if bind_node is node:
-                raise ClusterConfigParsingError('Cannot bind to itself: %s' % bind_name)
+                continue
             bind_node.bind.append((node.name, dst_device))
             if not src_device:
-                node.connect.append((bind_name, '/dev/out/' + bind_name))
+                node.connect.append((bind_node.name, '/dev/out/' + bind_node.name))
             else:
                 src_device = _resolve_wildcards(bind_node, src_device)
-                node.connect.append((bind_name, src_device))
-        elif self.nodes.get(bind_name + '-1'):
-            i = 1
-            bind_node = self.nodes.get(bind_name + '-1')
-            while bind_node:
-                if not bind_node is node:
-                    bind_node.bind.append((node.name, dst_device))
-                    if not src_device:
-                        node.connect.append((bind_name + '-' + str(i),
-                                             '/dev/out/' + bind_name + '-' + str(i)))
-                    else:
-                        src_device = _resolve_wildcards(bind_node, src_device)
-                        node.connect.append((bind_name + '-' + str(i), src_device))
-                i += 1
-                bind_node = self.nodes.get(bind_name + '-' + str(i))
-        else:
-            raise ClusterConfigParsingError('Non-existing node in connect %s' % bind_name)
+                node.connect.append((bind_node.name, src_device))
 
-    def build_connect_string(self, node):
+    def build_connect_strings(self):
         """
-        Builds connect strings from connection information stored in job config
+        Builds connect and bind strings of all nodes from connection information stored in job config
 
-        :param node: ZvmNode object we build strings for
+        Ids and replica counts of the nodes are kept in arrays, indexed by
+        node position in the node list, all the strings are built from them in one pass.
+        If `connect_ranges` is set in parser config, connections to contiguous
+        groups of nodes are encoded as ranges, see _expand_connections()
         """
         if not self.nodes:
             return
-        node_count = len(self.node_list)
-        tmp = []
-        for (dst, dst_dev) in node.bind:
-            dst_id = self.nodes.get(dst).id
-            dst_repl = self.nodes.get(dst).replicate
-            proto = ';'.join(map(
-                lambda i: 'tcp:%d:0' % (dst_id + i * node_count),
-                range(dst_repl)
-            ))
-            tmp.append(
-                ','.join([proto,
-                          dst_dev,
-                          '0,0',  # type = 0, sequential, etag = 0, not needed
-                          str(self.parser_config['limits']['reads']),
-                          str(self.parser_config['limits']['rbytes']),
-                          '0,0'])
-            )
-        node.bind = tmp
-        tmp = []
-        for (dst, dst_dev) in node.connect:
-            dst_id = self.nodes.get(dst).id
-            dst_repl = self.nodes.get(dst).replicate
-            proto = ';'.join(map(
-                lambda i: 'tcp:%d:' % (dst_id + i * node_count),
-                range(dst_repl)
-            ))
-            tmp.append(
-                ','.join([proto,
-                          dst_dev,
-                          '0,0',  # type = 0, sequential, etag = 0, not needed
-                          '0,0',
-                          str(self.parser_config['limits']['writes']),
-                          str(self.parser_config['limits']['wbytes'])])
-            )
-        node.connect = tmp
+        position = dict([(node.name, i) for i, node in enumerate(self.node_list)])
+        ids = array('l', [node.id for node in self.node_list])
+        replicas = array('l', [node.replicate for node in self.node_list])
+        limits = self.parser_config['limits']
+        table = (position, ids, replicas, len(self.node_list),
+                 self.parser_config.get('connect_ranges', False))
+        # type = 0, sequential, etag = 0, not needed
+        bind_suffix = ',0,0,%s,%s,0,0' % (limits['reads'], limits['rbytes'])
+        connect_suffix = ',0,0,0,0,%s,%s' % (limits['writes'], limits['wbytes'])
+        # many nodes connect to the same node, each edge is built once
+        bind_edges = {}
+        connect_edges = {}
+        for node in self.node_list:
+            node.bind = _connection_strings(node.bind, 'tcp:%d:0', bind_suffix, table, bind_edges)
+            node.connect = _connection_strings(node.connect, 'tcp:%d:', connect_suffix, table, connect_edges)
 
     def is_sysimage_device(self, device_name):
         """
@@ -468,7 +544,7 @@ class ClusterConfigParser(object):
                 mode_mapping[device] = mode
             channels.append(device)
         network_devices = []
-        for conn in config['connect'] + config['bind']:
+        for conn in _expand_connections(config['connect'] + config['bind']):
             zerovm_inputmnfst += 'Channel=%s\n' % conn
             dev = conn.split(',', 2)[1][5:]  # len('/dev/') = 5
             if dev in STD_DEVICES:
@@ -569,6 +645,65 @@ def _add_connected_device(devices, channel, zvm_node):
         '/dev/' + channel.device, channel.path.device)
 
 
+def _connection_strings(connections, proto, suffix, table, edges):
+    position, ids, replicas, node_count, use_ranges = table
+    proto_prefix, proto_suffix = proto.split('%d')
+    result = []
+    run = None
+    for dst, dst_dev in connections:
+        edge = edges.get((dst, dst_dev))
+        if not edge:
+            edge = _edge(dst, dst_dev, proto, proto_suffix, suffix, table)
+            edges[(dst, dst_dev)] = edge
+        if isinstance(edge, tuple):
+            dst_id, middle, n = edge
+            if run and run[2] == middle and run[1] + run[5] == dst_id and run[3] + run[5] == n:
+                run[5] += 1
+            else:
+                run = [proto_prefix, dst_id, middle, n, suffix, 1]
+                result.append(run)
+        else:
+            run = None
+            result.append(edge)
+    if use_ranges:
+        # ranges of one connection are not worth it
+        result = [conn if not isinstance(conn, list) or conn[5] > 1 else _expand_connections([conn]).next()
+                  for conn in result]
+    return result
+
+
+def _edge(dst, dst_dev, proto, proto_suffix, suffix, table):
+    """
+    Returns connection string to the node, or (id, middle, n) tuple if it can be a part of range
+    """
+    position, ids, replicas, node_count, use_ranges = table
+    i = position[dst]
+    if use_ranges and replicas[i] == 1 and dst_dev.endswith(dst):
+        # device of the node name-<n> ends with -<n>, as in /dev/out/name-<n>
+        name, sep, n = dst.rpartition('-')
+        if sep and n.isdigit() and not n.startswith('0'):
+            return ids[i], proto_suffix + ',' + dst_dev[:-len(n)], int(n)
+    return ','.join([';'.join([proto % (ids[i] + r * node_count) for r in range(replicas[i])]),
+                     dst_dev]) + suffix
+
+
+def _expand_connections(connections):
+    """
+    Expands connection ranges into connect or bind strings
+
+    Range is a list of [prefix, first_id, middle, first_index, suffix, count],
+    it stands for `count` strings: prefix, id, middle, index and suffix joined,
+    where id and index start from first_id and first_index and grow by one.
+    """
+    for conn in connections:
+        if isinstance(conn, list):
+            prefix, first_id, middle, first_index, suffix, count = conn
+            for i in range(count):
+                yield '%s%d%s%d%s' % (prefix, first_id + i, middle, first_index + i, suffix)
+        else:
+            yield conn
+
+
 def _create_node_name(node_name, i):
     return '%s-%d' % (node_name, i)
 
@@ -593,11 +728,11 @@ def _extract_stored_wildcards(path, node):
     return new_url
 
 
-def _create_node(node_config):
+def _create_node(node_config, validate=True):
     name = node_config.get('name')
     if not name:
         raise ClusterConfigParsingError(_('Must specify node name'))
-    if has_control_chars(name):
+    if validate and has_control_chars(name):
         raise ClusterConfigParsingError(_('Invalid node name'))
     nexe = node_config.get('exec')
     if not nexe:
@@ -609,15 +744,15 @@ def _create_node(node_config):
         raise ClusterConfigParsingError(_('Executable path cannot be a zvm path in %s') % name)
     args = nexe.get('args')
     env = nexe.get('env')
-    if has_control_chars('%s %s %s' % (exe.url, args, env)):
+    if validate and has_control_chars('%s %s %s' % (exe.url, args, env)):
         raise ClusterConfigParsingError(_('Invalid nexe property for %s') % name)
     replicate = node_config.get('replicate', 1)
     return ZvmNode(0, name, exe, args, env, replicate)
 
 
-def _create_channel(channel, node, default_content_type=None):
+def _create_channel(channel, node, default_content_type=None, validate=True):
     device = channel.get('device')
-    if has_control_chars(device):
+    if validate and has_control_chars(device):
         raise ClusterConfigParsingError(_('Bad device name: %s in %s') % (device, node.name))
     path = parse_location(channel.get('path'))
     if not device:
@@ -5,12 +5,14 @@ import shutil
 import time
 import traceback
 import tarfile
+from collections import OrderedDict
 from contextlib import contextmanager
+from itertools import chain, islice, repeat
 from urllib import unquote
-from hashlib import md5
+from hashlib import md5, sha256
 from tempfile import mkstemp, mkdtemp
 
-from eventlet import GreenPool, sleep, spawn
+from eventlet import GreenPool, sleep, spawn, tpool
 from eventlet.green import select, subprocess, os, socket
 from eventlet.timeout import Timeout
 from eventlet.green.httplib import HTTPResponse
@@ -24,14 +26,17 @@ from swift.common.swob import Request, Response, HTTPNotFound, \
     HTTPClientDisconnect, HTTPInternalServerError, HeaderKeyDict, HTTPInsufficientStorage
 from swift.common.utils import normalize_timestamp, fallocate, \
     split_path, get_logger, mkdirs, disable_fallocate, TRUE_VALUES
+from swift.common.bufferedhttp import http_connect
+from swift.common.http import is_success
+from swift.common.ring import Ring
 from swift.obj.diskfile import DiskFileManager, DiskFile, DiskFileWriter, write_metadata
 from swift.common.constraints import check_mount, check_utf8, check_float
 from swift.common.exceptions import DiskFileError, DiskFileNotExist, DiskFileNoSpace, DiskFileDeviceUnavailable, \
-    DiskFileQuarantined
+    DiskFileQuarantined, ConnectionTimeout, ChunkReadTimeout
 from swift.proxy.controllers.base import update_headers
 from zerocloud.common import TAR_MIMES, ACCESS_READABLE, ACCESS_CDR, ACCESS_WRITABLE, \
     MD5HASH_LENGTH, parse_location, \
-    is_image_path, ACCESS_NETWORK, ACCESS_RANDOM, REPORT_VALIDATOR, REPORT_RETCODE, REPORT_ETAG, \
+    is_image_path, is_swift_path, ACCESS_NETWORK, ACCESS_RANDOM, REPORT_VALIDATOR, REPORT_RETCODE, REPORT_ETAG, \
     REPORT_CDR, REPORT_STATUS, SwiftPath, REPORT_LENGTH, REPORT_DAEMON, NodeEncoder
 from zerocloud.configparser import ClusterConfigParser
 
@@ -144,6 +149,206 @@ class TmpDir(object):
             shutil.rmtree(tmpdir, ignore_errors=True)
 
 
+class NexeCache(object):
+    """
+    Size bounded LRU cache of executables on one device
+
+    Entries are keyed by content ETag. The directory is shared by all workers,
+    so it is the only state: entry mtime is its last use, total size is
+    counted from the directory on every put. Cached files are handed out
+    as hard links, so eviction never removes an executable from a running session.
+    """
+
+    def __init__(self, path, max_size, os_interface=os):
+        self.os_interface = os_interface
+        self.path = path
+        self.max_size = max_size
+        # total size of the cache, as of the last eviction
+        self.size = 0
+        if not self.os_interface.path.exists(self.path):
+            mkdirs(self.path)
+
+    def _touch(self, cached):
+        # explicit time, kernel clock is too coarse to order close uses
+        now = time.time()
+        try:
+            self.os_interface.utime(cached, (now, now))
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = []
+        total_size = 0
+        for name in self.os_interface.listdir(self.path):
+            try:
+                st = self.os_interface.stat(self.os_interface.path.join(self.path, name))
+            except OSError:
+                # evicted by another worker
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+            total_size += st.st_size
+        for _junk, name, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                self.os_interface.unlink(self.os_interface.path.join(self.path, name))
+            except OSError:
+                pass
+            total_size -= size
+        self.size = total_size
+
+    def link(self, key, dst):
+        """Links cached executable to dst, returns False on cache miss"""
+        cached = self.os_interface.path.join(self.path, key)
+        try:
+            self.os_interface.link(cached, dst)
+        except OSError:
+            return False
+        self._touch(cached)
+        return True
+
+    def put(self, key, src):
+        cached = self.os_interface.path.join(self.path, key)
+        if self.os_interface.path.exists(cached):
+            self._touch(cached)
+            return
+        if self.os_interface.path.getsize(src) > self.max_size:
+            return
+        try:
+            self.os_interface.link(src, cached)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                shutil.copyfile(src, cached)
+        self._touch(cached)
+        self._evict()
+
+    def __contains__(self, key):
+        return self.os_interface.path.exists(self.os_interface.path.join(self.path, key))
+
+
+class ValidationIndex(object):
+    """
+    Node-local map of executable content digest to its validation verdict
+
+    Verdicts are keyed by SHA-256 of the executable file as it is on this
+    node, not by the ETag the proxy or the object metadata claims, so a
+    verdict cannot be reused for different content, whoever uploaded it.
+    Verdicts are kept in memory, in LRU order, and appended to a log file,
+    so they survive restarts and are shared between the workers of a node.
+    Log is re-read when it grows and compacted when it is twice as long
+    as the index.
+    Log file and its directory must be private to the object server user,
+    anyone who can write there can mark any executable as validated.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.verdicts = OrderedDict()
+        self.offset = 0
+        self.lines = 0
+        self.inode = None
+        if self.path:
+            _check_private(os.path.dirname(os.path.abspath(self.path)), dir_ok=True)
+            if os.path.exists(self.path):
+                _check_private(self.path)
+            self._load()
+
+    def _load(self):
+        try:
+            fp = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            st = os.fstat(fp.fileno())
+            if not _is_private(st):
+                # somebody replaced the log, none of it can be trusted
+                return
+            inode = st.st_ino
+            if inode != self.inode:
+                # log was replaced by compaction
+                self.inode = inode
+                self.offset = 0
+                self.lines = 0
+            fp.seek(self.offset)
+            for line in fp:
+                if not line.endswith('\n'):
+                    # incomplete append by another worker
+                    break
+                self.offset += len(line)
+                self.lines += 1
+                try:
+                    etag, verdict = line.split()
+                    self._store(etag, verdict == '1')
+                except ValueError:
+                    continue
+        finally:
+            fp.close()
+
+    def _store(self, etag, verdict):
+        self.verdicts.pop(etag, None)
+        self.verdicts[etag] = verdict
+        while len(self.verdicts) > self.max_entries:
+            self.verdicts.popitem(last=False)
+
+    def _compact(self):
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            _write_all(fd, ''.join('%s %d\n' % (etag, verdict)
+                                   for etag, verdict in self.verdicts.iteritems()))
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, self.path)
+        st = os.stat(self.path)
+        self.inode = st.st_ino
+        self.offset = st.st_size
+        self.lines = len(self.verdicts)
+
+    def get(self, etag):
+        """Returns True or False verdict, None if executable was not validated yet"""
+        if not etag:
+            return None
+        if etag not in self.verdicts and self.path:
+            try:
+                st = os.stat(self.path)
+                if st.st_ino != self.inode or st.st_size != self.offset:
+                    self._load()
+            except OSError:
+                pass
+        verdict = self.verdicts.pop(etag, None)
+        if verdict is not None:
+            self.verdicts[etag] = verdict
+        return verdict
+
+    def put(self, etag, verdict):
+        if not etag or self.verdicts.get(etag) == verdict:
+            return
+        self._store(etag, verdict)
+        if not self.path:
+            return
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                _write_all(fd, '%s %d\n' % (etag, verdict))
+            finally:
+                os.close(fd)
+            self.lines += 1
+            if self.lines > 2 * self.max_entries:
+                self._compact()
+        except (IOError, OSError):
+            pass
+
+
+class ZvmDaemon(object):
+    """One instance of a ZeroVM daemon, listening on its own UNIX socket"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.busy = 0
+        self.last_used = time.time()
+
+
 class DualReader(object):
 
     def __init__(self, head, tail):
@@ -225,13 +430,38 @@ class ObjectQueryMiddleware(object):
         self.zerovm_stderr_size = 65536
         self.zerovm_stdout_size = 65536
 
+        # file where validation verdicts of executables are stored, by SHA-256 of executable,
+        # must be in a directory private to object server user,
+        # empty value (default) keeps them in memory only
+        self.validation_index = ValidationIndex(conf.get('zerovm_validation_cache', ''),
+                                                int(conf.get('zerovm_validation_cache_size', 100000)))
+
         # hardcoded dir for zerovm caching daemon sockets
         self.zerovm_sockets_dir = '/tmp/zvm-daemons'
         if not os.path.exists(self.zerovm_sockets_dir):
             mkdirs(self.zerovm_sockets_dir)
+        # maximum number of instances of each daemon, new instance is started
+        # when all others are busy
+        self.zerovm_daemon_pool_size = int(conf.get('zerovm_daemon_pool_size', 1))
+        # additional daemon instances are stopped after being idle for this amount of seconds
+        self.zerovm_daemon_idle_timeout = int(conf.get('zerovm_daemon_idle_timeout', 300))
+        # daemon name -> list of ZvmDaemon instances
+        self.daemon_pools = {}
         # mapping between return code and its message
         self.retcode_map = ['OK', 'Error', 'Timed out', 'Killed', 'Output too long']
 
+        # directory with ring files, used to fetch remote inputs from peer object servers
+        self.swift_dir = conf.get('swift_dir', '/etc/swift')
+        self._object_ring = None
+        # maximum number of remote inputs fetched in parallel for one session
+        self.zerovm_remote_fetch_concurrency = int(conf.get('zerovm_remote_fetch_concurrency', 8))
+        # timeouts for connections to peer object servers
+        self.conn_timeout = float(conf.get('conn_timeout', 0.5))
+        self.node_timeout = int(conf.get('node_timeout', 3))
+        # size of executables cache on each device, in bytes, zero disables the cache
+        self.zerovm_nexe_cache_size = int(conf.get('zerovm_nexe_cache_size', 0))
+        self.nexe_caches = {}
+
         self.fault_injection = conf.get('fault_injection', ' ')  # for unit-tests
         self.os_interface = os  # for unit-tests
 
@@ -267,6 +497,86 @@ class ObjectQueryMiddleware(object):
         return self._diskfile_mgr.get_diskfile(
             device, partition, account, container, obj, **kwargs)
 
+    @property
+    def object_ring(self):
+        if not self._object_ring:
+            self._object_ring = Ring(self.swift_dir, ring_name='object')
+        return self._object_ring
+
+    def get_nexe_cache(self, device):
+        if self.zerovm_nexe_cache_size <= 0:
+            return None
+        cache = self.nexe_caches.get(device)
+        if not cache:
+            cache = NexeCache(os.path.join(self._diskfile_mgr.devices, device, 'zvm-nexe-cache'),
+                              self.zerovm_nexe_cache_size, os_interface=self.os_interface)
+            self.nexe_caches[device] = cache
+        return cache
+
+    def _fetch_remote_object(self, ch, zerovm_tmp):
+        """
+        Downloads remote object of the channel from the peer object servers
+
+        Proxy sets channel `remote` to the etag, and size if known, of a plain
+        object that it left to us, only that exact version is accepted.
+        Tries primary nodes first and then the same number of handoffs,
+        sets channel `lpath` on success
+
+        :returns None on success or error status int
+        """
+        path = parse_location(ch['path'])
+        remote = ch['remote']
+        partition, nodes = self.object_ring.get_nodes(path.account, path.container, path.obj)
+        lpath = os.path.join(zerovm_tmp, ch['device'])
+        status = 404
+        for node in chain(nodes, islice(self.object_ring.get_more_nodes(partition), len(nodes))):
+            try:
+                with ConnectionTimeout(self.conn_timeout):
+                    conn = http_connect(node['ip'], node['port'], node['device'],
+                                        partition, 'GET', path.path,
+                                        headers={'If-Match': remote['etag']})
+                with Timeout(self.node_timeout):
+                    resp = conn.getresponse()
+                if not is_success(resp.status):
+                    if resp.status != 404:
+                        status = 503
+                    resp.read()
+                    continue
+                size = int(resp.getheader('content-length'))
+                if remote.get('size', size) != size:
+                    status = 503
+                    resp.close()
+                    continue
+                if size > self.parser_config['limits']['rbytes']:
+                    resp.close()
+                    return 413
+                received = 0
+                etag = md5()
+                fp = open(lpath, 'wb')
+                try:
+                    while True:
+                        with ChunkReadTimeout(self.node_timeout):
+                            chunk = resp.read(self.app.network_chunk_size)
+                        if not chunk:
+                            break
+                        received += len(chunk)
+                        etag.update(chunk)
+                        fp.write(chunk)
+                finally:
+                    fp.close()
+                if received != size or etag.hexdigest() != remote['etag']:
+                    status = 503
+                    continue
+                ch['lpath'] = lpath
+                ch['size'] = size
+                return None
+            except (Exception, Timeout):
+                self.logger.exception(_('ERROR fetching %(path)s from %(ip)s:%(port)s/%(device)s'),
+                                      {'path': path.path, 'ip': node['ip'],
+                                       'port': node['port'], 'device': node['device']})
+                status = 503
+        return status
+
     def send_to_socket(self, sock, zerovm_inputmnfst):
         SIZE = 8
         size = '0x%06x' % len(zerovm_inputmnfst)
@@ -290,12 +600,13 @@ class ObjectQueryMiddleware(object):
         finally:
             sock.close()
 
-    def execute_zerovm(self, zerovm_inputmnfst_fn, zerovm_args=None):
+    def execute_zerovm(self, zerovm_inputmnfst_fn, zerovm_args=None, metrics=None):
         """
         Executes zerovm in a subprocess
 
         :param zerovm_inputmnfst_fn: file name of zerovm manifest, can be relative path
         :param zerovm_args: additional arguments passed to zerovm command line, should be a list of str
+        :param metrics: dict, if set it is filled with wall-clock time and user/system cpu time of the run
 
         """
         cmdline = []
@@ -303,68 +614,78 @@ class ObjectQueryMiddleware(object):
         if zerovm_args:
             cmdline += zerovm_args
         cmdline += [zerovm_inputmnfst_fn]
+        start = time.time()
         proc = subprocess.Popen(cmdline,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
+        output = {proc.stdout: [], proc.stderr: []}
+        # bytes left before the size limit of each stream
+        left = {proc.stdout: self.zerovm_stdout_size, proc.stderr: self.zerovm_stderr_size}
+        readable = [proc.stdout, proc.stderr]
 
-        def get_final_status(stdout_data, stderr_data, return_code=None):
-            (data1, data2) = proc.communicate()
-            stdout_data += data1
-            stderr_data += data2
+        def read_from_std():
+            # no timeout here, whole run is limited by a single timer
+            rlist, _junk, __junk = select.select(readable, [], [])
+            for stream in rlist:
+                # never read more than one byte past the limit
+                data = self.os_interface.read(stream.fileno(), min(65536, left[stream] + 1))
+                if not data:
+                    readable.remove(stream)
+                    continue
+                output[stream].append(data)
+                left[stream] -= len(data)
+                if left[stream] < 0:
+                    return False
+            return True
+
+        def get_final_status(return_code=None):
+            status = 0
+            rusage = None
+            try:
+                # blocking wait in a native thread, the hub keeps running
+                # and the caller's timer still applies
+                _junk, status, rusage = tpool.execute(os.wait4, proc.pid, 0)
+                proc.returncode = status
+            except OSError:
+                pass
+            if metrics is not None:
+                metrics['wall'] = time.time() - start
+                metrics['user'] = rusage.ru_utime if rusage else 0.0
+                metrics['sys'] = rusage.ru_stime if rusage else 0.0
+                if self.zerovm_perf:
+                    self.logger.info("PERF EXEC: %.3f %.3f %.3f"
+                                     % (metrics['wall'], metrics['user'], metrics['sys']))
             if return_code is None:
                 return_code = 0
-                if proc.returncode:
+                if status:
                     return_code = 1
-            return return_code, stdout_data, stderr_data
-
-        def read_from_std(readable, stdout_data, stderr_data):
-            rlist, _junk, __junk = \
-                select.select(readable, [], [], self.parser_config['manifest']['Timeout'])
-            if rlist:
-                for stream in rlist:
-                    data = self.os_interface.read(stream.fileno(), 4096)
-                    if not data:
-                        readable.remove(stream)
-                        continue
-                    if stream == proc.stdout:
-                        stdout_data += data
-                    elif stream == proc.stderr:
-                        stderr_data += data
-            return stdout_data, stderr_data
-
-        stdout_data = ''
-        stderr_data = ''
-        readable = [proc.stdout, proc.stderr]
+            return return_code, ''.join(output[proc.stdout]), ''.join(output[proc.stderr])
+
         try:
             with Timeout(self.parser_config['manifest']['Timeout'] + 1):
-                start = time.time()
-                perf = ''
-                while len(readable) > 0:
-                    stdout_data, stderr_data = read_from_std(readable, stdout_data, stderr_data)
-                    if len(stdout_data) > self.zerovm_stdout_size \
-                            or len(stderr_data) > self.zerovm_stderr_size:
+                while readable:
+                    if not read_from_std():
                         proc.kill()
-                        return 4, stdout_data, stderr_data
-                    perf = "%s %.3f" % (perf, time.time() - start)
-                    start = time.time()
-                perf = "%s %.3f" % (perf, time.time() - start)
-                if self.zerovm_perf:
-                    self.logger.info("PERF EXEC: %s" % perf)
-                return get_final_status(stdout_data, stderr_data)
+                        return get_final_status(4)
+                return get_final_status()
         except (Exception, Timeout):
             proc.terminate()
             try:
                 with Timeout(self.zerovm_kill_timeout):
-                    while len(readable) > 0:
-                        stdout_data, stderr_data = read_from_std(readable, stdout_data, stderr_data)
-                        if len(stdout_data) > self.zerovm_stdout_size\
-                                or len(stderr_data) > self.zerovm_stderr_size:
+                    while readable:
+                        if not read_from_std():
                             proc.kill()
-                            return 4, stdout_data, stderr_data
-                    return get_final_status(stdout_data, stderr_data, 2)
+                            return get_final_status(4)
+                    return get_final_status(2)
             except (Exception, Timeout):
                 proc.kill()
-                return get_final_status(stdout_data, stderr_data, 3)
+                try:
+                    with Timeout(self.zerovm_kill_timeout):
+                        while readable and read_from_std():
+                            pass
+                except (Exception, Timeout):
+                    pass
+                return get_final_status(3)
 
     def _extract_boot_file(self, channels, boot_file, image, zerovm_tmp):
         tar = tarfile.open(name=image)
@@ -440,7 +761,7 @@ class ObjectQueryMiddleware(object):
             std.close()
 
     def _create_zerovm_thread(self, zerovm_inputmnfst, zerovm_inputmnfst_fd,
-                              zerovm_inputmnfst_fn, zerovm_valid, thrdpool):
+                              zerovm_inputmnfst_fn, zerovm_valid, thrdpool, metrics=None):
         while zerovm_inputmnfst:
             written = self.os_interface.write(zerovm_inputmnfst_fd,
                                               zerovm_inputmnfst)
@@ -448,7 +769,7 @@ class ObjectQueryMiddleware(object):
         zerovm_args = None
         if zerovm_valid:
             zerovm_args = ['-s']
-        thrd = thrdpool.spawn(self.execute_zerovm, zerovm_inputmnfst_fn, zerovm_args)
+        thrd = thrdpool.spawn(self.execute_zerovm, zerovm_inputmnfst_fn, zerovm_args, metrics)
         return thrd
 
     def _create_exec_error(self, nexe_headers, zerovm_retcode, zerovm_stdout):
@@ -462,13 +783,50 @@ class ObjectQueryMiddleware(object):
         resp.headers = nexe_headers
         return resp
 
+    def _acquire_daemon(self, name):
+        """
+        Returns the least busy instance of daemon `name`,
+        adds a new instance if all of them are busy and the pool is not full.
+        New instance is started by the request that gets it.
+        """
+        pool = self.daemon_pools.setdefault(name, [])
+        if not pool:
+            pool.append(ZvmDaemon(os.path.join(self.zerovm_sockets_dir, name)))
+        daemon = min(pool, key=lambda d: d.busy)
+        if daemon.busy and len(pool) < self.zerovm_daemon_pool_size:
+            used = set([d.sock for d in pool])
+            idx = 1
+            while '%s.%d' % (pool[0].sock, idx) in used:
+                idx += 1
+            daemon = ZvmDaemon('%s.%d' % (pool[0].sock, idx))
+            pool.append(daemon)
+        daemon.busy += 1
+        return daemon
+
+    def _release_daemon(self, name, daemon):
+        daemon.busy -= 1
+        now = time.time()
+        daemon.last_used = now
+        pool = self.daemon_pools.get(name, [])
+        # first instance is kept warm forever, as before
+        for idle in pool[1:]:
+            if not idle.busy and now - idle.last_used > self.zerovm_daemon_idle_timeout:
+                pool.remove(idle)
+                self._cleanup_daemon(idle.sock)
+
     def zerovm_query(self, req):
         """Handle zerovm execution requests for the Swift Object Server."""
+        daemon_name = req.headers.get('x-zerovm-daemon', None)
+        if not daemon_name:
+            return self._zerovm_query(req, None)
+        daemon = self._acquire_daemon(daemon_name)
+        try:
+            return self._zerovm_query(req, daemon.sock)
+        finally:
+            self._release_daemon(daemon_name, daemon)
 
+    def _zerovm_query(self, req, daemon_sock):
         debug_dir = self._debug_init(req)
-        daemon_sock = req.headers.get('x-zerovm-daemon', None)
-        if daemon_sock:
-            daemon_sock = os.path.join(self.zerovm_sockets_dir, daemon_sock)
         #print "URL: " + req.url
         nexe_headers = {
             'x-nexe-retcode': 0,
@@ -594,14 +952,45 @@ class ObjectQueryMiddleware(object):
             #print json.dumps(config, cls=NodeEncoder, indent=2)
             zerovm_nexe = None
             exe_path = parse_location(config['exe'])
+            nexe_cache = self.get_nexe_cache(device)
+            nexe_key = None
+            boot_path = os.path.join(zerovm_tmp, 'boot')
             if is_image_path(exe_path):
                 if exe_path.image in channels:
                     self._extract_boot_file(channels, exe_path.path, channels[exe_path.image], zerovm_tmp)
                 elif not daemon_sock:
                     sysimage_path = self.parser.get_sysimage(exe_path.image)
                     if sysimage_path:
-                        if self._extract_boot_file(channels, exe_path.path, sysimage_path, zerovm_tmp):
+                        nexe_key = _sysimage_nexe_key(sysimage_path, exe_path.path)
+                        if nexe_cache and nexe_cache.link(nexe_key, boot_path):
+                            channels['boot'] = boot_path
+                            zerovm_valid = True
+                        elif self._extract_boot_file(channels, exe_path.path, sysimage_path, zerovm_tmp):
                             zerovm_valid = True
+            elif is_swift_path(exe_path) \
+                    and re.match('^[0-9a-f]{%d}$' % MD5HASH_LENGTH,
+                                 req.headers.get('x-zerovm-boot-etag', '')):
+                nexe_key = req.headers['x-zerovm-boot-etag']
+                if 'boot' not in channels and not daemon_sock:
+                    # proxy did not send the executable, expecting it to be in cache
+                    if nexe_cache and nexe_cache.link(nexe_key, boot_path):
+                        channels['boot'] = boot_path
+                    else:
+                        boot_ch = {'path': config['exe'], 'device': 'boot',
+                                   'remote': {'etag': nexe_key}}
+                        status = self._fetch_remote_object(boot_ch, zerovm_tmp)
+                        if status:
+                            return Response(status=status, request=req, headers=nexe_headers,
+                                            body='Cannot fetch executable %s' % config['exe'])
+                        channels['boot'] = boot_ch['lpath']
+            nexe_digest = None
+            if is_swift_path(exe_path) and 'boot' in channels and not zerovm_valid:
+                # verdicts are looked up by the content we got, not by the etag proxy sent
+                nexe_digest = _nexe_digest(channels['boot'])
+                if self.validation_index.get(nexe_digest):
+                    zerovm_valid = True
+            if nexe_cache and nexe_key and 'boot' in channels:
+                nexe_cache.put(nexe_key, channels['boot'])
             if 'boot' in channels:
                 zerovm_nexe = channels.pop('boot')
             elif not daemon_sock:
@@ -611,6 +1000,7 @@ class ObjectQueryMiddleware(object):
             if config.get('replicate', 1) > 1 and len(config.get('replicas', [])) < (config.get('replicate', 1) - 1):
                 is_master = False
             response_channels = []
+            remote_channels = []
             local_object = {}
             if not zerovm_execute_only:
                 local_object['path'] = SwiftPath.init(account, container, obj).url
@@ -655,10 +1045,15 @@ class ObjectQueryMiddleware(object):
                     ch['lpath'] = self.parser.get_sysimage(ch['device'])
                 elif ch['access'] & (ACCESS_READABLE | ACCESS_CDR):
                     if not ch.get('lpath'):
-                        if not chan_path or is_image_path(chan_path):
+                        # swift object that proxy did not send is fetched only
+                        # if proxy checked it is a plain object and left it to us
+                        if not chan_path or is_image_path(chan_path) \
+                                or (is_swift_path(chan_path) and not ch.get('remote')):
                             return HTTPBadRequest(request=req,
                                                   body='Could not resolve channel path: %s'
                                                        % ch['path'])
+                        if is_swift_path(chan_path):
+                            remote_channels.append(ch)
                 elif ch['access'] & ACCESS_WRITABLE:
                     writable_tmpdir = os.path.join(self._diskfile_mgr.devices, device, 'tmp')
                     if not os.path.exists(writable_tmpdir):
@@ -676,6 +1071,20 @@ class ObjectQueryMiddleware(object):
                 elif ch['access'] & ACCESS_NETWORK:
                     ch['lpath'] = chan_path.path
 
+            if remote_channels:
+                pool = GreenPool(self.zerovm_remote_fetch_concurrency)
+                for ch, status in zip(remote_channels,
+                                      pool.imap(self._fetch_remote_object,
+                                                remote_channels, repeat(zerovm_tmp))):
+                    if status:
+                        _channel_cleanup(response_channels)
+                        return Response(status=status, request=req, headers=nexe_headers,
+                                        body='Cannot fetch remote object %s' % ch['path'])
+                    channels[ch['device']] = ch['lpath']
+                perf = "%s fetch:%.3f" % (perf, time.time() - start)
+                if self.zerovm_perf:
+                    self.logger.info("PERF FETCH: %s" % perf)
+
             with tmpdir.mkstemp() as (zerovm_inputmnfst_fd,
                                       zerovm_inputmnfst_fn):
                 (output_fd, nvram_file) = mkstemp()
@@ -696,6 +1105,7 @@ class ObjectQueryMiddleware(object):
                 self._debug_before_exec(config, debug_dir, nexe_headers, nvram_file, zerovm_inputmnfst)
                 start = time.time()
                 daemon_status = None
+                exec_metrics = {}
                 if daemon_sock:
                     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
                     try:
@@ -747,7 +1157,7 @@ class ObjectQueryMiddleware(object):
                 else:
                     thrd = self._create_zerovm_thread(zerovm_inputmnfst,
                                                       zerovm_inputmnfst_fd, zerovm_inputmnfst_fn,
-                                                      zerovm_valid, thrdpool)
+                                                      zerovm_valid, thrdpool, exec_metrics)
                 (zerovm_retcode, zerovm_stdout, zerovm_stderr) = thrd.wait()
                 perf = "%.3f" % (time.time() - start)
                 if self.zerovm_perf:
@@ -786,9 +1196,18 @@ class ObjectQueryMiddleware(object):
 
                 response = Response(request=req)
                 update_headers(response, nexe_headers)
+                if nexe_digest and not zerovm_valid and not daemon_sock \
+                        and int(nexe_headers['x-nexe-validation']) == 0:
+                    self.validation_index.put(nexe_digest, True)
+                if nexe_cache and nexe_key in nexe_cache and is_swift_path(exe_path):
+                    response.headers['x-zerovm-nexe-cached'] = nexe_key
                 response.headers['X-Timestamp'] =\
                     normalize_timestamp(time.time())
                 response.headers['x-nexe-system'] = nexe_headers['x-nexe-system']
+                if exec_metrics:
+                    # wall-clock, user cpu and system cpu time of zerovm process
+                    response.headers['x-zerovm-exec-time'] = '%.3f %.3f %.3f' \
+                        % (exec_metrics['wall'], exec_metrics['user'], exec_metrics['sys'])
                 response.content_type = 'application/x-gtar'
                 if daemon_status == 1:
                     response.headers['x-zerovm-daemon'] = req.headers.get('x-zerovm-daemon', None)
@@ -935,7 +1354,7 @@ class ObjectQueryMiddleware(object):
 
                     def validate_resp(status, response_headers, exc_info=None):
                         if 200 <= int(status.split(' ')[0]) < 300:
-                            if self.is_validated(req):
+                            if self.is_validated(req) is True:
                                 response_headers.append(('X-Zerovm-Valid', 'true'))
                         return start_response(status, response_headers, exc_info)
 
@@ -982,6 +1401,13 @@ class ObjectQueryMiddleware(object):
                 metadata = disk_file.get_metadata()
                 if int(metadata['Content-Length']) > self.zerovm_maxnexe:
                     return False
+                nexe_digest = _nexe_digest(disk_file.data_file)
+                verdict = self.validation_index.get(nexe_digest)
+                if verdict is not None:
+                    if verdict:
+                        metadata['Validated'] = metadata['ETag']
+                        disk_file.put_metadata(metadata)
+                    return verdict
                 tmpdir = TmpDir(
                     self._diskfile_mgr.devices,
                     device,
@@ -1019,6 +1445,7 @@ class ObjectQueryMiddleware(object):
                             validated = int(report[REPORT_VALIDATOR])
                         except ValueError:
                             return False
+                        self.validation_index.put(nexe_digest, validated == 0)
                         if validated == 0:
                             metadata = disk_file.get_metadata()
                             metadata['Validated'] = metadata['ETag']
@@ -1147,7 +1574,7 @@ class ObjectQueryMiddleware(object):
         result = []
         sock = None
         for l in open('/proc/net/unix').readlines():
-            m = re.search('(\d+) %s' % daemon_sock, l)
+            m = re.search('(\d+) %s$' % re.escape(daemon_sock), l.rstrip())
             if m:
                 sock = m.group(1)
         if not sock:
@@ -1174,6 +1601,46 @@ def _parse_zerovm_report(nexe_headers, report):
     nexe_headers['x-nexe-status'] = report[REPORT_STATUS].replace('\n', ' ').rstrip()
 
 
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _is_private(st):
+    """Returns True if stat result is owned by us or root and not writable by others"""
+    return st.st_uid in (os.geteuid(), 0) and not st.st_mode & 0o022
+
+
+def _check_private(path, dir_ok=False):
+    """
+    Raises ValueError if path is not private to object server user
+
+    Sticky world-writable directories, like /tmp, are refused too:
+    anybody can create a file there before us.
+    """
+    st = os.stat(path)
+    if dir_ok != os.path.isdir(path) or not _is_private(st):
+        raise ValueError('"%s" must be owned by object server user and '
+                         'not writable by group or others' % path)
+
+
+def _nexe_digest(path):
+    """SHA-256 of executable file, validation verdicts are keyed by it"""
+    digest = sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _sysimage_nexe_key(sysimage_path, boot_file):
+    try:
+        mtime = os.stat(sysimage_path).st_mtime
+    except OSError:
+        mtime = 0
+    return md5('%s:%s:%s' % (sysimage_path, mtime, boot_file)).hexdigest()
+
+
 def _channel_cleanup(response_channels):
     for ch in response_channels:
         try:
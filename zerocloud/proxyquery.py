@@ -1,5 +1,8 @@
-from copy import deepcopy
-import ctypes
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from StringIO import StringIO
+import errno
+import os
 import re
 import struct
 import traceback
@@ -8,8 +11,10 @@ import datetime
 import uuid
 from hashlib import md5
 from random import shuffle, randrange
+from urllib import urlencode
 import greenlet
-from eventlet import GreenPile, GreenPool, Queue
+from eventlet import GreenPile, GreenPool, Queue, spawn
+from eventlet.event import Event
 from eventlet.green import socket
 from eventlet.timeout import Timeout
 
@@ -30,13 +35,14 @@ from swift.common.constraints import check_utf8, MAX_FILE_SIZE
 from swift.common.swob import Request, Response, HTTPNotFound, \
     HTTPPreconditionFailed, HTTPRequestTimeout, HTTPRequestEntityTooLarge, \
     HTTPBadRequest, HTTPUnprocessableEntity, HTTPServiceUnavailable, \
-    HTTPClientDisconnect, wsgify
-from zerocloud.common import ACCESS_READABLE, ACCESS_CDR, ACCESS_WRITABLE, \
+    HTTPClientDisconnect, HTTPInternalServerError, wsgify
+from zerocloud.common import ACCESS_READABLE, ACCESS_CDR, ACCESS_WRITABLE, DEVICE_MAP, \
     CLUSTER_CONFIG_FILENAME, NODE_CONFIG_FILENAME, TAR_MIMES, \
     POST_TEXT_OBJECT_SYSTEM_MAP, POST_TEXT_ACCOUNT_SYSTEM_MAP, \
     merge_headers, update_metadata, DEFAULT_EXE_SYSTEM_MAP, STREAM_CACHE_SIZE, \
-    ZvmChannel, parse_location, is_swift_path, is_image_path, can_run_as_daemon, SwiftPath, NodeEncoder
-from zerocloud.configparser import ClusterConfigParser, ClusterConfigParsingError
+    ZvmChannel, parse_location, is_swift_path, is_image_path, can_run_as_daemon, SwiftPath, NodeEncoder, \
+    is_zvm_path, SysmapEncoder, request_cgi_env
+from zerocloud.configparser import ClusterConfigParser, ClusterConfigParsingError, ClusterPlanCache
 from zerocloud.tarstream import StringBuffer, UntarStream, \
     TarStream, REGTYPE, BLOCKSIZE, NUL, ExtractedFile, Path
 
@@ -105,25 +111,43 @@ class FinalBody(object):
 
 
 class NameService(object):
+    """
+    Name service shared by all cluster jobs of one proxy worker
+
+    Each job gets its own range of node ids, registrations of all jobs
+    arrive to one UDP socket and are routed to their job by node id.
+    """
 
     INT_FMT = '!I'
+    HEADER_FMT = '!III'
     INPUT_RECORD_FMT = '!IH'
     OUTPUT_RECORD_FMT = '!4sH'
     INT_SIZE = struct.calcsize(INT_FMT)
+    HEADER_SIZE = struct.calcsize(HEADER_FMT)
     INPUT_RECORD_SIZE = struct.calcsize(INPUT_RECORD_FMT)
     OUTPUT_RECORD_SIZE = struct.calcsize(OUTPUT_RECORD_FMT)
-
-    def __init__(self, peers):
+    LOCALHOST = socket.inet_pton(socket.AF_INET, '127.0.0.1')
+    # precompiled record formats, registration of large clusters parses a lot of them
+    HEADER = struct.Struct(HEADER_FMT)
+    INT = struct.Struct(INT_FMT)
+    INPUT_RECORD = struct.Struct(INPUT_RECORD_FMT)
+    OUTPUT_RECORD = struct.Struct(OUTPUT_RECORD_FMT)
+    # node ids are signed 32 bit integers in ZeroVM manifest
+    MAX_NODE_ID = 0x7fffffff
+
+    def __init__(self, logger=None, job_timeout=86400):
         self.port = None
         self.hostaddr = None
-        self.peers = peers
+        self.logger = logger or get_logger({}, log_route='name-service')
         self.sock = None
         self.thread = None
-        self.bind_map = {}
-        self.conn_map = {}
-        self.peer_map = {}
-        self.int_pool = GreenPool()
-        #print "NameServer got %d peers" % self.peers
+        # jobs that were never removed are dropped after this amount of seconds
+        self.job_timeout = job_timeout
+        # first id of the job range -> job, ranges never overlap
+        self.jobs = {}
+        self.bases = []
+        self.next_base = 0
+        self.next_purge = 0
 
     def start(self, pool):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -132,158 +156,540 @@ class NameService(object):
         self.thread = pool.spawn(self._run)
         (self.hostaddr, self.port) = self.sock.getsockname()
 
+    def add_job(self, peers, id_count=None):
+        """
+        Reserves a range of node ids for a new cluster job
+
+        :param peers: number of nodes that will register
+        :param id_count: size of the id range, if job node ids are sparse
+        :returns: NameServiceJob, its node ids must be offset by job.base
+        """
+        now = time.time()
+        if now > self.next_purge:
+            self.next_purge = now + 1
+            for job in [job for job in self.jobs.itervalues()
+                        if job.created + self.job_timeout < now]:
+                self.remove_job(job)
+        size = max(id_count or peers, peers)
+        base = self.next_base
+        while True:
+            if base + size > NameService.MAX_NODE_ID:
+                base = 0
+            idx = bisect_left(self.bases, base + size) - 1
+            if idx < 0:
+                break
+            prev_job = self.jobs[self.bases[idx]]
+            if prev_job.base + prev_job.size <= base:
+                break
+            base = prev_job.base + prev_job.size
+        job = NameServiceJob(base, size, peers, self.logger)
+        self.jobs[base] = job
+        insort(self.bases, base)
+        self.next_base = base + size
+        return job
+
+    def remove_job(self, job):
+        if self.jobs.get(job.base) is job:
+            del self.jobs[job.base]
+            del self.bases[bisect_left(self.bases, job.base)]
+
+    def get_job(self, peer_id):
+        idx = bisect_left(self.bases, peer_id) - 1
+        if idx < 0:
+            return None
+        job = self.jobs[self.bases[idx]]
+        if peer_id > job.base + job.size:
+            return None
+        return job
+
     def _run(self):
-        #bind_map = {}
-        #conn_map = {}
-        #peer_map = {}
         while 1:
             try:
-                start = time.time()
                 message, peer_address = self.sock.recvfrom(65535)
-                offset = 0
-                peer_id = struct.unpack_from(NameService.INT_FMT, message, offset)[0]
-                offset += NameService.INT_SIZE
-                bind_count = struct.unpack_from(NameService.INT_FMT, message, offset)[0]
-                offset += NameService.INT_SIZE
-                connect_count = struct.unpack_from(NameService.INT_FMT, message, offset)[0]
-                offset += NameService.INT_SIZE
-                for i in range(bind_count):
-                    connecting_host, port = struct.unpack_from(NameService.INPUT_RECORD_FMT, message, offset)[0:2]
-                    offset += NameService.INPUT_RECORD_SIZE
-                    self.bind_map.setdefault(peer_id, {})[connecting_host] = port
-                self.conn_map[peer_id] = (connect_count, offset, ctypes.create_string_buffer(message[:]))
-                self.peer_map.setdefault(peer_id, {})[0] = peer_address[0]
-                self.peer_map.setdefault(peer_id, {})[1] = peer_address[1]
-
-                if len(self.peer_map) == self.peers:
-                    print "Finished name server receive in %.3f seconds" % (time.time() - start)
-                    start = time.time()
-                    for peer_id in self.peer_map.iterkeys():
-                        #out = ''
-                        (connect_count, offset, reply) = self.conn_map[peer_id]
-                        for i in range(connect_count):
-                            connecting_host = struct.unpack_from(NameService.INT_FMT, reply, offset)[0]
-                            port = self.bind_map[connecting_host][peer_id]
-                            connect_to = self.peer_map[connecting_host][0]
-                            if connect_to == self.peer_map[peer_id][0]:  # both on the same host
-                                connect_to = '127.0.0.1'
-                            struct.pack_into(NameService.OUTPUT_RECORD_FMT, reply, offset,
-                                             socket.inet_pton(socket.AF_INET, connect_to), port)
-                            offset += NameService.OUTPUT_RECORD_SIZE
-                            #out += ' %d -> %d:%d\n' % (connecting_host, peer_id, port)
-                        self.sock.sendto(reply, (self.peer_map[peer_id][0], self.peer_map[peer_id][1]))
-                        #print out
-                    print "Finished name server send in %.3f seconds" % (time.time() - start)
+                start = time.time()
+                peer_id = NameService.INT.unpack_from(message, 0)[0]
+                job = self.get_job(peer_id)
+                if not job:
+                    self.logger.warn(_('Name service got registration for unknown node %d'), peer_id)
+                    continue
+                if job.first_seen is None:
+                    job.first_seen = start
+                # python has no sendmmsg, all replies unblocked by this
+                # registration are sent back to back, without yielding in between
+                for ready_id in job.register(message, peer_address):
+                    host, port, _junk = job.peer_map[ready_id]
+                    self.sock.sendto(job.conn_map[ready_id][0], (host, port))
+                    job.replied.add(ready_id)
+                job.busy_time += time.time() - start
+                if not job.reported and len(job.replied) == job.peers:
+                    job.reported = True
+                    self.logger.info(
+                        _('Name service job %(base)d: %(peers)d peers registered in %(reg).3fs, '
+                          'wired in %(busy).3fs'),
+                        {'base': job.base, 'peers': job.peers,
+                         'reg': time.time() - job.first_seen, 'busy': job.busy_time})
             except greenlet.GreenletExit:
                 return
             except Exception:
-                print traceback.format_exc()
-                pass
+                self.logger.exception(_('ERROR in name service'))
 
     def stop(self):
         self.thread.kill()
         self.sock.close()
 
 
-class ProxyQueryMiddleware(object):
+class NameServiceJob(object):
+    """
+    Name service state of one cluster job
 
-    def list_account(self, account, mask=None, marker=None, request=None):
-        new_req = request.copy_get()
-        new_req.path_info = '/' + quote(account)
-        new_req.query_string = 'format=json'
-        if marker:
-            new_req.query_string += '&marker=' + marker
-        resp = AccountController(self.app, account).GET(new_req)
-        if resp.status_int == 204:
-            data = resp.body
+    Each node registers the ports it has bound for its peers and the list of
+    peers it connects to. Connection is resolved as soon as both of its ends
+    are registered and node gets its reply as soon as all of its connections
+    are resolved, there is no barrier waiting for the whole cluster.
+    """
+
+    def __init__(self, base, size, peers, logger):
+        # job node ids are base + 1 ... base + size
+        self.base = base
+        self.size = size
+        self.peers = peers
+        self.logger = logger
+        self.created = time.time()
+        # peer id -> {connecting peer id: bound port}
+        self.bind_map = {}
+        # peer id -> [reply buffer, number of unresolved connections]
+        self.conn_map = {}
+        # peer id -> (host, port, packed host)
+        self.peer_map = {}
+        # peer id -> [(connecting peer id, reply offset)], connections waiting for that peer
+        self.waiting = {}
+        self.replied = set()
+        self.reported = False
+        self.first_seen = None
+        self.busy_time = 0.0
+
+    def register(self, message, peer_address):
+        """
+        Registers one peer and resolves all connections that can be resolved now
+
+        :param message: registration message received from the peer
+        :param peer_address: (host, port) address of the peer
+        :returns: list of peer ids whose replies are complete and can be sent
+        """
+        peer_id, bind_count, connect_count = \
+            NameService.HEADER.unpack_from(message, 0)
+        host = peer_address[0]
+        self.peer_map[peer_id] = (host, peer_address[1], socket.inet_pton(socket.AF_INET, host))
+        if peer_id in self.conn_map:
+            # peer sent its registration again, answer it if the reply is ready
+            if self.conn_map[peer_id][1] == 0:
+                return [peer_id]
             return []
-        if resp.status_int < 200 or resp.status_int >= 300:
+        offset = NameService.HEADER_SIZE
+        binds = self.bind_map.setdefault(peer_id, {})
+        for i in range(bind_count):
+            connecting_host, port = NameService.INPUT_RECORD.unpack_from(message, offset)
+            binds[connecting_host] = port
+            offset += NameService.INPUT_RECORD_SIZE
+        entry = [bytearray(message), connect_count]
+        self.conn_map[peer_id] = entry
+        for i in range(connect_count):
+            connect_to = NameService.INT.unpack_from(message, offset)[0]
+            if connect_to in self.conn_map:
+                self._resolve(peer_id, connect_to, offset)
+            else:
+                self.waiting.setdefault(connect_to, []).append((peer_id, offset))
+            offset += NameService.OUTPUT_RECORD_SIZE
+        ready = []
+        for connecting_peer, reply_offset in self.waiting.pop(peer_id, []):
+            if self._resolve(connecting_peer, peer_id, reply_offset):
+                ready.append(connecting_peer)
+        if entry[1] == 0:
+            ready.append(peer_id)
+        return ready
+
+    def _resolve(self, peer_id, connect_to, offset):
+        """
+        Writes address of connect_to peer into the reply of peer_id
+
+        :returns: True if it was the last unresolved connection of peer_id
+        """
+        port = self.bind_map[connect_to].get(peer_id)
+        if port is None:
+            self.logger.warn(_('Peer %(bind)d has no port bound for peer %(conn)d'),
+                             {'bind': connect_to, 'conn': peer_id})
+            port = 0
+        connect_host = self.peer_map[connect_to]
+        if connect_host[0] == self.peer_map[peer_id][0]:  # both on the same host
+            packed_host = NameService.LOCALHOST
+        else:
+            packed_host = connect_host[2]
+        entry = self.conn_map[peer_id]
+        NameService.OUTPUT_RECORD.pack_into(entry[0], offset, packed_host, port)
+        entry[1] -= 1
+        return entry[1] == 0
+
+
+class DaemonRegistry(object):
+    """
+    Daemon configs indexed by executable and number of channels
+
+    Lookup has the same semantics as a scan of the whole daemon list:
+    daemons are checked with can_run_as_daemon() in registration order
+    and the first one that matches is used. Only daemons with the same
+    executable and channel count can match, so only those are checked.
+    Daemon registered again under the same uuid is moved to the end.
+    """
+
+    def __init__(self):
+        self.daemons = OrderedDict()
+        self.index = {}
+
+    @staticmethod
+    def signature(node):
+        return node.exe.url, len(node.channels)
+
+    def register(self, sock, node):
+        self.unregister(sock)
+        self.daemons[sock] = node
+        key = self.signature(node)
+        self.index[key] = self.index.get(key, ()) + (sock,)
+
+    def unregister(self, sock):
+        node = self.daemons.pop(sock, None)
+        if node:
+            key = self.signature(node)
+            socks = tuple(s for s in self.index[key] if s != sock)
+            if socks:
+                self.index[key] = socks
+            else:
+                del self.index[key]
+
+    def get(self, sock):
+        return self.daemons.get(sock)
+
+    def copy(self):
+        registry = DaemonRegistry()
+        registry.daemons = self.daemons.copy()
+        registry.index = self.index.copy()
+        return registry
+
+    def lookup(self, node):
+        if not node.channels or not getattr(node.exe, 'url', None):
+            return None
+        for sock in self.index.get(self.signature(node), ()):
+            if can_run_as_daemon(node, self.daemons[sock]):
+                return sock
+        return None
+
+    def __len__(self):
+        return len(self.daemons)
+
+
+class MemcacheResultCache(object):
+    """
+    Results of deterministic executions stored in memcache
+    """
+
+    def __init__(self, memcache_client, ttl):
+        self.memcache = memcache_client
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.memcache.get('zvmresult/%s' % key)
+
+    def put(self, key, entry):
+        self.memcache.set('zvmresult/%s' % key, entry, serialize=False, time=self.ttl)
+
+
+class DiskResultCache(object):
+    """
+    Results of deterministic executions stored as files in a local directory
+
+    Directory can be shared by all proxy workers.
+    Each entry has its own expiration time, when total size of entries
+    goes over max_size least recently used entries are removed.
+    Cached results are served without any checks, so directory must be
+    private to proxy server user: it is created with mode 0700 and
+    ValueError is raised if it is accessible by anybody else.
+    """
+
+    def __init__(self, path, ttl, max_size):
+        if not path:
+            raise ValueError('"zerovm_result_cache_dir" must be set for disk result cache')
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        # unknown until the directory is scanned
+        self.total_size = None
+        self._make_dir()
+        st = os.stat(self.path)
+        if not os.path.isdir(self.path) or st.st_uid != os.geteuid() or st.st_mode & 0o077:
+            raise ValueError('"%s" must be a directory owned by proxy server user '
+                             'and not accessible by group or others' % self.path)
+
+    def _make_dir(self):
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get(self, key):
+        entry_path = os.path.join(self.path, key)
+        try:
+            with open(entry_path, 'rb') as fp:
+                entry = fp.read()
+        except IOError:
+            return None
+        if _result_cache_expires(entry) < time.time():
+            self._remove(entry_path)
+            return None
+        try:
+            # mtime is the last use time, for eviction
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        tmp_path = os.path.join(self.path, '.%s.%s' % (key, uuid.uuid4().hex))
+        try:
+            self._make_dir()
+            with open(tmp_path, 'wb') as fp:
+                fp.write(entry)
+            os.rename(tmp_path, os.path.join(self.path, key))
+        except (IOError, OSError):
+            self._remove(tmp_path)
+            return
+        if self.total_size is not None:
+            self.total_size += len(entry)
+        if self.total_size is None or self.total_size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total_size += st.st_size
+        entries.sort()
+        for _junk, size, name in entries:
+            if total_size <= self.max_size:
+                break
+            self._remove(os.path.join(self.path, name))
+            total_size -= size
+        self.total_size = total_size
+
+    def _remove(self, entry_path):
+        try:
+            os.unlink(entry_path)
+        except OSError:
+            pass
+
+
+class ProxyQueryMiddleware(object):
+
+    def list_account(self, account, mask=None, marker=None, request=None,
+                     prefix=None, delimiter=None):
+        """
+        Generates names of the containers in account that match the mask
+
+        Listing is fetched page by page, next page is fetched
+        while names from the current one are consumed.
+        """
+        path_info = '/' + quote(account)
+        get_page = lambda m: self._get_listing_page(AccountController(self.app, account),
+                                                    path_info, request, m, prefix, delimiter)
+        return _iter_listing(get_page, mask, marker)
+
+    def list_container(self, account, container, mask=None, marker=None, request=None,
+                       prefix=None, delimiter=None):
+        """
+        Generates names of the objects in container that match the mask
+
+        Listing is fetched page by page, next page is fetched
+        while names from the current one are consumed.
+        Pseudo-directories are skipped.
+        If listing cache is enabled, full listing of the prefix is kept
+        in memcache, it's used while container object count, bytes used
+        and timestamps, from a fresh HEAD request, are the same as when it was stored.
+        """
+        path_info = '/' + quote(account) + '/' + quote(container)
+        get_page = lambda m: self._get_listing_page(ContainerController(self.app, account, container),
+                                                    path_info, request, m, prefix, delimiter)
+        memcache_client = None
+        if self.app.zerovm_listing_cache and not marker and not delimiter:
+            memcache_client = cache_from_env(request.environ)
+        if not memcache_client:
+            return _iter_listing(get_page, mask, marker, skip_dirs=True)
+        # container info that Swift caches can be stale, ask the container itself,
+        # HEAD is authorized just like the listing would be
+        head_req = request.copy_get()
+        head_req.method = 'HEAD'
+        head_req.path_info = path_info
+        head_req.query_string = ''
+        head_resp = ContainerController(self.app, account, container).HEAD(head_req)
+        if not is_success(head_resp.status_int):
             raise Exception('Error querying object server')
-        data = json.loads(resp.body)
-        if marker:
-            return data
-        ret = []
-        while data:
-            for item in data:
-                if not mask or mask.match(item['name']):
-                    ret.append(item['name'])
-            marker = data[-1]['name']
-            data = self.list_account(account, mask=None, marker=marker, request=request)
-        return ret
-
-    def list_container(self, account, container, mask=None, marker=None, request=None):
+        if head_resp.headers.get('x-container-object-count') is None:
+            return _iter_listing(get_page, mask, marker, skip_dirs=True)
+        cache_key = 'zvmlist/%s/%s/%s' % (account, container, prefix or '')
+        validator = [head_resp.headers.get(name)
+                     for name in ('x-container-object-count', 'x-container-bytes-used',
+                                  'x-put-timestamp', 'x-timestamp')]
+        cached = memcache_client.get(cache_key)
+        if cached and cached.get('validator') == validator:
+            return (name for name in cached['names'] if not mask or mask.match(name))
+        return _cache_listing_iter(memcache_client, cache_key, validator,
+                                   _iter_listing(get_page, None, None, skip_dirs=True),
+                                   mask, self.app.zerovm_listing_cache_max_items,
+                                   self.app.zerovm_listing_cache_ttl)
+
+    def _get_listing_page(self, controller, path_info, request, marker, prefix, delimiter):
         new_req = request.copy_get()
-        new_req.path_info = '/' + quote(account) + '/' + quote(container)
-        new_req.query_string = 'format=json'
-        if marker:
-            new_req.query_string += '&marker=' + marker
-        resp = ContainerController(self.app, account, container).GET(new_req)
+        new_req.path_info = path_info
+        query = [('format', 'json')]
+        for key, value in [('marker', marker), ('prefix', prefix), ('delimiter', delimiter)]:
+            if value:
+                query.append((key, value.encode('utf-8') if isinstance(value, unicode) else value))
+        new_req.query_string = urlencode(query)
+        resp = controller.GET(new_req)
         if resp.status_int == 204:
-            data = resp.body
             return []
         if resp.status_int < 200 or resp.status_int >= 300:
             raise Exception('Error querying object server')
-        data = json.loads(resp.body)
-        if marker:
-            return data
-        ret = []
-        while data:
-            for item in data:
-                if item['name'][-1] == '/':
-                    continue
-                if not mask or mask.match(item['name']):
-                    ret.append(item['name'])
-            marker = data[-1]['name']
-            data = self.list_container(account, container,
-                                       mask=None, marker=marker, request=request)
-        return ret
+        return json.loads(resp.body)
 
-    def parse_daemon_config(self, daemon_list):
-        result = []
+    def parse_daemon_node(self, sock, json_config, source):
+        """
+        Parses one daemon config, returns daemon node or None if config is invalid
+
+        :param sock: daemon uuid, used as daemon socket name
+        :param json_config: parsed JSON of the daemon config
+        :param source: where config was loaded from, for log messages
+        """
         request = Request.blank('/daemon', environ={'REQUEST_METHOD': 'POST'},
                                 headers={'Content-Type': 'application/json'})
-        socks = {}
+        parser = ClusterConfigParser(self.zerovm_sysimage_devices,
+                                     self.app.zerovm_content_type,
+                                     self.app.parser_config,
+                                     self.list_account,
+                                     self.list_container)
+        try:
+            parser.parse(json_config, False, request=request)
+        except ClusterConfigParsingError, e:
+            self.logger.warning('Daemon config %s error: %s' % (source, str(e)))
+            return None
+        if len(parser.nodes) != 1:
+            self.logger.warning('Bad daemon config %s: too many nodes' % source)
+        for node in parser.nodes.itervalues():
+            if node.bind or node.connect:
+                self.logger.warning('Bad daemon config %s: network channels are present' % source)
+                continue
+            if not is_image_path(node.exe):
+                self.logger.warning('Bad daemon config %s: exe path must be in image file' % source)
+                continue
+            image = None
+            for sysimage in parser.sysimage_devices.keys():
+                if node.exe.image == sysimage:
+                    image = sysimage
+                    break
+            if not image:
+                self.logger.warning('Bad daemon config %s: exe is not in sysimage device' % source)
+                continue
+            node.channels = sorted(node.channels, key=lambda ch: ch.device)
+            self.logger.info('Loaded daemon config %s with UUID %s' % (source, sock))
+            return node
+        return None
+
+    def parse_daemon_config(self, daemon_list):
+        registry = DaemonRegistry()
         for sock, conf_file in zip(*[iter(daemon_list)] * 2):
-            if socks.get(sock, None):
+            if registry.get(sock):
                 self.logger.warning('Duplicate daemon config for uuid %s' % sock)
                 continue
-            socks[sock] = 1
             try:
                 json_config = json.load(open(conf_file))
             except IOError:
                 self.logger.warning('Cannot load daemon config file: %s' % conf_file)
                 continue
-            parser = ClusterConfigParser(self.zerovm_sysimage_devices,
-                                         self.app.zerovm_content_type,
-                                         self.app.parser_config,
-                                         self.list_account,
-                                         self.list_container)
-            try:
-                parser.parse(json_config, False, request=request)
-            except ClusterConfigParsingError, e:
-                self.logger.warning('Daemon config %s error: %s' % (conf_file, str(e)))
-                continue
-            if len(parser.nodes) != 1:
-                self.logger.warning('Bad daemon config %s: too many nodes' % conf_file)
-            for node in parser.nodes.itervalues():
-                if node.bind or node.connect:
-                    self.logger.warning('Bad daemon config %s: network channels are present' % conf_file)
-                    continue
-                if not is_image_path(node.exe):
-                    self.logger.warning('Bad daemon config %s: exe path must be in image file' % conf_file)
-                    continue
-                image = None
-                for sysimage in parser.sysimage_devices.keys():
-                    if node.exe.image == sysimage:
-                        image = sysimage
-                        break
-                if not image:
-                    self.logger.warning('Bad daemon config %s: exe is not in sysimage device' % conf_file)
-                    continue
-                node.channels = sorted(node.channels, key=lambda ch: ch.device)
-                result.append((sock, node))
-                self.logger.info('Loaded daemon config %s with UUID %s' % (conf_file, sock))
-        return result
+            node = self.parse_daemon_node(sock, json_config, conf_file)
+            if node:
+                registry.register(sock, node)
+        return registry
+
+    def load_daemon_registry(self, req):
+        """
+        Starts reload of daemons from the registry object, when it is time to check it
+
+        Registry is read in a separate greenthread, requests are served
+        with the daemons already loaded in the meantime.
+
+        :param req: request to copy the environment for registry GET from
+        """
+        if not self.daemon_registry_path or self.daemon_registry_loading \
+                or time.time() < self.daemon_registry_next_check:
+            return
+        self.daemon_registry_next_check = time.time() + self.daemon_registry_interval
+        registry_req = req.copy_get()
+        registry_req.path_info = self.daemon_registry_path
+        registry_req.query_string = ''
+        if 'swift.authorize' in registry_req.environ:
+            # registry is internal to the proxy, end user does not need access to it
+            del registry_req.environ['swift.authorize']
+        if self.daemon_registry_etag:
+            registry_req.headers['If-None-Match'] = self.daemon_registry_etag
+        self.daemon_registry_loading = True
+        spawn(self._reload_daemon_registry, registry_req)
+
+    def _reload_daemon_registry(self, registry_req):
+        """
+        Reloads daemons from the registry object, if it was changed
+
+        Registry object is a JSON dictionary of daemon uuid -> daemon config,
+        its daemons are added, in uuid order, after the ones from `zerovm_daemons`
+        config files and replace them if uuid is the same.
+        """
+        try:
+            account, container, obj = split_path(self.daemon_registry_path, 3, 3, True)
+            resp = ObjectController(self.app, account, container, obj).GET(registry_req)
+            if resp.status_int == 304:
+                return
+            if resp.status_int == 404:
+                registry = self.static_daemons
+            elif is_success(resp.status_int):
+                try:
+                    daemons = json.loads(resp.body)
+                    if not isinstance(daemons, dict):
+                        raise ValueError('must be a dictionary of uuid -> config')
+                except ValueError, e:
+                    self.logger.warning('Cannot load daemon registry %s: %s' % (self.daemon_registry_path, str(e)))
+                    return
+                registry = self.static_daemons.copy()
+                for sock, json_config in sorted(daemons.iteritems()):
+                    if not re.match(r'^[\w.-]+$', sock):
+                        self.logger.warning('Bad daemon uuid in registry: %s' % sock)
+                        continue
+                    node = self.parse_daemon_node(str(sock), json_config,
+                                                  '%s:%s' % (self.daemon_registry_path, sock))
+                    if node:
+                        registry.register(str(sock), node)
+            else:
+                self.logger.warning('Cannot load daemon registry %s: %s' % (self.daemon_registry_path, resp.status))
+                return
+            self.daemon_registry_etag = resp.etag
+            self.app.zerovm_daemons = registry
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR loading daemon registry %s'), self.daemon_registry_path)
+        finally:
+            self.daemon_registry_loading = False
 
     def __init__(self, app, conf, logger=None):
         self.app = app
@@ -299,17 +705,35 @@ class ProxyQueryMiddleware(object):
         self.app.zerovm_maxconfig = int(conf.get('zerovm_maxconfig', 65536))
         # name server hostname or ip, will be autodetected if not set
         self.app.zerovm_ns_hostname = conf.get('zerovm_ns_hostname')
-        # name server thread pool size
+        # thread pool size for the name service and accounting workers
         self.app.zerovm_ns_maxpool = int(conf.get('zerovm_ns_maxpool', 1000))
         self.app.zerovm_ns_thrdpool = GreenPool(self.app.zerovm_ns_maxpool)
         # max time to wait for upload to finish, used in POST requests
         self.app.max_upload_time = int(conf.get('max_upload_time', 86400))
         # network chunk size for all network ops
         self.app.network_chunk_size = int(conf.get('network_chunk_size', 65536))
+        # header for "execute many independent jobs by one POST"
+        self.app.zerovm_batch = 'x-zerovm-batch'
+        # maximum number of jobs in one batch request
+        self.app.zerovm_batch_max_jobs = int(conf.get('zerovm_batch_max_jobs', 100))
+        # number of jobs of one batch request that are executed at the same time
+        self.app.zerovm_batch_concurrency = int(conf.get('zerovm_batch_concurrency', 10))
+        # number of chunks each data source may prefetch while waiting for its turn
+        self.app.zerovm_source_prefetch = int(conf.get('zerovm_source_prefetch', 16))
+        # max time a data source waits for the data sources queued before it, default - max_upload_time
+        self.app.zerovm_source_wait_timeout = int(conf.get('zerovm_source_wait_timeout',
+                                                           self.app.max_upload_time))
         # use newest files when running zerovm executables, default - False
         self.app.zerovm_uses_newest = conf.get('zerovm_uses_newest', 'f').lower() in TRUE_VALUES
         # use executable validation info, stored on PUT or POST, to shave some time on zerovm startup
         self.app.zerovm_prevalidate = conf.get('zerovm_prevalidate', 'f').lower() in TRUE_VALUES
+        # let object servers fetch remote swift inputs directly from their peers,
+        # instead of streaming them through the proxy, default - False
+        self.app.zerovm_remote_fetch = conf.get('zerovm_remote_fetch', 'f').lower() in TRUE_VALUES
+        # number of (object server device, executable etag) pairs remembered as cached,
+        # executables are not sent to such devices, zero disables, default - 0
+        self.app.zerovm_nexe_cache_hints = int(conf.get('zerovm_nexe_cache_hints', 0))
+        self.app.nexe_cache_hints = OrderedDict()
         # use CORS workaround to POST execute commands, default - False
         self.app.zerovm_use_cors = conf.get('zerovm_use_cors', 'f').lower() in TRUE_VALUES
         # Accounting: enable or disabe execution accounting data, default - disabled
@@ -334,6 +758,31 @@ class ProxyQueryMiddleware(object):
         self.app.zerovm_allowed_commands = [self.app.zerovm_open_version, self.app.zerovm_openwith_version]
         # GET support: cache config files for this amount of seconds
         self.app.zerovm_cache_config_timeout = 60
+        # GET support: cache results of deterministic executions, "memcache", "disk" or empty to disable
+        self.app.zerovm_result_cache = conf.get('zerovm_result_cache', '').strip().lower()
+        # GET support: cached results expire after this amount of seconds
+        self.app.zerovm_result_cache_ttl = int(conf.get('zerovm_result_cache_ttl', 300))
+        # GET support: results bigger than this are never cached
+        self.app.zerovm_result_cache_max_item = int(conf.get('zerovm_result_cache_max_item', 1000000))
+        # GET support: disk result cache location and maximum total size,
+        # location must be set explicitly, directory must be private to proxy server user
+        self.app.result_cache_disk = None
+        if self.app.zerovm_result_cache == 'disk':
+            self.app.result_cache_disk = DiskResultCache(
+                conf.get('zerovm_result_cache_dir', ''),
+                self.app.zerovm_result_cache_ttl,
+                int(conf.get('zerovm_result_cache_size', 256 * 1048576)))
+        # cache container listings of wildcard jobs in memcache, default - False
+        self.app.zerovm_listing_cache = conf.get('zerovm_listing_cache', 'f').lower() in TRUE_VALUES
+        # cached listings expire after this amount of seconds
+        self.app.zerovm_listing_cache_ttl = int(conf.get('zerovm_listing_cache_ttl', 600))
+        # listings with more objects than this are never cached
+        self.app.zerovm_listing_cache_max_items = int(conf.get('zerovm_listing_cache_max_items', 10000))
+        # number of parsed cluster maps kept for reuse by repeated jobs, zero disables
+        self.app.zerovm_plan_cache_size = int(conf.get('zerovm_plan_cache_size', 100))
+        self.app.plan_cache = None
+        if self.app.zerovm_plan_cache_size > 0:
+            self.app.plan_cache = ClusterPlanCache(self.app.zerovm_plan_cache_size)
         self.app.parser_config = {
             'limits': {
                 # total maximum iops for channel read or write operations, per zerovm session
@@ -343,7 +792,11 @@ class ProxyQueryMiddleware(object):
                 'rbytes': int(conf.get('zerovm_maxoutput', 1024 * 1048576)),
                 # total maximum bytes for a channel read operations, per zerovm session
                 'wbytes': int(conf.get('zerovm_maxinput', 1024 * 1048576))
-            }
+            },
+            # number of containers listed at the same time, when container name has wildcards
+            'listing_concurrency': int(conf.get('zerovm_listing_concurrency', 8)),
+            # send connections to contiguous groups of nodes as ranges, object servers must support them
+            'connect_ranges': conf.get('zerovm_connect_ranges', 'f').lower() in TRUE_VALUES
         }
         # sysmap json config parser instance
         # self.app.parser = ClusterConfigParser(self.zerovm_sysimage_devices,
@@ -352,7 +805,17 @@ class ProxyQueryMiddleware(object):
         #                                       self.list_account, self.list_container)
         # list of daemons we need to lazy load (first request will start the daemon)
         daemon_list = [i.strip() for i in conf.get('zerovm_daemons', '').split() if i.strip()]
-        self.app.zerovm_daemons = self.parse_daemon_config(daemon_list)
+        self.static_daemons = self.parse_daemon_config(daemon_list)
+        self.app.zerovm_daemons = self.static_daemons
+        # swift object with daemon configs that can be changed at runtime, /account/container/object
+        self.daemon_registry_path = conf.get('zerovm_daemon_registry')
+        # how often to check daemon registry object for changes, in seconds
+        self.daemon_registry_interval = int(conf.get('zerovm_daemon_registry_interval', 60))
+        self.daemon_registry_next_check = 0
+        self.daemon_registry_etag = None
+        self.daemon_registry_loading = False
+        # name service shared by all cluster jobs, started on first use
+        self.name_service = None
 
     @wsgify
     def __call__(self, req):
@@ -375,6 +838,7 @@ class ProxyQueryMiddleware(object):
             controller = self.get_controller(account, container, obj)
             if not controller:
                 return HTTPPreconditionFailed(request=req, body='Bad URL')
+            self.load_daemon_registry(req)
             if 'swift.trans_id' not in req.environ:
                 # if this wasn't set by an earlier middleware, set it now
                 trans_id = 'tx' + uuid.uuid4().hex
@@ -388,6 +852,8 @@ class ProxyQueryMiddleware(object):
                 req.path_info_pop()
             if not self.app.zerovm_execute in req.headers:
                 req.headers[self.app.zerovm_execute] = self.app.zerovm_execute_ver
+            if self.app.zerovm_batch in req.headers and req.method == 'POST':
+                return self.execute_batch(req, path_parts)
             try:
                 handler = getattr(controller, req.method)
             except AttributeError:
@@ -407,9 +873,70 @@ class ProxyQueryMiddleware(object):
             return res
         return self.app
 
+    def get_name_service(self):
+        if not self.name_service:
+            self.name_service = NameService(logger=self.logger,
+                                            job_timeout=self.app.max_upload_time)
+            self.name_service.start(self.app.zerovm_ns_thrdpool)
+        return self.name_service
+
     def get_controller(self, account, container, obj):
         return ClusterController(self.app, account, container, obj, self)
 
+    def execute_batch(self, req, path_parts):
+        """
+        Executes many independent jobs sent in one POST
+
+        Request body is a JSON list of cluster maps, jobs are executed concurrently,
+        each one as a regular POST of its own.
+        Response is a tar stream, with two members for each job, in the order of jobs:
+        "<n>/headers" - JSON with "status" and "headers" of the job response,
+        "<n>/body" - body of the job response.
+        Each job result is sent as soon as it and all the jobs before it are finished.
+        """
+        if req.headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+            return HTTPBadRequest(request=req, body='Batch must be sent as application/json')
+        max_size = self.app.zerovm_maxconfig * self.app.zerovm_batch_max_jobs
+        if req.content_length is None:
+            return HTTPBadRequest(request=req, body='Must specify Content-Length')
+        if req.content_length > max_size:
+            return HTTPRequestEntityTooLarge(request=req)
+        try:
+            jobs = json.loads(req.body)
+        except Exception:
+            return HTTPUnprocessableEntity(request=req, body='Could not parse batch')
+        if not isinstance(jobs, list) or [job for job in jobs if not isinstance(job, list)]:
+            return HTTPUnprocessableEntity(request=req, body='Batch must be a list of cluster maps')
+        if len(jobs) > self.app.zerovm_batch_max_jobs:
+            return HTTPRequestEntityTooLarge(request=req,
+                                             body='Too many jobs in batch; max %d'
+                                                  % self.app.zerovm_batch_max_jobs)
+        # jobs are spawned by the pool in its own greenthread, results stream
+        # to the client while the rest of the jobs are waiting for their turn
+        pool = GreenPool(self.app.zerovm_batch_concurrency)
+        results = pool.imap(lambda job: self._execute_batch_job(req, path_parts, json.dumps(job)),
+                            jobs)
+        return Response(app_iter=iter(TarStream(path_list=_batch_results(results))),
+                        content_type=TAR_MIMES[0], request=req)
+
+    def _execute_batch_job(self, req, path_parts, cluster_config):
+        job_req = Request(req.environ.copy())
+        job_req.environ['wsgi.input'] = StringIO('')
+        # body and batch marker belong to the batch, not to the job
+        job_req.environ.pop('CONTENT_LENGTH', None)
+        job_req.headers.pop(self.app.zerovm_batch, None)
+        job_req.headers['x-trans-id'] = req.environ['swift.trans_id']
+        controller = self.get_controller(path_parts['account_name'],
+                                         path_parts['container_name'],
+                                         path_parts['object_name'])
+        controller.trans_id = req.environ['swift.trans_id']
+        controller.command = path_parts['version']
+        try:
+            return controller.POST(job_req, cluster_config=cluster_config)
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR executing batch job'))
+            return HTTPInternalServerError(request=job_req, body='Batch job failed')
+
 
 class ClusterController(ObjectController):
 
@@ -422,13 +949,11 @@ class ClusterController(ObjectController):
                                           self.app.zerovm_content_type,
                                           self.app.parser_config,
                                           self.middleware.list_account,
-                                          self.middleware.list_container)
+                                          self.middleware.list_container,
+                                          plan_cache=self.app.plan_cache)
 
     def get_daemon_socket(self, config):
-        for daemon_sock, daemon_conf in self.app.zerovm_daemons:
-            if can_run_as_daemon(config, daemon_conf):
-                return daemon_sock
-        return None
+        return self.app.zerovm_daemons.lookup(config)
 
     def get_random_partition(self):
         partition_count = self.app.object_ring.partition_count
@@ -449,13 +974,109 @@ class ClusterController(ObjectController):
                     break
         return addr
 
-    def _make_exec_requests(self, pile, exec_requests):
+    def _get_input_objects(self, node, sizes):
+        """
+        Lists all readable swift objects of the node with their sizes,
+        size is 1 if it is not known yet
+        """
+        channels = self._get_remote_objects(node)
+        if node.channels and is_swift_path(node.channels[0].path) \
+                and (node.channels[0].access & (ACCESS_READABLE | ACCESS_CDR)):
+            channels.insert(0, node.channels[0])
+        return [(ch.path, sizes.get(ch.path.path) or 1)
+                for ch in channels if ch.path.obj]
+
+    def _plan_placement(self, exec_requests, sizes):
+        """
+        Chooses object servers for all the nodes of the job at once
+
+        Candidate object servers are scored, in this order, by: host not yet
+        used by another replica of the same node, input bytes local to the server,
+        number of nodes of this job already placed on the server.
+        Nodes with the biggest inputs are placed first.
+
+        :param exec_requests: list of execution requests, one per node
+        :param sizes: dict of object path -> object size, for known objects
+
+        :returns dict of id(ZvmNode) -> (partition, list of ring nodes in order of preference)
+        """
+        ring = self.app.object_ring
+        load = {}
+        jobs = []
+        for exec_request in exec_requests:
+            node = exec_request.node
+            local_bytes = {}
+            candidates = {}
+            for path, size in self._get_input_objects(node, sizes):
+                partition, devs = ring.get_nodes(path.account, path.container, path.obj)
+                for dev in devs:
+                    key = _device_key(dev)
+                    candidates[key] = (partition, dev)
+                    local_bytes[key] = local_bytes.get(key, 0) + size
+            try:
+                account, container, obj = split_path(node.path_info, 3, 3, True)
+                partition, devs = ring.get_nodes(account, container, obj)
+                # local object must be on the object server that runs the node
+                candidates = dict([(_device_key(dev), (partition, dev)) for dev in devs])
+                group = [node]
+            except ValueError:
+                if not candidates:
+                    partition = self.get_random_partition()
+                    candidates = dict([(_device_key(dev), (partition, dev))
+                                       for dev in ring.get_part_nodes(partition)])
+                group = [node] + node.replicas
+            jobs.append((sum(local_bytes.values()), node, group, candidates, local_bytes))
+        jobs.sort(key=lambda job: job[0], reverse=True)
+        plan = {}
+        for _junk, node, group, candidates, local_bytes in jobs:
+            used_hosts = set()
+            for n in group:
+
+                def score(key):
+                    return (candidates[key][1]['ip'] not in used_hosts,
+                            local_bytes.get(key, 0),
+                            -load.get(key, 0))
+
+                order = sorted(candidates.keys(), key=score, reverse=True)
+                best = order[0]
+                load[best] = load.get(best, 0) + 1
+                used_hosts.add(candidates[best][1]['ip'])
+                if n is node:
+                    plan[id(n)] = (candidates[best][0], [candidates[dev_key][1] for dev_key in order])
+                else:
+                    plan[id(n)] = (candidates[best][0], [candidates[best][1]])
+            if node.replicate > 1 and len(group) == 1:
+                # replicas share one node iterator and take devices in planned order
+                for i in range(1, node.replicate):
+                    order = sorted(candidates.keys(),
+                                   key=lambda key: (candidates[key][1]['ip'] not in used_hosts,
+                                                    -load.get(key, 0)),
+                                   reverse=True)
+                    load[order[0]] = load.get(order[0], 0) + 1
+                    used_hosts.add(candidates[order[0]][1]['ip'])
+        return plan
+
+    def _preferred_nodes_first(self, preferred, node_iter):
+        seen = set()
+        for dev in preferred:
+            if self.app.error_limited(dev):
+                continue
+            seen.add(_device_key(dev))
+            yield dev
+        for dev in node_iter:
+            if _device_key(dev) not in seen:
+                yield dev
+
+    def _make_exec_requests(self, pile, exec_requests, sizes=None):
+        plan = self._plan_placement(exec_requests, sizes or {})
         for exec_request in exec_requests:
             node = exec_request.node
             try:
                 account, container, obj = split_path(node.path_info, 3, 3, True)
                 partition, nodes = self.app.object_ring.get_nodes(account, container, obj)
-                node_iter = GreenthreadSafeIterator(self.iter_nodes_local_first(self.app.object_ring, partition))
+                node_iter = GreenthreadSafeIterator(self._preferred_nodes_first(
+                    plan[id(node)][1],
+                    self.iter_nodes_local_first(self.app.object_ring, partition)))
                 exec_request.path_info = node.path_info
                 if node.replicate > 1:
                     container_info = self.container_info(account, container)
@@ -482,16 +1103,18 @@ class ClusterController(ObjectController):
                                exec_request, self.app.logger.thread_locals, node,
                                exec_request.headers)
             except ValueError:
-                partition = self.get_random_partition()
-                node_iter = self.iter_nodes_local_first(self.app.object_ring, partition)
+                partition, preferred = plan[id(node)]
+                node_iter = self._preferred_nodes_first(
+                    preferred, self.iter_nodes_local_first(self.app.object_ring, partition))
                 if node.skip_validation:
                     exec_request.headers['x-zerovm-valid'] = 'true'
                 pile.spawn(self._connect_exec_node, node_iter, partition,
                            exec_request, self.app.logger.thread_locals, node,
                            exec_request.headers)
                 for repl_node in node.replicas:
-                    partition = self.get_random_partition()
-                    node_iter = self.iter_nodes_local_first(self.app.object_ring, partition)
+                    partition, preferred = plan[id(repl_node)]
+                    node_iter = self._preferred_nodes_first(
+                        preferred, self.iter_nodes_local_first(self.app.object_ring, partition))
                     pile.spawn(self._connect_exec_node, node_iter, partition,
                                exec_request, self.app.logger.thread_locals, repl_node,
                                exec_request.headers)
@@ -501,7 +1124,6 @@ class ClusterController(ObjectController):
         for conn in conns:
             conn.failed = False
             conn.queue = Queue(self.app.put_queue_depth)
-            conn.tar_stream = TarStream()
             pool.spawn(self._send_file, conn, req.path)
 
     def _get_remote_objects(self, node):
@@ -519,12 +1141,17 @@ class ClusterController(ObjectController):
     def _create_request_for_remote_object(self, data_sources, channel, exe_resp, req, nexe_headers, node):
         source_resp = None
         load_from = channel.path.path
+        fetched = False
         for resp in data_sources:
             if resp.request and load_from == resp.request.path_info:
-                source_resp = resp
-                break
+                fetched = True
+                # node that reads one object into several channels gets a copy
+                # for each of them, tar members on one connection cannot interleave
+                if not any(n['node'] is node for n in resp.nodes):
+                    source_resp = resp
+                    break
         if not source_resp:
-            if exe_resp and load_from == exe_resp.request.path_info:
+            if exe_resp and load_from == exe_resp.request.path_info and not fetched:
                 source_resp = exe_resp
             else:
                 source_req = req.copy_get()
@@ -555,9 +1182,61 @@ class ClusterController(ObjectController):
         source_resp.nodes.append({'node': node, 'dev': channel.device})
         if source_resp.headers.get('x-zerovm-valid', None) and 'boot' in channel.device:
             node.skip_validation = True
+        boot_etag = None
+        if 'boot' in channel.device and _is_plain_object(source_resp):
+            boot_etag = source_resp.etag.strip('"')
+            node.boot_etag = boot_etag
         for repl_node in node.replicas:
             repl_node.last_data = source_resp
             source_resp.nodes.append({'node': repl_node, 'dev': channel.device})
+            if boot_etag:
+                repl_node.boot_etag = boot_etag
+
+    def _authorize_remote_object(self, channel, node, req, nexe_headers, sizes, remote_objects):
+        """
+        Checks that remote object can be read by the user, without fetching it
+
+        Used when object servers fetch remote inputs by themselves,
+        object size is stored in `sizes` for the placement planner.
+        Only plain objects with known size and etag are left to object servers:
+        channel of the node and of its replicas gets `remote` set to them.
+        Manifests are not, proxy must send them.
+        """
+        load_from = channel.path.path
+        if load_from not in remote_objects:
+            source_resp = self._head_object(req, load_from)
+            if source_resp.status_int >= 300:
+                update_headers(source_resp, nexe_headers)
+                source_resp.body = 'Error %s while fetching %s' \
+                                   % (source_resp.status, load_from)
+                return source_resp
+            sizes[load_from] = source_resp.content_length
+            remote_objects[load_from] = None
+            if _is_plain_object(source_resp):
+                remote_objects[load_from] = {'size': source_resp.content_length,
+                                             'etag': source_resp.etag}
+        remote = remote_objects[load_from]
+        if remote:
+            channel.remote = remote
+            for repl_node in node.replicas:
+                repl_node.get_channel(device=channel.device).remote = remote
+
+    def _head_object(self, req, load_from):
+        source_req = req.copy_get()
+        source_req.method = 'HEAD'
+        source_req.path_info = load_from
+        if source_req.environ.get('QUERY_STRING'):
+            source_req.environ['QUERY_STRING'] = ''
+        if self.app.zerovm_uses_newest:
+            source_req.headers['X-Newest'] = 'true'
+        acct, src_container_name, src_obj_name =\
+            split_path(load_from, 1, 3, True)
+        container_info = self.container_info(acct, src_container_name)
+        source_req.acl = container_info['read_acl']
+        return ObjectController(self.app,
+                                acct,
+                                src_container_name,
+                                src_obj_name).HEAD(source_req)
 
     @delay_denial
     @cors_validation
@@ -702,189 +1381,256 @@ class ClusterController(ObjectController):
             return HTTPServiceUnavailable(
                 body='Cannot find own address, check zerovm_ns_hostname')
         ns_server = None
+        ns_job = None
         if self.parser.total_count > 1:
-            ns_server = NameService(self.parser.total_count)
-            if self.app.zerovm_ns_thrdpool.free() <= 0:
-                return HTTPServiceUnavailable(body='Cluster slot not available',
-                                              request=req)
-            ns_server.start(self.app.zerovm_ns_thrdpool)
+            ns_server = self.middleware.get_name_service()
             if not ns_server.port:
                 return HTTPServiceUnavailable(body='Cannot bind name service')
-        exec_requests = []
-        for node in self.parser.node_list:
-            nexe_headers = {
-                'x-nexe-system': node.name,
-                'x-nexe-status': 'ZeroVM did not run',
-                'x-nexe-retcode': 0,
-                'x-nexe-etag': '',
-                'x-nexe-validation': 0,
-                'x-nexe-cdr-line': '0.0 0.0 0 0 0 0 0 0 0 0'
-            }
-            path_info = req.path_info
-            exec_request = Request.blank(path_info,
-                                         environ=req.environ,
-                                         headers=req.headers)
-            exec_request.path_info = path_info
-            #exec_request.content_length = None
-            exec_request.etag = None
-            exec_request.headers['content-type'] = TAR_MIMES[0]
-            #exec_request.headers['transfer-encoding'] = 'chunked'
-            exec_request.headers['x-account-name'] = self.account_name
-            exec_request.headers['x-timestamp'] = normalize_timestamp(time.time())
-            exec_request.headers['x-zerovm-valid'] = 'false'
-            exec_request.headers['x-zerovm-pool'] = 'default'
-            if len(node.connect) > 0 or len(node.bind) > 0:
-                # node operation depends on connection to other nodes
-                exec_request.headers['x-zerovm-pool'] = 'cluster'
-            if 'swift.authorize' in exec_request.environ:
-                aresp = exec_request.environ['swift.authorize'](exec_request)
-                if aresp:
-                    return aresp
-            if ns_server:
-                node.name_service = 'udp:%s:%d' % (addr, ns_server.port)
-                self.parser.build_connect_string(node)
-                if node.replicate > 1:
-                    for i in range(0, node.replicate - 1):
-                        node.replicas.append(deepcopy(node))
-                        node.replicas[i].id = node.id + (i + 1) * len(self.parser.node_list)
-            node.copy_cgi_env(exec_request)
-            resp = node.create_sysmap_resp()
-            node.add_data_source(data_sources, resp, 'sysmap')
-            for repl_node in node.replicas:
-                repl_node.copy_cgi_env(exec_request)
-                resp = repl_node.create_sysmap_resp()
-                repl_node.add_data_source(data_sources, resp, 'sysmap')
-            #print json.dumps(node, sort_keys=True, indent=2, cls=NodeEncoder)
-            channels = self._get_remote_objects(node)
-            for ch in channels:
-                error = self._create_request_for_remote_object(data_sources, ch,
-                                                               exe_resp, req,
-                                                               nexe_headers, node)
-                if error:
-                    return error
-            if user_image:
-                node.last_data = image_resp
-                image_resp.nodes.append({'node': node, 'dev': 'image'})
+            max_replicate = max([node.replicate for node in self.parser.node_list])
+            ns_job = ns_server.add_job(self.parser.total_count,
+                                       len(self.parser.node_list) * max_replicate)
+        try:
+            if ns_job:
+                # node ids must be unique among all the jobs of the name service
+                for node in self.parser.node_list:
+                    node.id += ns_job.base
+                self.parser.build_connect_strings()
+            exec_requests = []
+            sizes = {}
+            # remote object path -> its size and etag if object servers can fetch it
+            remote_objects = {}
+            sysmap_encoder = SysmapEncoder()
+            for node in self.parser.node_list:
+                nexe_headers = {
+                    'x-nexe-system': node.name,
+                    'x-nexe-status': 'ZeroVM did not run',
+                    'x-nexe-retcode': 0,
+                    'x-nexe-etag': '',
+                    'x-nexe-validation': 0,
+                    'x-nexe-cdr-line': '0.0 0.0 0 0 0 0 0 0 0 0'
+                }
+                path_info = req.path_info
+                exec_request = Request.blank(path_info,
+                                             environ=req.environ,
+                                             headers=req.headers)
+                exec_request.path_info = path_info
+                #exec_request.content_length = None
+                exec_request.etag = None
+                exec_request.headers['content-type'] = TAR_MIMES[0]
+                #exec_request.headers['transfer-encoding'] = 'chunked'
+                exec_request.headers['x-account-name'] = self.account_name
+                exec_request.headers['x-timestamp'] = normalize_timestamp(time.time())
+                exec_request.headers['x-zerovm-valid'] = 'false'
+                exec_request.headers['x-zerovm-pool'] = 'default'
+                if 'x-zerovm-boot-etag' in exec_request.headers:
+                    del exec_request.headers['x-zerovm-boot-etag']
+                if len(node.connect) > 0 or len(node.bind) > 0:
+                    # node operation depends on connection to other nodes
+                    exec_request.headers['x-zerovm-pool'] = 'cluster'
+                if 'swift.authorize' in exec_request.environ:
+                    aresp = exec_request.environ['swift.authorize'](exec_request)
+                    if aresp:
+                        return aresp
+                if ns_server:
+                    node.name_service = 'udp:%s:%d' % (addr, ns_server.port)
+                    if node.replicate > 1:
+                        for i in range(0, node.replicate - 1):
+                            node.replicas.append(node.copy(node.id + (i + 1) * len(self.parser.node_list)))
+                channels = self._get_remote_objects(node)
+                if self.app.zerovm_remote_fetch:
+                    # channels of plain objects are marked in sysmap, object servers will fetch them
+                    for ch in channels:
+                        if 'boot' not in ch.device:
+                            error = self._authorize_remote_object(ch, node, req, nexe_headers,
+                                                                  sizes, remote_objects)
+                            if error:
+                                return error
+                node.copy_cgi_env(exec_request)
+                resp = node.create_sysmap_resp(sysmap_encoder)
+                node.add_data_source(data_sources, resp, 'sysmap')
                 for repl_node in node.replicas:
-                    repl_node.last_data = image_resp
-                    image_resp.nodes.append({'node': repl_node, 'dev': 'image'})
-            if not getattr(node, 'path_info', None):
-                node.path_info = path_info
-            exec_request.node = node
-            exec_request.resp_headers = nexe_headers
-            sock = self.get_daemon_socket(node)
-            if sock:
-                exec_request.headers['x-zerovm-daemon'] = str(sock)
-            exec_requests.append(exec_request)
-
-        if user_image:
-            data_sources.append(image_resp)
-        tstream = TarStream()
-        for data_src in data_sources:
-            for n in data_src.nodes:
-                if not getattr(n['node'], 'size', None):
-                    n['node'].size = 0
-                n['node'].size += len(tstream.create_tarinfo(ftype=REGTYPE, name=n['dev'],
-                                                             size=data_src.content_length))
-                n['node'].size += TarStream.get_archive_size(data_src.content_length)
-        pile = GreenPile(self.parser.total_count)
-        conns = self._make_exec_requests(pile, exec_requests)
-        if len(conns) < self.parser.total_count:
-            self.app.logger.exception(
-                _('ERROR Cannot find suitable node to execute code on'))
-            return HTTPServiceUnavailable(
-                body='Cannot find suitable node to execute code on')
-
-        for conn in conns:
-            if getattr(conn, 'error', None):
-                return Response(body=conn.error,
-                                status="%d %s" % (conn.resp.status, conn.resp.reason),
-                                headers=conn.nexe_headers)
+                    repl_node.copy_cgi_env(exec_request)
+                    resp = repl_node.create_sysmap_resp(sysmap_encoder)
+                    repl_node.add_data_source(data_sources, resp, 'sysmap')
+                #print json.dumps(node, sort_keys=True, indent=2, cls=NodeEncoder)
+                for ch in channels:
+                    if getattr(ch, 'remote', None):
+                        continue
+                    error = self._create_request_for_remote_object(data_sources, ch,
+                                                                   exe_resp, req,
+                                                                   nexe_headers, node)
+                    if error:
+                        return error
+                if user_image:
+                    node.last_data = image_resp
+                    image_resp.nodes.append({'node': node, 'dev': 'image'})
+                    for repl_node in node.replicas:
+                        repl_node.last_data = image_resp
+                        image_resp.nodes.append({'node': repl_node, 'dev': 'image'})
+                if not getattr(node, 'path_info', None):
+                    node.path_info = path_info
+                exec_request.node = node
+                exec_request.resp_headers = nexe_headers
+                sock = self.get_daemon_socket(node)
+                if sock:
+                    exec_request.headers['x-zerovm-daemon'] = str(sock)
+                exec_requests.append(exec_request)
 
-        _attach_connections_to_data_sources(conns, data_sources)
+            if user_image:
+                data_sources.append(image_resp)
+            tstream = TarStream()
+            for data_src in data_sources:
+                for n in data_src.nodes:
+                    if not getattr(n['node'], 'size', None):
+                        n['node'].size = 0
+                    member_size = len(tstream.create_tarinfo(ftype=REGTYPE, name=n['dev'],
+                                                             size=data_src.content_length))
+                    member_size += TarStream.get_archive_size(data_src.content_length)
+                    n['node'].size += member_size
+                    if n['dev'] == 'boot':
+                        n['node'].boot_size = member_size
+            for data_src in data_sources:
+                if getattr(data_src, 'request', None) and data_src.content_length:
+                    sizes[data_src.request.path_info] = data_src.content_length
+            pile = GreenPile(self.parser.total_count)
+            conns = self._make_exec_requests(pile, exec_requests, sizes)
+            if len(conns) < self.parser.total_count:
+                self.app.logger.exception(
+                    _('ERROR Cannot find suitable node to execute code on'))
+                return HTTPServiceUnavailable(
+                    body='Cannot find suitable node to execute code on')
 
-        #chunked = req.headers.get('transfer-encoding')
-        chunked = False
-        try:
-            with ContextPool(self.parser.total_count) as pool:
-                self._spawn_file_senders(conns, pool, req)
-                for data_src in data_sources:
-                    data_src.bytes_transferred = 0
-                    _send_tar_headers(chunked, data_src)
-                    while True:
-                        with ChunkReadTimeout(self.app.client_timeout):
-                            try:
-                                data = next(data_src.app_iter)
-                            except StopIteration:
-                                error = _finalize_tar_streams(chunked, data_src, req)
-                                if error:
-                                    return error
-                                break
-                        error = _send_data_chunk(chunked, data_src, data, req)
-                        if error:
-                            return error
-                    if data_src.bytes_transferred < data_src.content_length:
-                        return HTTPClientDisconnect(request=req, body='data source %s dead' % data_src.__dict__)
-                for conn in conns:
-                    if conn.queue.unfinished_tasks:
-                        conn.queue.join()
-                    conn.tar_stream = None
-        except ChunkReadTimeout, err:
-            self.app.logger.warn(
-                _('ERROR Client read timeout (%ss)'), err.seconds)
-            self.app.logger.increment('client_timeouts')
-            return HTTPRequestTimeout(request=req)
-        except (Exception, Timeout):
-            print traceback.format_exc()
-            self.app.logger.exception(
-                _('ERROR Exception causing client disconnect'))
-            return HTTPClientDisconnect(request=req, body='exception')
+            for conn in conns:
+                if getattr(conn, 'error', None):
+                    return Response(body=conn.error,
+                                    status="%d %s" % (conn.resp.status, conn.resp.reason),
+                                    headers=conn.nexe_headers)
+
+            _attach_connections_to_data_sources(conns, data_sources)
+            # executables that are cached on all their target nodes are not sent at all
+            for data_src in data_sources:
+                if not data_src.conns and hasattr(data_src.app_iter, 'close'):
+                    data_src.app_iter.close()
+            data_sources = [data_src for data_src in data_sources if data_src.conns]
+
+            #chunked = req.headers.get('transfer-encoding')
+            chunked = False
+            _schedule_data_sources(conns, data_sources)
+            try:
+                with ContextPool(self.parser.total_count) as pool:
+                    self._spawn_file_senders(conns, pool, req)
+                    with ContextPool(len(data_sources)) as src_pool:
+                        src_pile = GreenPile(src_pool)
+                        for data_src in data_sources:
+                            src_pile.spawn(self._send_data_source, data_src, chunked, req)
+                        for error in src_pile:
+                            if error:
+                                return error
+                    for conn in conns:
+                        if conn.queue.unfinished_tasks:
+                            conn.queue.join()
+            except ChunkReadTimeout, err:
+                self.app.logger.warn(
+                    _('ERROR Client read timeout (%ss)'), err.seconds)
+                self.app.logger.increment('client_timeouts')
+                return HTTPRequestTimeout(request=req)
+            except (Exception, Timeout):
+                print traceback.format_exc()
+                self.app.logger.exception(
+                    _('ERROR Exception causing client disconnect'))
+                return HTTPClientDisconnect(request=req, body='exception')
 
-        for conn in conns:
-            pile.spawn(self._process_response, conn, req)
+            for conn in conns:
+                pile.spawn(self._process_response, conn, req)
 
-        conns = [conn for conn in pile if conn]
-        final_body = None
-        final_response = Response(request=req)
-        req.cdr_log = []
-        for conn in conns:
-            resp = conn.resp
-            if resp:
-                for key in conn.nexe_headers.keys():
-                    if resp.headers.get(key):
-                        conn.nexe_headers[key] = resp.headers.get(key)
-            if conn.error:
-                conn.nexe_headers['x-nexe-error'] = \
-                    conn.error.replace('\n', '')
-
-            #print [final_response.headers, conn.nexe_headers]
-            self._store_accounting_data(req, conn)
-            merge_headers(final_response.headers, conn.nexe_headers)
-            if resp and resp.headers.get('x-zerovm-daemon', None):
-                final_response.headers['x-nexe-cached'] = 'true'
-            if resp and resp.content_length > 0:
-                if final_body:
-                    final_body.append(resp.app_iter)
-                    final_response.content_length += resp.content_length
-                else:
-                    final_body = FinalBody(resp.app_iter)
-                    final_response.app_iter = final_body
-                    final_response.content_length = resp.content_length
-                    final_response.content_type = resp.content_type
-        if ns_server:
-            ns_server.stop()
-        if self.app.zerovm_accounting_enabled:
-            self.app.zerovm_ns_thrdpool.spawn_n(self._store_accounting_data, req)
-        if self.app.zerovm_use_cors and self.container_name:
-            container_info = self.container_info(self.account_name, self.container_name)
-            if container_info.get('cors', None):
-                if container_info['cors'].get('allow_origin', None):
-                    final_response.headers['access-control-allow-origin'] = container_info['cors']['allow_origin']
-                if container_info['cors'].get('expose_headers', None):
-                    final_response.headers['access-control-expose-headers'] = container_info['cors']['expose_headers']
-        etag = md5(str(time.time()))
-        final_response.headers['Etag'] = etag.hexdigest()
-        return final_response
+            conns = [conn for conn in pile if conn]
+            final_body = None
+            final_response = Response(request=req)
+            req.cdr_log = []
+            for conn in conns:
+                resp = conn.resp
+                if resp:
+                    for key in conn.nexe_headers.keys():
+                        if resp.headers.get(key):
+                            conn.nexe_headers[key] = resp.headers.get(key)
+                if conn.error:
+                    conn.nexe_headers['x-nexe-error'] = \
+                        conn.error.replace('\n', '')
+
+                #print [final_response.headers, conn.nexe_headers]
+                self._store_accounting_data(req, conn)
+                merge_headers(final_response.headers, conn.nexe_headers)
+                if resp and resp.headers.get('x-zerovm-daemon', None):
+                    final_response.headers['x-nexe-cached'] = 'true'
+                if resp and resp.content_length > 0:
+                    if final_body:
+                        final_body.append(resp.app_iter)
+                        final_response.content_length += resp.content_length
+                    else:
+                        final_body = FinalBody(resp.app_iter)
+                        final_response.app_iter = final_body
+                        final_response.content_length = resp.content_length
+                        final_response.content_type = resp.content_type
+            if self.app.zerovm_accounting_enabled:
+                self.app.zerovm_ns_thrdpool.spawn_n(self._store_accounting_data, req)
+            if self.app.zerovm_use_cors and self.container_name:
+                container_info = self.container_info(self.account_name, self.container_name)
+                if container_info.get('cors', None):
+                    if container_info['cors'].get('allow_origin', None):
+                        final_response.headers['access-control-allow-origin'] = container_info['cors']['allow_origin']
+                    if container_info['cors'].get('expose_headers', None):
+                        final_response.headers['access-control-expose-headers'] = container_info['cors']['expose_headers']
+            etag = md5(str(time.time()))
+            final_response.headers['Etag'] = etag.hexdigest()
+            return final_response
+        finally:
+            # job is released on every return, not only after a successful run
+            if ns_job:
+                ns_server.remove_job(ns_job)
+
+    def _send_data_source(self, data_src, chunked, req):
+        """
+        Streams one data source to all of its connections
+
+        Data is prefetched, up to zerovm_source_prefetch chunks, until every
+        connection that gets this data source has finished all the data sources
+        queued before it, then the data source is sent as one tar member.
+        """
+        data_src.bytes_transferred = 0
+        prefetched = []
+        eof = False
+        while not eof and not data_src.ready.ready() \
+                and len(prefetched) < self.app.zerovm_source_prefetch:
+            with ChunkReadTimeout(self.app.client_timeout):
+                try:
+                    prefetched.append(next(data_src.app_iter))
+                except StopIteration:
+                    eof = True
+        with Timeout(self.app.zerovm_source_wait_timeout, False):
+            data_src.ready.wait()
+        if not data_src.ready.ready():
+            return HTTPRequestTimeout(request=req,
+                                      body='Timeout waiting for earlier job inputs to be sent')
+        _send_tar_headers(chunked, data_src)
+        for data in prefetched:
+            error = _send_data_chunk(chunked, data_src, data, req)
+            if error:
+                return error
+        while not eof:
+            with ChunkReadTimeout(self.app.client_timeout):
+                try:
+                    data = next(data_src.app_iter)
+                except StopIteration:
+                    break
+            error = _send_data_chunk(chunked, data_src, data, req)
+            if error:
+                return error
+        error = _finalize_tar_streams(chunked, data_src, req)
+        if error:
+            return error
+        if data_src.bytes_transferred < data_src.content_length:
+            return HTTPClientDisconnect(request=req, body='data source %s dead' % data_src.__dict__)
+        _advance_data_sources(data_src)
 
     def _process_response(self, conn, request):
         conn.error = None
@@ -902,6 +1648,10 @@ class ClusterController(ObjectController):
             #conn.resp = HTTPClientDisconnect(body=conn.path,
             #    headers=conn.nexe_headers)
             return conn
+        boot_etag = getattr(conn.cnode, 'boot_etag', None)
+        if boot_etag:
+            self._update_nexe_cache_hint(conn.node, boot_etag,
+                                         server_response.getheader('x-zerovm-nexe-cached') == boot_etag)
         if server_response.status != 200:
             conn.error = '%d %s %s' % \
                          (server_response.status,
@@ -941,7 +1691,7 @@ class ClusterController(ObjectController):
                 if not chan.path:
                     app_iter = iter(CachedBody(
                         untar_stream.tar_iter,
-                        cache=[untar_stream.block[info.offset_data:]],
+                        cache=untar_stream.get_buffered_chunks(info.offset_data),
                         total_size=info.size))
                     resp.app_iter = app_iter
                     resp.content_length = info.size
@@ -984,14 +1734,21 @@ class ClusterController(ObjectController):
     def _connect_exec_node(self, obj_nodes, part, request,
                            logger_thread_locals, cnode, request_headers):
         self.app.logger.thread_locals = logger_thread_locals
+        boot_etag = getattr(cnode, 'boot_etag', None)
         for node in obj_nodes:
             try:
+                boot_cached = boot_etag and self._is_nexe_cached(node, boot_etag)
                 with ConnectionTimeout(self.app.conn_timeout):
                     #if (request.content_length > 0) or 'transfer-encoding' in request_headers:
                     #    request_headers['Expect'] = '100-continue'
                     request.headers['Connection'] = 'close'
                     request_headers['Expect'] = '100-continue'
-                    request_headers['Content-Length'] = str(cnode.size)
+                    if boot_etag:
+                        request_headers['x-zerovm-boot-etag'] = boot_etag
+                    if boot_cached:
+                        request_headers['Content-Length'] = str(cnode.size - cnode.boot_size)
+                    else:
+                        request_headers['Content-Length'] = str(cnode.size)
                     conn = http_connect(node['ip'], node['port'],
                                         node['device'], part, request.method,
                                         request.path_info, request_headers)
@@ -999,6 +1756,7 @@ class ClusterController(ObjectController):
                     resp = conn.getexpect()
                 conn.node = node
                 conn.cnode = cnode
+                conn.boot_cached = boot_cached
                 conn.nexe_headers = request.resp_headers
                 if resp.status == HTTP_CONTINUE:
                     conn.resp = None
@@ -1018,6 +1776,25 @@ class ClusterController(ObjectController):
                 self.exception_occurred(node, _('Object'),
                                         _('Expect: 100-continue on %s') % request.path_info)
 
+    def _is_nexe_cached(self, node, etag):
+        key = (_device_key(node), etag)
+        if key in self.app.nexe_cache_hints:
+            # refresh LRU position
+            self.app.nexe_cache_hints[key] = self.app.nexe_cache_hints.pop(key)
+            return True
+        return False
+
+    def _update_nexe_cache_hint(self, node, etag, cached):
+        """Remembers whether object server device reported the executable as cached"""
+        if self.app.zerovm_nexe_cache_hints <= 0:
+            return
+        key = (_device_key(node), etag)
+        self.app.nexe_cache_hints.pop(key, None)
+        if cached:
+            self.app.nexe_cache_hints[key] = True
+            while len(self.app.nexe_cache_hints) > self.app.zerovm_nexe_cache_hints:
+                self.app.nexe_cache_hints.popitem(last=False)
+
     def _store_accounting_data(self, request, connection=None):
         txn_id = request.environ['swift.trans_id']
         acc_object = datetime.datetime.utcnow().strftime('%Y/%m/%d.log')
@@ -1104,7 +1881,82 @@ class ClusterController(ObjectController):
         exe_resp = None
         if obj_req.method in 'GET':
             exe_resp = obj_resp
-        return self.POST(post_req, exe_resp=exe_resp, cluster_config=config)
+        result_cache = self._get_result_cache(req)
+        cache_key = None
+        if result_cache:
+            cache_key = self._result_cache_key(req, config, location, obj_resp)
+        if cache_key:
+            entry = result_cache.get(cache_key)
+            if entry:
+                if exe_resp and hasattr(exe_resp.app_iter, 'close'):
+                    exe_resp.app_iter.close()
+                # same check as the execution requests of the job would pass
+                if 'swift.authorize' in post_req.environ:
+                    auth_req = Request.blank(post_req.path_info,
+                                             environ=post_req.environ,
+                                             headers=post_req.headers)
+                    aresp = post_req.environ['swift.authorize'](auth_req)
+                    if aresp:
+                        return aresp
+                return _result_cache_response(entry, req)
+        resp = self.POST(post_req, exe_resp=exe_resp, cluster_config=config)
+        if cache_key and _is_cacheable_result(resp, self.app.zerovm_result_cache_max_item):
+            content_length = resp.content_length
+            body_iter = resp.app_iter if resp.app_iter is not None else [resp.body]
+            resp.app_iter = _cache_result_iter(result_cache, cache_key,
+                                               resp.status, resp.headers.items(), body_iter,
+                                               self.app.zerovm_result_cache_max_item)
+            resp.content_length = content_length
+        return resp
+
+    def _get_result_cache(self, req):
+        if self.app.zerovm_result_cache == 'disk':
+            return self.app.result_cache_disk
+        if self.app.zerovm_result_cache == 'memcache':
+            memcache_client = cache_from_env(req.environ)
+            if memcache_client:
+                return MemcacheResultCache(memcache_client, self.app.zerovm_result_cache_ttl)
+        return None
+
+    def _result_cache_key(self, req, config, location, obj_resp):
+        """
+        Returns result cache key of the job, or None if job cannot be cached
+
+        Key covers the cluster map (executable paths, args, env),
+        ETags of all the Swift objects it reads and the whole CGI environment
+        executables get from the request, including the remote user and address.
+        Jobs that write to Swift objects, use wildcards or external network are never cached.
+        Each object is checked with a HEAD request, with the user's credentials.
+        """
+        try:
+            cluster_config = json.loads(config)
+        except Exception:
+            return None
+        if not isinstance(cluster_config, list):
+            return None
+        etags = {location.path: obj_resp.headers.get('etag')}
+        for node in cluster_config:
+            if not isinstance(node, dict) or node.get('count', 1) != 1:
+                return None
+            paths = [(None, node.get('exec', {}).get('path'))]
+            paths.extend([(f.get('device'), f.get('path'))
+                          for f in node.get('file_list', []) if isinstance(f, dict)])
+            for device, url in paths:
+                if not url:
+                    continue
+                if '*' in url or DEVICE_MAP.get(device, 0) & ACCESS_WRITABLE:
+                    return None
+                path = parse_location(url)
+                if is_swift_path(path):
+                    if path.path not in etags:
+                        head_resp = self._head_object(req, path.path)
+                        if not is_success(head_resp.status_int):
+                            return None
+                        etags[path.path] = head_resp.headers.get('etag')
+                elif not is_image_path(path) and not is_zvm_path(path):
+                    return None
+        cgi = sorted(request_cgi_env(req).items())
+        return md5(json.dumps([config, sorted(etags.items()), cgi])).hexdigest()
 
     def _get_content_config(self, req, content_type):
         req.template = None
@@ -1144,8 +1996,8 @@ def _load_channel_data(node, extracted_file):
         if old_ch:
             old_ch.content_type = new_ch['content_type']
             if new_ch.get('meta', None):
-                for k, v in new_ch.get('meta').iteritems():
-                    old_ch.meta[k] = v
+                # meta data dict can be shared with other copies of the channel
+                old_ch.meta = dict(old_ch.meta, **new_ch.get('meta'))
 
 
 def _total_node_count(node_list):
@@ -1173,59 +2025,230 @@ def _attach_connections_to_data_sources(conns, data_sources):
         for node in data_src.nodes:
             for conn in conns:
                 if conn.cnode is node['node']:
-                    conn.last_data = node['node'].last_data
+                    if node['dev'] == 'boot' and getattr(conn, 'boot_cached', False):
+                        continue
+                    conn.last_data = data_src
                     data_src.conns.append({'conn': conn, 'dev': node['dev']})
+        # tar framing is done once per device name, all connections
+        # that get the data source under this name share the same chunks
+        data_src.streams = []
+        by_dev = {}
+        for conn in data_src.conns:
+            stream = by_dev.get(conn['dev'])
+            if not stream:
+                stream = {'dev': conn['dev'],
+                          'tar_stream': TarStream(),
+                          'conns': []}
+                by_dev[conn['dev']] = stream
+                data_src.streams.append(stream)
+            stream['conns'].append(conn['conn'])
 
 
-def _queue_put(conn, data, chunked):
-    conn['conn'].queue.put('%x\r\n%s\r\n'
-                           % (len(data), data) if chunked else data)
+def _schedule_data_sources(conns, data_sources):
+    """
+    Orders data sources per connection, each connection receives its data
+    sources in the order of data_sources list. A data source becomes ready
+    when it is the next one to be sent on all its connections.
+    """
+    for conn in conns:
+        conn.data_sources = []
+    for data_src in data_sources:
+        data_src.ready = Event()
+        # connection can get the same data source under several device names,
+        # data source is still queued and counted only once for it
+        data_src.queued_conns = []
+        seen = set()
+        for conn in data_src.conns:
+            if id(conn['conn']) not in seen:
+                seen.add(id(conn['conn']))
+                data_src.queued_conns.append(conn['conn'])
+                conn['conn'].data_sources.append(data_src)
+        data_src.waiting = len(data_src.queued_conns)
+    for conn in conns:
+        if conn.data_sources:
+            conn.data_sources[0].waiting -= 1
+    for data_src in data_sources:
+        if data_src.waiting <= 0:
+            data_src.ready.send()
+
+
+def _advance_data_sources(data_src):
+    for conn in data_src.queued_conns:
+        conn.data_sources.pop(0)
+        if conn.data_sources:
+            next_src = conn.data_sources[0]
+            next_src.waiting -= 1
+            if next_src.waiting <= 0:
+                next_src.ready.send()
+
+
+def _queue_put(conns, data, chunked):
+    if chunked:
+        data = '%x\r\n%s\r\n' % (len(data), data)
+    failed = False
+    for conn in conns:
+        if conn.failed:
+            failed = True
+        else:
+            conn.queue.put(data)
+    return failed
 
 
 def _send_tar_headers(chunked, data_src):
-    for conn in data_src.conns:
-        info = conn['conn'].tar_stream.create_tarinfo(ftype=REGTYPE,
-                                                      name=conn['dev'],
-                                                      size=data_src.content_length)
-        for chunk in conn['conn'].tar_stream.serve_chunk(info):
-            if not conn['conn'].failed:
-                _queue_put(conn, chunk, chunked)
+    for stream in data_src.streams:
+        info = stream['tar_stream'].create_tarinfo(ftype=REGTYPE,
+                                                   name=stream['dev'],
+                                                   size=data_src.content_length)
+        for chunk in stream['tar_stream'].serve_chunk(info):
+            _queue_put(stream['conns'], chunk, chunked)
 
 
 def _send_data_chunk(chunked, data_src, data, req):
     data_src.bytes_transferred += len(data)
     if data_src.bytes_transferred > MAX_FILE_SIZE:
         return HTTPRequestEntityTooLarge(request=req)
-    for conn in data_src.conns:
-        for chunk in conn['conn'].tar_stream.serve_chunk(data):
-            if not conn['conn'].failed:
-                _queue_put(conn, chunk, chunked)
-            else:
+    for stream in data_src.streams:
+        for chunk in stream['tar_stream'].serve_chunk(data):
+            if _queue_put(stream['conns'], chunk, chunked):
                 return HTTPServiceUnavailable(request=req)
 
 
 def _finalize_tar_streams(chunked, data_src, req):
     blocks, remainder = divmod(data_src.bytes_transferred, BLOCKSIZE)
-    if remainder > 0:
-        nulls = NUL * (BLOCKSIZE - remainder)
-        for conn in data_src.conns:
-            for chunk in conn['conn'].tar_stream.serve_chunk(nulls):
-                if not conn['conn'].failed:
-                    _queue_put(conn, chunk, chunked)
-                else:
+    for stream in data_src.streams:
+        if remainder > 0:
+            nulls = NUL * (BLOCKSIZE - remainder)
+            for chunk in stream['tar_stream'].serve_chunk(nulls):
+                if _queue_put(stream['conns'], chunk, chunked):
                     return HTTPServiceUnavailable(request=req)
+        if stream['tar_stream'].data:
+            if _queue_put(stream['conns'], stream['tar_stream'].data, chunked):
+                return HTTPServiceUnavailable(request=req)
     for conn in data_src.conns:
         if conn['conn'].last_data is data_src:
-            if conn['conn'].tar_stream.data:
-                data = conn['conn'].tar_stream.data
-                if not conn['conn'].failed:
-                    _queue_put(conn, data, chunked)
-                else:
-                    return HTTPServiceUnavailable(request=req)
             if chunked:
                 conn['conn'].queue.put('0\r\n\r\n')
 
 
+def _result_cache_expires(entry):
+    try:
+        return json.loads(entry[:entry.index('\n')])['expires']
+    except Exception:
+        return 0
+
+
+def _result_cache_response(entry, req):
+    offset = entry.index('\n')
+    meta = json.loads(entry[:offset])
+    headers = [(str(k), str(v)) for k, v in meta['headers']]
+    resp = Response(request=req, status=str(meta['status']), headers=headers,
+                    body=entry[offset + 1:])
+    resp.headers['x-zerovm-result-cached'] = 'true'
+    return resp
+
+
+def _is_cacheable_result(resp, max_size):
+    if resp.status_int != 200 or 'x-nexe-error' in resp.headers:
+        return False
+    retcodes = resp.headers.get('x-nexe-retcode', '0').split(',')
+    if [code for code in retcodes if code.strip() != '0']:
+        return False
+    if resp.content_length is not None and resp.content_length > max_size:
+        return False
+    return True
+
+
+def _cache_result_iter(result_cache, cache_key, status, headers, body_iter, max_size):
+    headers = [(k, v) for k, v in headers
+               if k.lower() != 'transfer-encoding']
+    body = []
+    size = 0
+    for chunk in body_iter:
+        if body is not None:
+            size += len(chunk)
+            if size > max_size:
+                body = None
+            else:
+                body.append(chunk)
+        yield chunk
+    if body is not None:
+        meta = json.dumps({'status': status,
+                           'headers': headers,
+                           'expires': time.time() + result_cache.ttl})
+        result_cache.put(cache_key, '%s\n%s' % (meta, ''.join(body)))
+
+
+def _iter_listing(get_page, mask, marker, skip_dirs=False):
+    page = get_page(marker)
+    while page:
+        last = page[-1]
+        next_page = spawn(get_page, last.get('name', last.get('subdir')))
+        for item in page:
+            name = item.get('name', item.get('subdir'))
+            if skip_dirs and name[-1] == '/':
+                continue
+            if not mask or mask.match(name):
+                yield name
+        page = next_page.wait()
+
+
+def _cache_listing_iter(memcache_client, cache_key, validator, names, mask, max_items, ttl):
+    cached = []
+    for name in names:
+        if cached is not None:
+            cached.append(name)
+            if len(cached) > max_items:
+                cached = None
+        if not mask or mask.match(name):
+            yield name
+    if cached is not None:
+        memcache_client.set(cache_key, {'validator': validator, 'names': cached}, time=ttl)
+
+
+def _batch_results(results):
+    for n, resp in enumerate(results):
+        if resp.content_length is None or resp.app_iter is None:
+            app_iter = [resp.body]
+            size = len(resp.body)
+        else:
+            app_iter = _exact_size_iter(resp.app_iter, resp.content_length)
+            size = resp.content_length
+        headers = json.dumps({'status': resp.status,
+                              'headers': dict(resp.headers.items())})
+        yield Path(REGTYPE, '%d/headers' % n, len(headers), [headers])
+        yield Path(REGTYPE, '%d/body' % n, size, app_iter)
+
+
+def _exact_size_iter(app_iter, size):
+    """
+    Yields app_iter, raises if it has not exactly size bytes,
+    tar member header is already sent, so the stream cannot be fixed
+    """
+    sent = 0
+    for chunk in app_iter:
+        sent += len(chunk)
+        if sent > size:
+            raise Exception('Batch job body is longer than %d bytes' % size)
+        yield chunk
+    if sent < size:
+        raise Exception('Batch job body is shorter than %d bytes' % size)
+
+
+def _is_plain_object(resp):
+    """
+    Returns True if response is for a single object, not a manifest,
+    with known size and etag, object servers can fetch it by themselves
+    """
+    if resp.headers.get('x-object-manifest') \
+            or resp.headers.get('x-static-large-object', '').lower() in TRUE_VALUES:
+        return False
+    return resp.content_length is not None and bool(resp.etag)
+
+
+def _device_key(dev):
+    return dev['ip'], dev['port'], dev['device']
+
+
 def _get_local_address(node):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.connect((node['ip'], node['port']))
@@ -11,6 +11,7 @@ import struct
 import copy
 import re
 import operator
+from collections import deque
 
 try:
     import grp, pwd
@@ -948,20 +949,51 @@ class TarStream(object):
         self.format = format
         self.encoding = encoding
         self.to_write = self.chunk_size
-        self.data = ''
+        self.buffers = []
         self.file_len = 0
         self.append = append
 
+    @property
+    def data(self):
+        """Bytes queued for the next chunk, not yet served."""
+        if len(self.buffers) > 1:
+            self.buffers = [''.join(self.buffers)]
+        if self.buffers:
+            return self.buffers[0]
+        return ''
+
+    @property
+    def data_len(self):
+        return self.chunk_size - self.to_write
+
     def serve_chunk(self, buf):
-        self.to_write -= len(buf)
-        if self.to_write < 0:
-            self.data += buf[:self.to_write]
+        """Queue buf and yield every full chunk that it completes.
+
+        Incoming buffers are kept in a list and joined once when a chunk
+        is ready, so bytes already queued are never copied again, whatever
+        the size of the incoming pieces.
+        """
+        size = len(buf)
+        self.to_write -= size
+        if self.to_write >= 0:
+            if size:
+                self.buffers.append(buf)
+            return
+        # head of buf completes the pending chunk
+        offset = size + self.to_write
+        if offset:
+            self.buffers.append(buf[:offset])
+        chunk = ''.join(self.buffers)
+        self.buffers = []
+        self.file_len += self.chunk_size
+        yield chunk
+        # whole chunks contained in buf go out as single slices
+        while size - offset > self.chunk_size:
             self.file_len += self.chunk_size
-            yield self.data
-            self.data = buf[self.to_write:]
-            self.to_write += self.chunk_size
-        else:
-            self.data += buf
+            yield buf[offset:offset + self.chunk_size]
+            offset += self.chunk_size
+        self.buffers.append(buf[offset:])
+        self.to_write = self.chunk_size - (size - offset)
 
     def create_tarinfo(self, path=None, ftype=None, name=None, size=None):
         tarinfo = TarInfo()
@@ -1004,7 +1036,7 @@ class TarStream(object):
             for file_data in path:
                 for chunk in self.serve_chunk(file_data):
                     yield chunk
-            self.file_len += len(self.data)
+            self.file_len += self.data_len
             blocks, remainder = divmod(self.file_len, BLOCKSIZE)
             if remainder > 0:
                 nulls = NUL * (BLOCKSIZE - remainder)
@@ -1031,34 +1063,39 @@ class ExtractedFile(object):
 
     def read(self, size=None):
         if size is None:
-            size = self.untar_stream.to_write
-
-        if size:
-            if self.untar_stream.to_write:
-                while len(self.data) < size:
-                    chunk = self.untar_stream.get_file_chunk()
-                    if not chunk:
-                        result = self.data[:]
-                        self.data = ''
-                        return result
-                    self.data += chunk
-                    if self.untar_stream.to_write:
-                        self.untar_stream.block = ''
-                        try:
-                            data = next(self.untar_stream.tar_iter)
-                        except StopIteration:
-                            result = self.data[:]
-                            self.data = ''
-                            return result
-                        self.untar_stream.update_buffer(data)
-            else:
-                result = self.data[:]
-                self.data = ''
-                return result
+            size = len(self.data) + self.untar_stream.to_write
+        if len(self.data) >= size:
+            # leftover of the previous read is enough, chunks are clamped below
             result = self.data[:size]
             self.data = self.data[size:]
             return result
-        return ''
+        pieces = []
+        length = len(self.data)
+        if self.data:
+            pieces.append(self.data)
+            self.data = ''
+        while length < size and self.untar_stream.to_write:
+            chunk = self.untar_stream.get_file_chunk()
+            if not chunk:
+                try:
+                    data = next(self.untar_stream.tar_iter)
+                except StopIteration:
+                    break
+                self.untar_stream.update_buffer(data)
+                continue
+            length += len(chunk)
+            if length > size:
+                # keep the tail for the next read, split only the last chunk
+                cut = len(chunk) - (length - size)
+                self.data = chunk[cut:]
+                chunk = chunk[:cut]
+                length = size
+            pieces.append(chunk)
+        if len(pieces) == 1:
+            result = pieces[0]
+        else:
+            result = ''.join(pieces)
+        return result
 
 
 class UntarStream(object):
@@ -1067,10 +1104,16 @@ class UntarStream(object):
                  errors=None):
         self.tar_iter = iter(tar_iter)
         self.path_list = path_list
-        self.block = ''
+        # network chunks are kept as they came, without joining them
+        self.chunks = deque()
+        # stream position of the first byte of self.chunks[0]
+        self.chunks_offset = 0
+        # stream position right after the last buffered byte
+        self.buffer_end = 0
         self.encoding = encoding
         self.errors = errors
         self.pax_headers = {}
+        # all offsets are absolute positions in the tar stream
         self.offset = 0
         self.offset_data = 0
         self.to_write = 0
@@ -1078,20 +1121,72 @@ class UntarStream(object):
         self.format = None
 
     def update_buffer(self, data):
-        if self.block:
-            self.block += data
-        else:
-            self.block = data
+        self._release_chunks()
+        if data:
+            self.chunks.append(data)
+            self.buffer_end += len(data)
+
+    def _release_chunks(self):
+        """Drop buffered chunks that hold only already consumed data."""
+        mark = self.offset
+        if self.to_write and self.offset_data < mark:
+            mark = self.offset_data
+        while self.chunks \
+                and self.chunks_offset + len(self.chunks[0]) <= mark:
+            self.chunks_offset += len(self.chunks.popleft())
+
+    def _get_chunk(self, start, size):
+        """Return up to size bytes starting at stream position start,
+           without crossing a chunk boundary. Whole chunks are returned
+           as is, without copying.
+        """
+        pos = self.chunks_offset
+        for chunk in self.chunks:
+            end = pos + len(chunk)
+            if start < end:
+                lo = start - pos
+                hi = min(lo + size, len(chunk))
+                if lo == 0 and hi == len(chunk):
+                    return chunk
+                return chunk[lo:hi]
+            pos = end
+        return ''
+
+    def _get_chunks(self, start, stop):
+        """Return buffered data between stream positions start and stop
+           as a list of chunk slices, walking the buffer only once.
+        """
+        result = []
+        pos = self.chunks_offset
+        for chunk in self.chunks:
+            end = pos + len(chunk)
+            if start < end:
+                lo = max(start - pos, 0)
+                hi = min(stop - pos, len(chunk))
+                if lo == 0 and hi == len(chunk):
+                    result.append(chunk)
+                else:
+                    result.append(chunk[lo:hi])
+                if stop <= end:
+                    break
+            pos = end
+        return result
+
+    def get_buffered_chunks(self, start):
+        """Return all buffered data from stream position start onwards."""
+        return self._get_chunks(start, self.buffer_end)
 
     def __iter__(self):
-        while True:
-            try:
-                data = next(self.tar_iter)
-            except StopIteration:
-                break
+        for data in self.tar_iter:
             self.update_buffer(data)
-            info = self.get_next_tarinfo()
-            while info:
+            while True:
+                if self.to_write or self.fp:
+                    self.write_file()
+                    if self.to_write:
+                        break
+                info = self.get_next_tarinfo()
+                if not info:
+                    break
                 if info.offset_data:
                     for f in self.path_list:
                         if info.name == f.name:
@@ -1099,81 +1194,63 @@ class UntarStream(object):
                             break
                     self.to_write = info.size
                     self.offset_data = info.offset_data
-                    while self.to_write:
-                        if self.fp:
-                            self.fp.write(self.get_file_chunk())
-                            if not self.to_write:
-                                self.fp.close()
-                                self.fp = None
-                        else:
-                            self.skip_file_chunk()
-                        if self.to_write:
-                            self.block = ''
-                            yield data
-                            try:
-                                data = next(self.tar_iter)
-                            except StopIteration:
-                                break
-                            self.update_buffer(data)
-                info = self.get_next_tarinfo()
             yield data
 
     def next_block(self, size=BLOCKSIZE):
-        if size > len(self.block):
-            return None
         stop = self.offset + size
-        if stop > len(self.block):
-            self.block = self.block[self.offset:]
-            self.offset = 0
+        if stop > self.buffer_end:
             return None
         start = self.offset
+        buf = self._get_chunk(start, size)
+        if len(buf) < size:
+            # block spans several network chunks
+            buf = ''.join(self._get_chunks(start, stop))
         self.offset = stop
-        return self.block[start:stop]
+        return buf
 
     def read_tarinfo(self):
+        start = self.offset
         buf = self.next_block()
         if not buf:
             return None
         tarinfo = TarInfo.frombuf(buf)
         tarinfo.offset = self.offset - BLOCKSIZE
         if tarinfo.type in (GNUTYPE_LONGNAME, GNUTYPE_LONGLINK):
-            return tarinfo._proc_gnulong(self)
+            tarinfo = tarinfo._proc_gnulong(self)
         elif tarinfo.type == GNUTYPE_SPARSE:
-            return tarinfo._proc_sparse(self)
+            tarinfo = tarinfo._proc_sparse(self)
         elif tarinfo.type in (XHDTYPE, XGLTYPE, SOLARIS_XHDTYPE):
-            return tarinfo._proc_pax(self)
+            tarinfo = tarinfo._proc_pax(self)
         else:
-            return tarinfo._proc_builtin(self)
+            tarinfo = tarinfo._proc_builtin(self)
+        if not tarinfo:
+            # extended header is not fully buffered yet, re-read it later
+            self.offset = start
+        return tarinfo
 
     def write_file(self):
+        if not self.fp:
+            self.skip_file_chunk()
+            return
         chunk = self.get_file_chunk()
-        if self.fp:
+        while chunk:
             self.fp.write(chunk)
-            if not self.to_write:
-                self.fp.close()
-                self.fp = None
+            chunk = self.get_file_chunk()
+        if not self.to_write:
+            self.fp.close()
+            self.fp = None
 
     def get_file_chunk(self):
-        buf_size = len(self.block)
-        eof = self.offset_data + self.to_write
-        if eof <= buf_size:
-            self.to_write = 0
-            return self.block[self.offset_data:eof]
-        start = self.offset_data
-        self.offset_data = 0
-        self.offset -= buf_size
-        self.to_write = eof - buf_size
-        return self.block[start:]
+        chunk = self._get_chunk(self.offset_data, self.to_write)
+        self.offset_data += len(chunk)
+        self.to_write -= len(chunk)
+        return chunk
 
     def skip_file_chunk(self):
-        buf_size = len(self.block)
-        eof = self.offset_data + self.to_write
-        if eof < buf_size:
-            self.to_write = 0
-            return
-        self.offset_data = 0
-        self.offset -= buf_size
-        self.to_write = eof - buf_size
+        size = min(self.to_write, self.buffer_end - self.offset_data)
+        if size > 0:
+            self.offset_data += size
+            self.to_write -= size
 
     def get_next_tarinfo(self):
         info = None
@@ -1198,14 +1275,15 @@ class UntarStream(object):
 
     def untar_file_iter(self):
         while self.to_write:
-            yield self.get_file_chunk()
-            if self.to_write:
-                self.block = ''
-                try:
-                    data = next(self.tar_iter)
-                except StopIteration:
-                    break
-                self.update_buffer(data)
+            chunk = self.get_file_chunk()
+            if chunk:
+                yield chunk
+                continue
+            try:
+                data = next(self.tar_iter)
+            except StopIteration:
+                break
+            self.update_buffer(data)
 
 if __name__ == "__main__":
     if len(sys.argv) < 4:
@@ -0,0 +1,62 @@
+"""
+Validation of the strings users put into cluster maps
+"""
+import re
+
+# C0 control characters and DEL, all other bytes of str are allowed
+CONTROL_CHARS = ''.join([chr(i) for i in range(0x20)]) + '\x7f'
+
+# characters that can make unicode string invalid, most strings have none of them
+RE_SUSPECT = re.compile(u'[\u0000-\u001f\u007f\ud800-\udfff\ufffe-\uffff]')
+
+# control characters, non-characters and unpaired surrogates in unicode strings
+RE_ILLEGAL = re.compile(
+    u'[\u0000-\u001f\u007f\ufffe-\uffff]' +
+    u'|([%s-%s][^%s-%s])|([^%s-%s][%s-%s])|([%s-%s]$)|(^[%s-%s])' %
+    (unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff),
+     unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff),
+     unichr(0xd800), unichr(0xdbff), unichr(0xdc00), unichr(0xdfff)))
+
+
+def has_control_chars(line):
+    """
+    Returns True if line has control characters or invalid unicode
+
+    Pure ASCII lines are checked with str.translate(), non-ASCII
+    unicode lines need the regex, full one only if they have
+    surrogates or control characters.
+    """
+    if not line:
+        return False
+    if isinstance(line, unicode):
+        try:
+            line = line.encode('ascii')
+        except UnicodeEncodeError:
+            return RE_SUSPECT.search(line) is not None and RE_ILLEGAL.search(line) is not None
+    return len(line.translate(None, CONTROL_CHARS)) != len(line)
+
+
+def cluster_map_has_control_chars(cluster_config):
+    """
+    Checks all the strings in cluster map that are validated by the parser
+
+    Node names, executable properties and device names are joined
+    and checked in one pass. Unexpected value types are reported
+    as invalid too: caller should check each value separately then.
+
+    :param cluster_config: deserialized JSON cluster map
+
+    :returns True if some string in the map may have control characters
+    """
+    try:
+        strings = []
+        for node in cluster_config:
+            strings.append(node.get('name') or '')
+            nexe = node.get('exec') or {}
+            strings.append('%s %s %s' % (nexe.get('path'), nexe.get('args'), nexe.get('env')))
+            for channel in node.get('file_list') or []:
+                strings.append(channel.get('device') or '')
+        # strings are joined with a space, surrogate pairs cannot be made across them
+        return has_control_chars(' '.join(strings))
+    except Exception:
+        return True